@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the whole pipeline on synthetic data (see synthetic_data.py).
+For each cohort size, a cohort of E4 sessions and EMA sheets is written to a
+temporary folder, and the stages are run on it one after the other:
+
+    - cleaner:  E4_Cleaner.main, merging the sessions of every subject week
+    - ema:      EMA_Cleaner.clean_ema, cleaning the wake and sleep sheets
+    - features: E4_Features.main, the features of all EMA windows
+
+Each stage runs in a new process, so its peak memory (maximum resident set
+size of the stage and its worker processes) is measured on its own. The
+script reports the wall time, throughput (E4 samples, EMA rows or feature
+windows per second) and peak memory of each stage, and can save the results
+as JSON.
+
+Usage:  python bench_pipeline.py [--subjects 2 8] [--days 2] [--hours 16] [--workers 1] [--out results.json]
+"""
+
+#Import Libraries
+import os, sys, time, json, shutil, tempfile, argparse, resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+#Scripts folder holds the code under test
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.insert(0, scripts_dir)
+import synthetic_data
+
+STAGES = ('cleaner', 'ema', 'features')
+
+
+def _peak_mb():
+    """Peak resident set size of this process and of its finished child processes (MB)"""
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        #ru_maxrss is in bytes on macOS
+        return max(self_kb, children_kb) / 1024**2
+    #On Linux ru_maxrss keeps the peak of the parent process after exec, VmHWM (kB) does not
+    try:
+        with open('/proc/self/status') as f:
+            self_kb = [int(line.split()[1]) for line in f if line.startswith('VmHWM:')][0]
+    except (OSError, IndexError):
+        pass
+    return max(self_kb, children_kb) / 1024
+
+
+def _generate(folder, n_subjects, days, hours, beeps, seed):
+    """Write the synthetic cohort to folder (in a new process). Returns the samples per data type and the EMA sheets."""
+    weeks, samples = synthetic_data.write_cohort(os.path.join(folder, 'data'), n_subjects, days, hours, beeps, seed)
+    sheets = synthetic_data.make_ema_sheets(weeks, days, hours, beeps, seed)
+    os.makedirs(os.path.join(folder, 'EMA'), exist_ok=True)
+    return samples, sheets
+
+
+def _in_process(function, *args):
+    """Call function in a new process, so its memory use is not counted in the following stages"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(function, *args).result()
+
+
+def _run_stage(stage, folder, workers, sheets):
+    """Run one stage on the cohort in folder (in a new process). Returns wall time, peak memory and counts."""
+    sys.path.insert(0, scripts_dir)
+    root = os.path.join(folder, 'data')
+    ema_dir = os.path.join(folder, 'EMA')
+    counts = {}
+    start = time.perf_counter()
+    if stage == 'cleaner':
+        import E4_Cleaner
+        status = E4_Cleaner.main(['--root', root, '--force', '--workers', str(workers)])
+    elif stage == 'ema':
+        import EMA_Cleaner
+        from EMA_Calendar import StressCalendar
+        Day_df, Sleep_df = EMA_Cleaner.clean_ema(sheets[0], sheets[1], ema_dir, StressCalendar.from_file())
+        counts = {'wake rows': len(Day_df), 'sleep rows': len(Sleep_df)}
+        status = 0
+    else:
+        import E4_Features
+        status = E4_Features.main(['--root', root, '--ema-dir', ema_dir, '--no-resume', '--no-eda-cache',
+                                   '--workers', str(workers)])
+    seconds = time.perf_counter() - start
+    if stage == 'features':
+        import pandas as pd
+        for name in ('EMA_Clean', 'Sleep_Clean'):
+            fullin = os.path.join(ema_dir, name + '_Features_10min.csv')
+            counts[name + ' windows'] = len(pd.read_csv(fullin)) if os.path.isfile(fullin) else 0
+    return {'seconds': seconds, 'peak_mb': _peak_mb(), 'status': status, 'counts': counts}
+
+
+def run_cohort(n_subjects, days, hours, beeps, workers, stages=STAGES, folder=None, seed=0):
+    """Write a synthetic cohort and run the stages on it. Returns a dict of results per stage."""
+    tmp_dir = folder or tempfile.mkdtemp(prefix='e4_bench_')
+    try:
+        start = time.perf_counter()
+        samples, sheets = _in_process(_generate, tmp_dir, n_subjects, days, hours, beeps, seed)
+        results = {'subjects': n_subjects, 'days': days, 'hours': hours, 'samples': samples,
+                   'generate_seconds': time.perf_counter() - start, 'stages': {}}
+
+        #The features need the cleaned EMA files, made without timing if the EMA stage is not run
+        if 'features' in stages and 'ema' not in stages:
+            _in_process(_run_stage, 'ema', tmp_dir, workers, sheets)
+        for stage in [stage for stage in STAGES if stage in stages]:
+            #A new process per stage, so the peak memory is that of the stage alone
+            result = _in_process(_run_stage, stage, tmp_dir, workers, sheets)
+            if stage == 'cleaner':
+                result['counts'] = {'E4 samples': sum(samples.values())}
+            result['throughput'] = {name + '/s': n / result['seconds'] for name, n in result['counts'].items()}
+            results['stages'][stage] = result
+        return results
+    finally:
+        if folder is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def print_results(results):
+    """Table of the results of one cohort"""
+    print('\n' + str(results['subjects']) + ' subject(s), ' + str(results['days']) + ' day(s) of '
+          + str(results['hours']) + ' h per week, ' + str(sum(results['samples'].values())) + ' E4 samples'
+          + ' (generated in %.1f s)' % results['generate_seconds'])
+    print('%-10s %10s %10s %8s  %s' % ('stage', 'time (s)', 'peak (MB)', 'status', 'throughput'))
+    for stage, result in results['stages'].items():
+        rates = ', '.join('%.0f %s' % (rate, name) for name, rate in result['throughput'].items())
+        print('%-10s %10.2f %10.1f %8s  %s' % (stage, result['seconds'], result['peak_mb'], result['status'], rates))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, nargs='+', default=[2], help='cohort sizes to run')
+    parser.add_argument('--days', type=int, default=2, help='recordings (days) per week')
+    parser.add_argument('--hours', type=float, default=16, help='length of each recording')
+    parser.add_argument('--beeps', type=int, default=3, help='wake surveys per day')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the cleaner and features')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES, help='stages to run')
+    parser.add_argument('--keep', default=None, help='write the cohort to this folder and keep it')
+    parser.add_argument('--out', default=None, help='save the results as JSON')
+    args = parser.parse_args()
+
+    all_results = []
+    for n_subjects in args.subjects:
+        folder = os.path.join(args.keep, 'cohort_' + str(n_subjects)) if args.keep else None
+        results = run_cohort(n_subjects, args.days, args.hours, args.beeps, args.workers, args.stages, folder)
+        print_results(results)
+        all_results.append(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(all_results, f, indent=2)
+        print('\nResults saved in ' + args.out)
+
+
+if __name__ == '__main__':
+    main()
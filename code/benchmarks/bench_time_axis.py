@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the time stamp generation in E4_Cleaner.py. A synthetic E4
+session of a few hours is made for each sampling frequency, and the time
+stamps are built both with the old sample by sample loop and with
+E4_IO.make_time_axis. The script reports the run time of both and checks
+that they give the same time stamps.
+
+Usage:  python bench_time_axis.py [--hours 4]
+"""
+
+#Import Libraries
+import os, sys, time, argparse
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+#Scripts folder holds the code under test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from E4_IO import make_time_axis
+
+
+def old_time_axis(start_time, samp_freq, n_samples):
+    """Time stamps as built by E4_Cleaner.py before the vectorized version"""
+    samp_time = 1/samp_freq
+    start_time = pd.to_datetime(start_time, unit='s')
+    times = [start_time]
+    for i in range(1, n_samples):
+        start_time = start_time + timedelta(seconds=samp_time)
+        times.append(start_time)
+    return pd.to_datetime(times).values.astype('datetime64[ns]')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, default=4, help='length of the synthetic session')
+    args = parser.parse_args()
+
+    #Start time as written in the first line of an E4 file
+    start_time = 1527665407.0
+    #Sampling frequencies of the E4 modalities
+    modalities = [('HR', 1), ('EDA', 4), ('TEMP', 4), ('ACC', 32), ('BVP', 64)]
+
+    print('Session length: ' + str(args.hours) + ' hours')
+    print('{:<6}{:>12}{:>12}{:>12}{:>10}{:>16}'.format('Type', 'Samples', 'Old (s)', 'New (s)', 'Speedup', 'Max diff (ns)'))
+    failed = False
+    for name, samp_freq in modalities:
+        n_samples = int(args.hours*3600*samp_freq)
+
+        tic = time.perf_counter()
+        old = old_time_axis(start_time, samp_freq, n_samples)
+        old_sec = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        new = make_time_axis(start_time, samp_freq, n_samples)
+        new_sec = time.perf_counter() - tic
+
+        #Compare the time stamps in nanoseconds
+        max_diff = int(np.max(np.abs(old.astype(np.int64) - new.astype(np.int64))))
+        if max_diff != 0:
+            failed = True
+        print('{:<6}{:>12}{:>12.3f}{:>12.4f}{:>10.0f}{:>16}'.format(
+            name, n_samples, old_sec, new_sec, old_sec/max(new_sec, 1e-9), max_diff))
+
+    if failed:
+        print('Time stamps differ between old and new method!')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
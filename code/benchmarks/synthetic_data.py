@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic study data for testing and benchmarking the scripts without the
+data on the project drive. For a cohort of subjects it writes:
+
+    - E4 session folders in the Empatica layout under
+        <root>/3013068.02_BaLS_sub_XXX/logs/e4/<control|stress>/<start>_A<n>/,
+        with EDA, TEMP, BVP, HR and ACC files (start time on the first line,
+        sampling frequency on the second, one sample per line) and IBI
+        (start time and 'IBI' on the first line, then onset and interval).
+        Each week has one recording per day, from the evening before until
+        the end of the morning, so the nights and the morning surveys are
+        covered.
+    - Castor-style EMA sheets (2._Momentary_Assessment and
+        1._Sleep_Assessment) with the surveys of the same subjects and days:
+        beeps_per_day wake surveys ('EMA <day>.<beep>') in the recordings,
+        and a sleep survey with the first survey of each day. The stress
+        week of each subject starts on a day of stress_weeks.csv, the control
+        week two weeks before it.
+
+The signals are shaped like E4 data (heart rate with a lower rate at night,
+beat intervals with missed beats, pulse wave at the heart rate, skin
+conductance responses on a slow tonic level, skin temperature, and
+accelerometer counts with movement bursts), but are random.
+
+Usage:  python synthetic_data.py <folder> [--subjects 4] [--days 2] [--hours 16]
+"""
+
+#Import Libraries
+import os, sys, argparse
+import numpy as np
+import pandas as pd
+
+#Scripts folder holds the code the data is made for
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from EMA_Calendar import read_stress_weeks
+
+#Sampling frequencies of the E4 modalities
+samp_freqs = {'EDA': 4, 'TEMP': 4, 'BVP': 64, 'HR': 1, 'ACC': 32}
+#Recordings start the evening before each day (hours after midnight), or
+#later for short recordings so they still reach the first survey
+recording_start = -4
+#Sleep (hours after midnight) and the first survey of the day
+sleep_down = -0.5
+sleep_up = 7
+first_beep = 8.5
+
+
+def subject_dir(root, sub_nr, session_type):
+    """Folder of the E4 sessions of a subject and week, as in the study"""
+    return os.path.join(root, '3013068.02_BaLS_sub_' + str(sub_nr).rjust(3, '0'), 'logs', 'e4', session_type)
+
+
+def _write_signal(file_name, start, samp_freq, values, fmt):
+    """Evenly sampled E4 file: start time, sampling frequency, then the samples"""
+    values = np.asarray(values)
+    n_cols = values.shape[1] if values.ndim == 2 else 1
+    with open(file_name, 'w') as f:
+        f.write(', '.join(['%.6f' % start] * n_cols) + '\n')
+        f.write(', '.join(['%.6f' % samp_freq] * n_cols) + '\n')
+        np.savetxt(f, values, fmt=fmt, delimiter=',')
+
+
+def heart_rate(t, asleep, rng):
+    """Heart rate (bpm) at the times t (s), lower during sleep"""
+    hr = 72 + 8 * np.sin(2 * np.pi * t / (3 * 3600) + rng.uniform(0, 2 * np.pi))
+    hr = hr - 12 * asleep + rng.normal(0, 2, len(t))
+    return np.clip(hr, 45, 160)
+
+
+def write_session(session_dir, start, duration, asleep_from, asleep_to, rng):
+    """
+    Write one E4 recording of duration seconds starting at the unix time
+    start. The subject is asleep from asleep_from to asleep_to (seconds from
+    the start). Returns the number of samples per data type.
+    """
+    os.makedirs(session_dir, exist_ok=True)
+    n_samples = {}
+
+    def asleep_at(t):
+        return ((t >= asleep_from) & (t < asleep_to)).astype(float)
+
+    #Heart rate (1 Hz), E4 HR starts 10 s after the other signals
+    t = np.arange(int(duration * samp_freqs['HR'])) / samp_freqs['HR']
+    hr = heart_rate(t, asleep_at(t), rng)
+    _write_signal(os.path.join(session_dir, 'HR.csv'), start + 10, samp_freqs['HR'], hr, '%.2f')
+    n_samples['HR'] = len(hr)
+
+    #Beat intervals from the heart rate, with breathing variation and missed beats
+    mean_ibi = 60 / np.mean(hr)
+    n_beats = int(duration / mean_ibi * 1.1)
+    beat_t = np.arange(n_beats) * mean_ibi
+    ibi = 60 / np.interp(beat_t, t, hr) * (1 + 0.04 * np.sin(2 * np.pi * 0.25 * beat_t)) + rng.normal(0, 0.02, n_beats)
+    onsets = np.cumsum(ibi)
+    keep = (onsets < duration) & (rng.random(n_beats) > 0.3 + 0.5 * (1 - asleep_at(onsets)) * (rng.random(n_beats) < 0.3))
+    with open(os.path.join(session_dir, 'IBI.csv'), 'w') as f:
+        f.write('%.6f, IBI\n' % start)
+        np.savetxt(f, np.column_stack([onsets[keep], ibi[keep]]), fmt='%.6f', delimiter=',')
+    n_samples['IBI'] = int(keep.sum())
+
+    #Pulse wave at the heart rate
+    fs = samp_freqs['BVP']
+    t = np.arange(int(duration * fs)) / fs
+    phase = 2 * np.pi * np.cumsum(np.interp(t, np.arange(len(hr)), hr) / 60) / fs
+    bvp = 60 * np.sin(phase) + 20 * np.sin(2 * phase) + rng.normal(0, 5, len(t))
+    _write_signal(os.path.join(session_dir, 'BVP.csv'), start, fs, bvp, '%.2f')
+    n_samples['BVP'] = len(bvp)
+
+    #Skin conductance: slow tonic level with responses (Bateman shape), more when awake
+    fs = samp_freqs['EDA']
+    t = np.arange(int(duration * fs)) / fs
+    tonic = 1.5 + 0.8 * np.sin(2 * np.pi * t / (5 * 3600) + rng.uniform(0, 2 * np.pi))
+    rate = (2 - 1.5 * asleep_at(t)) / 60 / fs
+    events = (rng.random(len(t)) < rate) * rng.exponential(0.3, len(t))
+    k = np.arange(int(20 * fs)) / fs
+    bateman = np.exp(-k / 2) - np.exp(-k / 0.75)
+    eda = tonic + np.convolve(events, bateman / bateman.max())[:len(t)] + rng.normal(0, 0.005, len(t))
+    _write_signal(os.path.join(session_dir, 'EDA.csv'), start, fs, np.clip(eda, 0.01, None), '%.6f')
+    n_samples['EDA'] = len(eda)
+
+    #Skin temperature, higher at night
+    t = np.arange(int(duration * samp_freqs['TEMP'])) / samp_freqs['TEMP']
+    temp = 32.5 + 1.5 * asleep_at(t) + 0.3 * np.sin(2 * np.pi * t / 3600) + rng.normal(0, 0.02, len(t))
+    _write_signal(os.path.join(session_dir, 'TEMP.csv'), start, samp_freqs['TEMP'], temp, '%.2f')
+    n_samples['TEMP'] = len(temp)
+
+    #Accelerometer (1/64 g): gravity, lying down at night, with movement bursts when awake
+    fs = samp_freqs['ACC']
+    t = np.arange(int(duration * fs)) / fs
+    asleep = asleep_at(t)[:, None]
+    gravity = asleep * np.array([0, 0, 64]) + (1 - asleep) * np.array([10, -62, 10])
+    moving = (1 - asleep[:, 0]) * (np.sin(2 * np.pi * t / 600 + rng.uniform(0, 6)) > 0.6)
+    acc = gravity + rng.normal(0, 1, (len(t), 3)) + moving[:, None] * rng.normal(0, 25, (len(t), 3))
+    _write_signal(os.path.join(session_dir, 'ACC.csv'), start, fs, np.clip(np.rint(acc), -128, 127), '%d')
+    n_samples['ACC'] = len(acc)
+    return n_samples
+
+
+def recording_hours(hours):
+    """Start and end (hours after midnight) of the recording of a day"""
+    start = max(recording_start, first_beep + 1 - hours)
+    return start, start + hours
+
+
+def write_cohort(root, n_subjects=4, days=2, hours=16, beeps_per_day=3, seed=0):
+    """
+    Write the E4 sessions of n_subjects subjects (control and stress week,
+    days recordings of hours each per week) under root. Returns the weeks as
+    a list of (subject number, session type, first day) and the number of
+    samples per data type.
+    """
+    rng = np.random.default_rng(seed)
+    stress_starts = read_stress_weeks()
+    weeks = []
+    totals = {}
+    for sub_nr in range(1, n_subjects + 1):
+        stress_day = pd.Timestamp(stress_starts[(sub_nr - 1) % len(stress_starts)])
+        for session_type, first_day in [('control', stress_day - pd.Timedelta(days=14)), ('stress', stress_day)]:
+            weeks.append((sub_nr, session_type, first_day))
+            for day in range(days):
+                midnight = first_day + pd.Timedelta(days=day)
+                start = (midnight + pd.Timedelta(hours=recording_hours(hours)[0])).timestamp() + rng.integers(0, 600)
+                session_dir = os.path.join(subject_dir(root, sub_nr, session_type), '%d_A%05d' % (start, sub_nr))
+                asleep_from = midnight.timestamp() + sleep_down * 3600 - start
+                asleep_to = midnight.timestamp() + sleep_up * 3600 - start
+                n_samples = write_session(session_dir, start, hours * 3600, asleep_from, asleep_to, rng)
+                for name, n in n_samples.items():
+                    totals[name] = totals.get(name, 0) + n
+    return weeks, totals
+
+
+def make_ema_sheets(weeks, days=2, hours=16, beeps_per_day=3, seed=0):
+    """
+    Castor exports of the wake and sleep surveys of the weeks from
+    write_cohort, as two data frames with the columns of the export.
+    """
+    rng = np.random.default_rng(seed + 1)
+    day_rows = []
+    sleep_rows = []
+    n = 0
+    #Surveys between the first beep and the end of the recording
+    last_beep = max(recording_hours(hours)[1] - 0.5, first_beep)
+    for sub_nr, session_type, first_day in weeks:
+        for day in range(days):
+            midnight = first_day + pd.Timedelta(days=day)
+            for beep in range(beeps_per_day):
+                n += 1
+                hour = first_beep + beep * (last_beep - first_beep) / max(beeps_per_day - 1, 1)
+                completed = midnight + pd.Timedelta(hours=hour, minutes=int(rng.integers(0, 20)),
+                                                    seconds=int(rng.integers(0, 60)))
+                row = {'Castor Record ID': 'sub_' + str(sub_nr).rjust(3, '0') + '-' + str(rng.integers(10)),
+                       'Survey Instance ID': 'SI%06d' % n,
+                       'Survey Package Name': 'EMA ' + str(day + 1) + '.' + str(beep + 1),
+                       'Survey Completed On': completed.strftime('%d-%m-%Y %H:%M:%S'),
+                       'Survey Progress': 100}
+                day_rows.append(dict(row, **{'Stress (0-10)': int(rng.integers(0, 11)),
+                                             'Mood (1-7)': int(rng.integers(1, 8)),
+                                             'Activity': rng.choice(['study', 'work', 'rest', 'sport'])}))
+                if beep == 0:
+                    down = (midnight + pd.Timedelta(hours=sleep_down, minutes=int(rng.integers(-30, 30))))
+                    up = (midnight + pd.Timedelta(hours=sleep_up, minutes=int(rng.integers(-30, 30))))
+                    sleep_rows.append(dict(row, **{'Sleep Down': down.strftime('%H:%M'), 'Sleep Up': up.strftime('%H:%M'),
+                                                   'Sleep Quality (1-5)': int(rng.integers(1, 6))}))
+    return pd.DataFrame(day_rows), pd.DataFrame(sleep_rows)
+
+
+def write_ema(ema_dir, Day_df, Sleep_df):
+    """Write the EMA sheets as EMA.xlsx (needs openpyxl) in ema_dir. Returns the path."""
+    os.makedirs(ema_dir, exist_ok=True)
+    fullout = os.path.join(ema_dir, 'EMA.xlsx')
+    with pd.ExcelWriter(fullout) as writer:
+        Sleep_df.to_excel(writer, sheet_name='1._Sleep_Assessment', index=False)
+        Day_df.to_excel(writer, sheet_name='2._Momentary_Assessment', index=False)
+    return fullout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help='output folder (data/ and EMA/ are made in it)')
+    parser.add_argument('--subjects', type=int, default=4, help='number of subjects')
+    parser.add_argument('--days', type=int, default=2, help='recordings (days) per week')
+    parser.add_argument('--hours', type=float, default=16, help='length of each recording')
+    parser.add_argument('--beeps', type=int, default=3, help='wake surveys per day')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    weeks, totals = write_cohort(os.path.join(args.folder, 'data'), args.subjects, args.days, args.hours,
+                                 args.beeps, args.seed)
+    Day_df, Sleep_df = make_ema_sheets(weeks, args.days, args.hours, args.beeps, args.seed)
+    print('E4 samples: ' + ', '.join(name + ' ' + str(n) for name, n in sorted(totals.items())))
+    try:
+        print('EMA sheets: ' + write_ema(os.path.join(args.folder, 'EMA'), Day_df, Sleep_df))
+    except ImportError:
+        #No Excel writer: CSV files of the sheets instead
+        os.makedirs(os.path.join(args.folder, 'EMA'), exist_ok=True)
+        Day_df.to_csv(os.path.join(args.folder, 'EMA', '2._Momentary_Assessment.csv'), index=False)
+        Sleep_df.to_csv(os.path.join(args.folder, 'EMA', '1._Sleep_Assessment.csv'), index=False)
+        print('EMA sheets written as CSV (openpyxl is needed for EMA.xlsx)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accumulator for the data of several E4 sessions, used when the sessions of a
+week are merged (E4_Cleaner.py) and when the weeks of a subject are loaded
+(E4_Features.py).
+
+    - Session data frames are collected and joined once at the end, instead
+        of appending to a growing data frame (which copies all data collected
+        so far on each append).
+    - When the total number of rows is known beforehand (e.g. from the
+        metadata of Parquet files), the columns are preallocated and each
+        session is copied into place, and the result is made from these
+        columns without another copy. A session can be added in parts (e.g.
+        the record batches of a Parquet file), so only one part is in memory
+        next to the columns.
+    - Sessions are usually sorted in time and do not overlap, so they are
+        put in order by their first time stamp. The full data is only sorted
+        when sessions overlap or a session is not sorted itself.
+
+"""
+
+#Import Libraries
+import numpy as np
+import pandas as pd
+
+
+class SessionAccumulator:
+    """
+    Collects the data frames of E4 sessions, and joins them into one data
+    frame sorted by time with result(). n_rows is the total number of rows
+    if known, which preallocates the columns.
+    """
+
+    def __init__(self, n_rows=None, time_col='Time'):
+        self.n_rows = n_rows
+        self.time_col = time_col
+        self.columns = None
+        #Session data frames, or preallocated columns with the number filled
+        self.chunks = []
+        self.buffers = None
+        self.n_filled = 0
+        #Per session: first and last time stamp, if sorted in itself, and length
+        self.bounds = []
+
+    def __len__(self):
+        return self.n_filled + sum(len(df) for df in self.chunks)
+
+    def add(self, df):
+        """Add the data frame of one session (empty data frames are skipped)"""
+        if len(df) == 0:
+            return
+        if self.columns is None:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            raise ValueError('Session columns ' + str(list(df.columns)) + ' do not match ' + str(self.columns))
+
+        #Time stamps of the session, to check the order later
+        times = df[self.time_col].to_numpy()
+        is_sorted = bool(np.all(times[1:] >= times[:-1]))
+        self.bounds.append((times[0], times[-1], is_sorted, len(df)))
+
+        #Copy into the preallocated columns if it still fits, keep the frame otherwise
+        if self.n_rows is not None and not self.chunks and self.n_filled + len(df) <= self.n_rows:
+            if self.buffers is None:
+                self.buffers = {col: np.empty(self.n_rows, dtype=df[col].dtype) for col in self.columns}
+            start, stop = self.n_filled, self.n_filled + len(df)
+            for col in self.columns:
+                values = df[col].to_numpy()
+                buffer = self.buffers[col]
+                #Upcast the column if the session has a wider type (e.g. int and float)
+                if values.dtype != buffer.dtype:
+                    dtype = np.result_type(buffer.dtype, values.dtype)
+                    if dtype != buffer.dtype:
+                        self.buffers[col] = buffer = buffer.astype(dtype)
+                buffer[start:stop] = values
+            self.n_filled = stop
+        else:
+            self.chunks.append(df)
+
+    def _order(self):
+        """
+        Order of the sessions by first time stamp, and whether that order
+        gives sorted data without sorting the rows.
+        """
+        order = sorted(range(len(self.bounds)), key=lambda i: (self.bounds[i][0], self.bounds[i][1]))
+        in_order = all(self.bounds[i][2] for i in order)
+        for prev, nxt in zip(order[:-1], order[1:]):
+            if self.bounds[nxt][0] < self.bounds[prev][1]:
+                in_order = False
+        return order, in_order
+
+    def result(self):
+        """Join all sessions into one data frame, sorted by time"""
+        if self.columns is None:
+            return pd.DataFrame()
+        order, in_order = self._order()
+
+        #Sessions kept as data frames only: join them in time order
+        if self.buffers is None:
+            if in_order:
+                return pd.concat([self.chunks[i] for i in order], ignore_index=True)
+            full_df = pd.concat(self.chunks, ignore_index=True)
+            return full_df.sort_values(self.time_col, kind='stable', ignore_index=True)
+
+        #Preallocated rows first, then any sessions that did not fit. Sessions
+        #are in the order they were added
+        full_df = pd.DataFrame({col: self.buffers[col][:self.n_filled] for col in self.columns}, copy=False)
+        if self.chunks:
+            full_df = pd.concat([full_df] + self.chunks, ignore_index=True)
+        if not in_order:
+            #Overlapping or unsorted sessions: stable sort of the joined rows
+            return full_df.sort_values(self.time_col, kind='stable', ignore_index=True)
+        if order == list(range(len(order))):
+            return full_df
+
+        #Take the rows of each session in time order
+        starts = np.cumsum([0] + [bound[3] for bound in self.bounds])
+        index = np.concatenate([np.arange(starts[i], starts[i+1]) for i in order])
+        return full_df.take(index).reset_index(drop=True)
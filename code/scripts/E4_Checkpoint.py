@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoints for the feature extraction in E4_Features.py, so a run that
+stops (crash, time limit on the cluster) can continue where it was.
+
+    - Features of finished EMA rows are appended to a checkpoint file next to
+        the feature file, every few subjects, instead of writing the whole
+        feature table after every row.
+    - Rows are identified by subject and survey instance (or survey time if
+        the file has no survey instance IDs). On a restart the rows already
+        in the checkpoint file are skipped.
+    - The final feature file is only written at the end, from the EMA data
+        and all rows in the checkpoint file.
+
+"""
+
+#Import Libraries
+import os
+import pandas as pd
+
+
+class FeatureCheckpoint:
+    """
+    Append-only store of finished feature rows for one feature file.
+    flush_every is the number of subjects collected before they are
+    appended to the checkpoint file. With resume=False an old checkpoint
+    file is removed and all rows are calculated again.
+    """
+
+    def __init__(self, feature_file, EMA_df, feature_cols, flush_every=5, resume=True):
+        self.feature_file = feature_file
+        self.path = os.path.splitext(feature_file)[0] + '.checkpoint.csv'
+        self.feature_cols = list(feature_cols)
+        self.flush_every = flush_every
+        #Columns that identify an EMA row
+        key = 'survey_instance_id' if 'survey_instance_id' in EMA_df.columns else 'survey_completed_on'
+        self.key_cols = ['castor_record_id', key]
+        self.pending = []
+        self.n_pending_subjects = 0
+
+        if not resume and os.path.isfile(self.path):
+            os.remove(self.path)
+        self.done = set(self.row_keys(self.read())) if os.path.isfile(self.path) else set()
+
+    def row_keys(self, df):
+        """Keys of the rows of a data frame, as tuples of strings"""
+        if len(df) == 0:
+            return pd.Series([], dtype=object)
+        return pd.Series(list(zip(*[df[col].astype(str) for col in self.key_cols])), index=df.index)
+
+    def is_done(self, df):
+        """Boolean series, True for the rows that are in the checkpoint already"""
+        return self.row_keys(df).isin(self.done)
+
+    def add(self, df):
+        """Add the finished rows of one subject, appended to the file every flush_every subjects"""
+        self.pending.append(df[self.key_cols + self.feature_cols])
+        self.n_pending_subjects += 1
+        if self.n_pending_subjects >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Append all collected rows to the checkpoint file"""
+        if not self.pending:
+            return
+        rows = pd.concat(self.pending)
+        rows.to_csv(self.path, mode='a', index=None, header=not os.path.isfile(self.path))
+        self.done.update(self.row_keys(rows))
+        self.pending = []
+        self.n_pending_subjects = 0
+
+    def read(self):
+        """All rows in the checkpoint file"""
+        return pd.read_csv(self.path)
+
+    def finalize(self, EMA_df, keep=False):
+        """
+        Write the feature file: the EMA data with the features of all rows in
+        the checkpoint file. The checkpoint file is removed unless keep is True.
+        """
+        self.flush()
+        if os.path.isfile(self.path):
+            rows = self.read()
+            rows.index = self.row_keys(rows)
+            rows = rows[~rows.index.duplicated(keep='last')]
+            keys = self.row_keys(EMA_df)
+            found = keys.isin(rows.index)
+            EMA_df.loc[found, self.feature_cols] = rows.loc[keys[found], self.feature_cols].to_numpy()
+        EMA_df.to_csv(self.feature_file, index = None, header=True)
+        if not keep and os.path.isfile(self.path):
+            os.remove(self.path)
+        return EMA_df
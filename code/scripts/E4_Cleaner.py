@@ -1,212 +1,375 @@
 """
 
-This script accepts either an input argument for a subject (with edits) or will
-loop over subjects to convert their multiple E4 sessions into a single csv file 
-for stress and control weeks. 
+This script accepts either a list of subjects (--subjects) or will loop over
+all subjects to convert their multiple E4 sessions into a single csv file
+for stress and control weeks.
 
 Given a subject ID, it will access the folder, extract the time stamps,
 merge all sessions with timestamps into one file, and save it as a single file
-with all time stamps for each data pount. 
+with all time stamps for each data pount. Merged files are written as Parquet
+by default (see out_format below), which keeps the time stamps as datetimes,
+ACC as int8 and the other signals as float32 (see E4_Schema). The old tab
+separated CSV can still be selected.
 
-    - Time stamps are calcualted by adding the sampling frequency to the 
-        start time of the recording
-    - ACC data is also inclueds a calculation for mean displacement taking 
+    - Time stamps are calcualted from the start time of the recording and
+        the sampling frequency (see E4_IO.make_time_axis)
+    - ACC data is also inclueds a calculation for mean displacement taking
         the XYZ directions into a single value
-    - IBI timestamps are derived by adding the time from onset to the start 
+    - IBI timestamps are derived by adding the time from onset to the start
         time of the recording
-        
-        
+    - Each subject, session and data type is merged as a separate task on
+        absolute paths, so tasks can run in parallel (--workers). Failed
+        tasks are reported at the end, and give a non-zero exit status.
+    - With --store, the evenly sampled signals are also written to a
+        memory-mapped store (see E4_Store), for fast reads of any window.
+        Samples the store cannot hold as they are (overlapping sessions, or
+        sessions out of phase with the sampling grid) are reported per task.
+    - With --stream, the session files are read and written in chunks of
+        --chunk-rows rows (see E4_Stream), so long recordings do not have to
+        fit in memory. Weeks with overlapping sessions are merged in memory.
+    - Each merged file has a manifest of the sessions it was made from (see
+        E4_Manifest). A rerun skips files whose sessions have not changed,
+        and adds new sessions to the existing merged file instead of reading
+        all sessions again. --force merges everything again.
+    - With --tiles, the multi-resolution summaries used by E4_Plots.py (see
+        E4_Tiles) are built after the merge, instead of on the first plot.
+
+Usage:  python E4_Cleaner.py [--subjects 1 2 3] [--workers 8] [--format parquet] [--stream] [--force]
+
 Author:         Rayyan Toutounji
 Last Modified:  08-APR-2020
 
 """
 
 #Import Libraries
-import os, errno, ast
+import os, sys, argparse, traceback
 import numpy as np
 import pandas as pd
 import datetime as dt
-from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from E4_IO import make_time_axis, write_merged, read_merged, merged_name
+from E4_Accumulator import SessionAccumulator
+from E4_Store import build_store as build_signal_store, store_issues
+from E4_Manifest import MergeManifest, source_files
+import E4_Stream
+from E4_Tiles import update_tiles
 
 #Turnoff write warning in Pandas
-pd.options.mode.chained_assignment = None  
+pd.options.mode.chained_assignment = None
+
+#Output format of the merged files: 'parquet', 'feather' or 'csv' (old format)
+out_format = 'parquet'
+#Also write the memory-mapped signal store (see E4_Store)
+build_store = False
+#Read and write the sessions in chunks of chunk_rows rows (see E4_Stream)
+stream = False
+chunk_rows = E4_Stream.chunk_rows
+#Merge all sessions again, also when the manifest says nothing changed
+force = False
+#Also build the plot tiles (see E4_Tiles)
+build_tiles = False
+
+#Folder with the subject data, sessions and E4 data types
+data_root = "/project/3013068.02/data/"
+sessions = ['control', 'stress']
+data_types = ['EDA.csv','TEMP.csv', 'IBI.csv','BVP.csv', 'HR.csv', 'ACC.csv']
 
 
-#Loop over subjects
-for sub_nr in range(1,200):
-    #Print which subject, and set directories
-    print ('Processing subject number ' + str(sub_nr))
+def session_path(sub_nr, session_type, root=None):
+    """Absolute path of the E4 folder of a subject for one session (week)"""
     #Set sub nr as padded string
-    sub=str(sub_nr)
-    sub = sub.rjust (3, '0')
-    #Make array with the two sessions for loop
-    sessions = ['control/', 'stress/']
-    for session_type in sessions:
-        
-        #Path with E4 files. Only run if the files exist
-        filepath = ("/project/3013068.02/data/3013068.02_BaLS_sub_" + str(sub) + "/logs/e4/"+str(session_type))
-        if os.path.isdir(filepath)==True:
-            if len(os.listdir(filepath) ) >= 1:
-                
-                #Set as working directory
-                os.chdir (str(filepath))
-                
-                #Check if merge directory (for output) exists, if not then make it
-                try:
-                    os.makedirs('merge/')
-                except FileExistsError:
-                    pass
-                
-                #Set E4 data types for loop
-                data_types=['EDA.csv','TEMP.csv', 'IBI.csv','BVP.csv', 'HR.csv', 'ACC.csv']
+    sub = str(sub_nr).rjust(3, '0')
+    root = data_root if root is None else root
+    return os.path.join(root, "3013068.02_BaLS_sub_" + sub, "logs", "e4", session_type)
+
+
+def session_dirs(filepath):
+    """All directories with E4 sessions in a session folder, without the merge, store and tiles directories"""
+    return sorted(k for k in os.listdir(filepath)
+                  if k not in ('merge', 'store', 'tiles') and os.path.isdir(os.path.join(filepath, k)))
+
+
+def merge_ibi(filepath, dir_list):
+    """Merge the IBI files of all sessions into one data frame"""
+    #Collect sessions for data type, joined in time order at the end
+    sessions_acc=SessionAccumulator()
+    #Select Directory from available list
+    for k in dir_list:
+
+        #Select File for single session, import as df
+        file_name=os.path.join(filepath, k, 'IBI.csv')
+
+        #Only run if IBI files contains data (Skip over empty files)
+        if os.stat(file_name).st_size!=0:
+
+            #Read CSV
+            df=pd.read_csv(file_name, sep=',', header=0)
+            #Get time stamp
+            time=list(df)
+            time=time[0]
+            time=float(time)
+
+            #Rename time column to time, data to Data
+            df=df.rename(columns={ df.columns[0]: "Time" })
+            df=df.rename(columns={ df.columns[1]: "Data" })
+
+            #Add the starttime from time stamp (time) to the column+Convert to datetime
+            df['Time']=time + df['Time']
+            df['Time']=pd.to_datetime(df['Time'],unit='s')
+
+            #Add to the collected sessions
+            sessions_acc.add(df[['Time', 'Data']])
+
+    #Join sessions sorted by date, convert IBI to ms:
+    full_df = sessions_acc.result()
+    #No session with beats: empty frame with the IBI columns
+    if len(full_df)==0:
+        return pd.DataFrame({'Time': pd.Series([], dtype='datetime64[ns]'), 'Data': pd.Series([], dtype=float)})
+    full_df['Data']=full_df['Data']*1000
+    return full_df
+
+
+def merge_acc(filepath, dir_list):
+    """Merge the ACC files of all sessions into one data frame"""
+    #Collect sessions for data type, joined in time order at the end
+    sessions_acc=SessionAccumulator()
+    #Select Directory, go through files
+    for k in dir_list:
+
+        #Select File, Import as df
+        file_name=os.path.join(filepath, k, 'ACC.csv')
+        df=pd.read_csv(file_name, sep=',', header=0)
+
+        #Get time stamp (Used Later)
+        time=list(df)
+        time=time[0]
+        time=float(time)
+
+        #Get Sampling Frequency
+        samp_freq=df.iloc[0,0]
+        samp_freq=float(samp_freq)
+
+        #Drop sampling rate from df (first row)
+        df=df.drop([0])
+
+        #Rename data columns to corresponding axes
+        df=df.rename(columns={ df.columns[0]: "ACC_X" })
+        df=df.rename(columns={ df.columns[1]: "ACC_Y" })
+        df=df.rename(columns={ df.columns[2]: "ACC_Z" })
+
+        #Make array of time stamps, add time and data to dataframe
+        df['Time'] = make_time_axis(time, samp_freq, len(df))
+
+        #Add to the collected sessions
+        sessions_acc.add(df)
+    #Join sessions sorted by date:
+    return sessions_acc.result()
+
+
+def merge_signal(filepath, dir_list, data_type):
+    """Merge the files of all sessions of a single channel data type (EDA, TEMP, BVP, HR)"""
+    #Collect sessions for data type, joined in time order at the end
+    sessions_acc=SessionAccumulator()
+    for k in dir_list:
+        #Select File, Import to df
+        file_name=os.path.join(filepath, k, data_type)
+        df=pd.read_csv(file_name, sep=',', header=0)
+        ##Get start time+sampling frequency
+        start_time = list(df)
+        start_time=start_time[0]
+        samp_freq=df.iloc[0,0]
+        #Drop sampling rate from df
+        df=df.drop([0])
+        #Make array of time, add time and data to dataframe
+        df['Time']= make_time_axis(start_time, samp_freq, len(df))
+        #Rename first column to Data
+        df=df.rename(columns={df.columns[0]: "Data" })
+        #Add to the collected sessions
+        sessions_acc.add(df)
+
+    #Join sessions sorted by date:
+    return sessions_acc.result()
+
+
+def merge_sessions(filepath, dir_list, data_type):
+    """Merge the files of one data type from the session directories dir_list into one data frame"""
+    #IBI and ACC are special cases
+    if data_type=='IBI.csv':
+        return merge_ibi(filepath, dir_list)
+    elif data_type=='ACC.csv':
+        return merge_acc(filepath, dir_list)
+    return merge_signal(filepath, dir_list, data_type)
+
+
+def merge_data_type(filepath, data_type, out_format=out_format, store=build_store, stream=stream, rows=chunk_rows,
+                    force=force, tiles=build_tiles):
+    """
+    Merge all E4 sessions in a session folder for one data type, and save it
+    in the merge directory of that folder (and in the store directory if
+    store is True). With stream, the sessions are merged in chunks of rows
+    rows, unless they overlap in time. Only new sessions are read when the
+    manifest of the merged file (see E4_Manifest) shows that the others have
+    not changed, and nothing is done if no session with data was added,
+    unless force is True. With tiles, the plot tiles are built if they are out of date.
+    Returns the path of the output and what was done ('skip', 'append' or
+    'full').
+    """
+    fullout, action = _merge_data_type(filepath, data_type, out_format, store, stream, rows, force)
+    if tiles and os.path.isfile(fullout):
+        update_tiles(filepath, data_type)
+    return fullout, action
+
+
+def _merge_data_type(filepath, data_type, out_format, store, stream, rows, force):
+    """Merge of merge_data_type, without the tiles"""
+    #Check if merge directory (for output) exists, if not then make it
+    merge_dir = os.path.join(filepath, 'merge')
+    os.makedirs(merge_dir, exist_ok=True)
+
+    #Get all directories with E4 sessions for subject
+    dir_list = session_dirs(filepath)
+
+    #Compare the session files with the last merge
+    manifest = MergeManifest(filepath, data_type)
+    sources = source_files(filepath, dir_list, data_type)
+    output = os.path.join(merge_dir, merged_name(data_type, out_format))
+    action, new_dirs = ('full', []) if force else manifest.plan(sources, out_format, store, output)
+    if action == 'skip':
+        return output, action
+    if action == 'full':
+        new_dirs = dir_list
+    #Only sessions with data in their export (empty exports add nothing)
+    new_dirs = [k for k in new_dirs if sources.get(k, [0])[0] > 0]
+    if action == 'append' and not new_dirs:
+        #Only empty sessions were added: the output stays, the manifest records them
+        manifest.write(sources, out_format, store, manifest.entry['n_rows'])
+        return output, 'skip'
+    existing = output if action == 'append' else None
+    #The manifest is only valid again when the new output is complete
+    manifest.remove()
+
+    if stream:
+        try:
+            sink = E4_Stream.stream_merge(filepath, new_dirs, data_type, out_format, rows, store, existing)
+            manifest.write(sources, out_format, store, sink.n_rows)
+            return sink.path, action
+        except E4_Stream.SessionOverlapError:
+            #Sorting overlapping sessions needs all data, merge in memory
+            pass
+
+    full_df = merge_sessions(filepath, new_dirs, data_type)
+    if existing is not None:
+        #New sessions joined with the earlier merge, in time order
+        sessions_acc = SessionAccumulator()
+        sessions_acc.add(read_merged(merge_dir, data_type))
+        sessions_acc.add(full_df)
+        full_df = sessions_acc.result()
+
+    #Save in the merge directory, and the signal store (after it, so the store is not older)
+    fullout = write_merged(full_df, merge_dir, data_type, out_format)
+    if store:
+        build_signal_store(full_df, filepath, data_type)
+    manifest.write(sources, out_format, store, len(full_df))
+    return fullout, action
+
+
+def find_tasks(subjects, root=None):
+    """List of (subject, session, data type) tasks for session folders that exist and have files"""
+    tasks = []
+    for sub_nr in subjects:
+        for session_type in sessions:
+            #Path with E4 files. Only run if the files exist
+            filepath = session_path(sub_nr, session_type, root)
+            if os.path.isdir(filepath) and len(os.listdir(filepath)) >= 1:
                 for data_type in data_types:
-                   
-                    #Get all directories with E4 sessions for subject, merge directory from the list
-                    directories = [x[1] for x in os.walk(filepath)]
-                    dir_list=[item for item in directories[0]]
-                    dir_list.remove('merge')  
-                    
-                    #Make Empty DF as master df for data type
-                    full_df=pd.DataFrame()
-                    
-                    #IBI is special case
-                    if data_type=='IBI.csv':
-                        
-                        #Select Directory from available list
-                        for k in dir_list:
-                            
-                            #Select File for single session, import as df
-                            file_name=((str(k))+'/'+ data_type)
-                            
-                            #Only run if IBI files contains data (Skip over empty files)
-                            if os.stat(file_name).st_size!=0:
-                                
-                                #Read CSV
-                                df=pd.read_csv(file_name, sep=',', header=0)
-                                #Get time stamp
-                                time=list(df)
-                                time=time[0]
-                                time=float(time) 
-                                
-                                #Rename time column to time, data to Data
-                                df=df.rename(columns={ df.columns[0]: "Time" })
-                                df=df.rename(columns={ df.columns[1]: "Data" })
-                                
-                                #Add the starttime from time stamp (time) to the column+Convert to datetime
-                               # time=dt.datetime.fromtimestamp(time)
-                                df['Time']=time + df['Time']
-                                df['Time']=pd.to_datetime(df['Time'],unit='s')
-                            
-                                #Append to master data frame the clear it for memory
-                                full_df =full_df.append(df)[df.columns.tolist()]
-                                df=pd.DataFrame()
-                                
-                        #Convert IBI to ms and sort by date:
-                        full_df['Data']=full_df['Data']*1000
-                        full_df = full_df.sort_values('Time', ascending=True)
-                        
-                        #Set Output Names and direcotries, save as csv
-                        outputdir=('merge/')
-                        outputname='full_'+str(data_type)
-                        fullout=(str(outputdir)+str(outputname))
-                        full_df.to_csv(str(fullout),sep='\t',index=False)
-                        
-                    #ACC also special case, implement alternate combination method
-                    elif data_type=='ACC.csv':
-                        
-                        #Select Directory, go through files
-                        for k in dir_list:
-                            
-                            #Select File, Import as df
-                            file_name=((str(k))+'/'+ data_type)  
-                            df=pd.read_csv(file_name, sep=',', header=0)
-                            
-                            #Get time stamp (Used Later)
-                            time=list(df)
-                            time=time[0]
-                            time=float(time) 
-                            
-                            #Get Sampling Frequency, convert to time
-                            samp_freq=df.iloc[0,0]
-                            samp_freq=float(samp_freq)
-                            samp_time=1/samp_freq
-                        
-                            #Drop sampling rate from df (first row)
-                            df=df.drop([0])
-                            
-                            #Rename data columns to corresponding axes
-                            df=df.rename(columns={ df.columns[0]: "ACC_X" })
-                            df=df.rename(columns={ df.columns[1]: "ACC_Y" })
-                            df=df.rename(columns={ df.columns[2]: "ACC_Z" })
-                                    
-                            #Make array of time stamps
-                            df_len=len(df)
-                            time=pd.to_datetime(time,unit='s')
-                            times = [time]
-                            for i in range (1,(df_len)):
-                                time = time + timedelta(seconds=samp_time)
-                                times.append (time)
-        
-                            #Add time and data to dataframe
-                            df['Time'] = times
-                            
-                            #Append to master data frame
-                            full_df =full_df.append(df)
-                            df=pd.DataFrame()
-                        #Sort master by date:
-                        full_df = full_df.sort_values('Time', ascending=True)
-                        
-                        #Set Output Names and direcotries, save as csv
-                        outputdir=('merge/')
-                        outputname='full_'+str(data_type)
-                        fullout=(str(outputdir)+str(outputname))
-                        full_df.to_csv(str(fullout),sep='\t',index=False)
-                        
-                    #All other data structures:              
-                    else:
-                        for k in dir_list:
-                            #Select File, Import to df
-                            file_name=((str(k))+'/'+ data_type)  
-                            df=pd.read_csv(file_name, sep=',', header=0)
-                            ##Get start time+sampling frequency
-                            start_time = list(df)
-                            start_time=start_time[0]
-                            samp_freq=df.iloc[0,0]
-                            #Change samp freq to samp time
-                            samp_time=1/samp_freq
-                            #Drop sampling rate from df
-                            df=df.drop([0])
-                            #Convert start time to date time
-                            start_time=int(float(start_time))
-                            start_time=pd.to_datetime(start_time,unit='s')
-                            #Make array of time
-                            file_len=len(df)	
-                            times = [start_time]
-                            for i in range (1,(file_len)):
-                                start_time = start_time + timedelta(seconds=samp_time)
-                                times.append (start_time)
-                            #Add time and data to dataframe
-                            df['Time']= times
-                            #Rename first column to Data
-                            df=df.rename(columns={df.columns[0]: "Data" })
-                            #Append to master data frame
-                            full_df =full_df.append(df)
-                            df=pd.DataFrame()
-                        
-                        #Sort by date:
-                        full_df = full_df.sort_values('Time', ascending=True)
-                        
-                        #Set Output Names and direcotries
-                        outputdir=('merge/')
-                        outputname='full_'+str(data_type)
-                        #Output Raw File
-                        fullout=(str(outputdir)+str(outputname))
-                        full_df.to_csv(str(fullout),sep='\t',index=False)
-        
-            
-    
-        
-    
-    
-    
-    
+                    tasks.append((sub_nr, session_type, data_type))
+    return tasks
+
+
+def run_task(task, out_format=out_format, root=None, store=build_store, stream=stream, rows=chunk_rows, force=force,
+             tiles=build_tiles):
+    """
+    Run one merge task. Returns the task, what was done ('skip', 'append' or
+    'full', see merge_data_type) and None on success, or the error (with
+    traceback) on failure, so one broken session does not stop the rest.
+    """
+    sub_nr, session_type, data_type = task
+    try:
+        _, action = merge_data_type(session_path(sub_nr, session_type, root), data_type, out_format, store,
+                                    stream, rows, force, tiles)
+        return task, action, None
+    except Exception:
+        return task, None, traceback.format_exc()
+
+
+def run_tasks(tasks, workers=1, out_format=out_format, root=None, store=build_store, stream=stream, rows=chunk_rows,
+              force=force, tiles=build_tiles):
+    """
+    Run the merge tasks on a pool of worker processes (in this process if
+    workers is 1), printing progress per task. Returns the failed tasks as a
+    list of (task, error).
+    """
+    failed = []
+    n_tasks = len(tasks)
+    statuses = {'skip': 'up to date', 'append': 'new sessions added', 'full': 'done'}
+
+    def report(n_done, task, action, error):
+        sub_nr, session_type, data_type = task
+        status = statuses[action] if error is None else 'FAILED'
+        #Samples the signal store does not hold as they are (reads of the features use the merged file)
+        if store and error is None:
+            issues = store_issues(os.path.join(session_path(sub_nr, session_type, root), 'store'), data_type)
+            if issues:
+                status += ' (store: ' + issues + ', not used for reading)'
+        print('[' + str(n_done) + '/' + str(n_tasks) + '] sub ' + str(sub_nr).rjust(3, '0') +
+              ' ' + session_type + ' ' + data_type + ' ' + status, flush=True)
+        if error is not None:
+            failed.append((task, error))
+
+    if workers <= 1:
+        for n_done, task in enumerate(tasks, 1):
+            report(n_done, *run_task(task, out_format, root, store, stream, rows, force, tiles))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_task, task, out_format, root, store, stream, rows, force, tiles) for task in tasks]
+            for n_done, future in enumerate(as_completed(futures), 1):
+                report(n_done, *future.result())
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge the E4 sessions of each subject and week.')
+    parser.add_argument('--subjects', type=int, nargs='+', default=list(range(1,200)),
+                        help='subject numbers to merge (default: 1-199)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default: 1, 0 uses all cores)')
+    parser.add_argument('--format', dest='out_format', default=out_format,
+                        choices=['parquet', 'feather', 'csv'], help='output format of the merged files')
+    parser.add_argument('--root', default=data_root, help='folder with the subject data')
+    parser.add_argument('--store', action='store_true', default=build_store,
+                        help='also write the memory-mapped signal store (store/ next to merge/)')
+    parser.add_argument('--stream', action='store_true', default=stream,
+                        help='read and write the sessions in chunks instead of whole files')
+    parser.add_argument('--chunk-rows', type=int, default=chunk_rows,
+                        help='rows per chunk with --stream (default: ' + str(chunk_rows) + ')')
+    parser.add_argument('--force', action='store_true', default=force,
+                        help='merge all sessions again, also if they did not change since the last run')
+    parser.add_argument('--tiles', action='store_true', default=build_tiles,
+                        help='also build the multi-resolution tiles for E4_Plots.py (tiles/ next to merge/)')
+    args = parser.parse_args(argv)
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    tasks = find_tasks(args.subjects, args.root)
+    print('Merging ' + str(len(tasks)) + ' tasks with ' + str(workers) + ' worker(s)')
+    failed = run_tasks(tasks, workers, args.out_format, args.root, args.store, args.stream, args.chunk_rows, args.force, args.tiles)
+
+    #Report failures, and exit with error if any task failed
+    for task, error in failed:
+        sub_nr, session_type, data_type = task
+        print('\nsub ' + str(sub_nr).rjust(3, '0') + ' ' + session_type + ' ' + data_type + ' failed:\n' + error)
+    print(str(len(tasks) - len(failed)) + ' of ' + str(len(tasks)) + ' tasks merged, ' + str(len(failed)) + ' failed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EDA processing on numpy arrays, the native replacement of the pyphysio chain
+in E4_Features.py (EvenlySignal -> RemoveSpikes -> DenoiseEDA -> IIRFilter ->
+DriverEstim -> PhasicEstim, and the time domain and peak indicators).
+
+    - Works on one window (1D) or a batch of equal length windows (2D, one
+        window per row). Despiking, denoising, the low-pass filter and the
+        driver estimation run on the whole batch at once, the phasic/tonic
+        split and the peaks per row.
+    - The elliptic low-pass is designed once per (fp, fs) as second order
+        sections and applied forward and backward (scipy.signal.sosfiltfilt).
+    - The driver is the inverse of the Bateman response (t1 = 0.75 s,
+        t2 = 2 s), which is a 3 sample difference filter, scaled so a
+        constant signal gives the same constant driver, and smoothed with a
+        Gaussian of 1 s.
+    - Windows that cannot be processed (missing values, too short for the
+        filter, failed phasic estimation) are returned as error records
+        {'index', 'stage', 'error'} with NaN components, instead of stopping
+        the batch.
+
+The steps follow the pyphysio methods, but the values are not identical to
+pyphysio (the driver scaling, peak detection by prominence and the tonic
+grid differ in detail).
+
+"""
+
+#Import Libraries
+import functools
+import numpy as np
+from scipy import signal, ndimage
+
+#Sampling frequency of the E4 EDA (Hz)
+samp_freq = 4
+#Parameters of the chain (as the pyphysio defaults used in E4_Features.py)
+spike_k = 2
+denoise_win = 2
+filter_loss = 0.1
+filter_att = 40
+bateman_t1 = 0.75
+bateman_t2 = 2
+tonic_grid = 1
+#Gaussian smoothing of the driver (standard deviation, seconds)
+driver_smooth = 1
+phasic_win_pre = 2
+phasic_win_post = 2
+
+COMPONENTS = ('driver', 'phasic', 'tonic')
+
+
+@functools.lru_cache(maxsize=None)
+def lowpass_sos(fp, fs, fsamp=samp_freq, loss=filter_loss, att=filter_att):
+    """Second order sections of the elliptic low-pass (pass band edge fp, stop band edge fs, in Hz)"""
+    return signal.iirdesign(fp, fs, loss, att, ftype='ellip', output='sos', fs=fsamp)
+
+
+def min_length(fp, fs, fsamp=samp_freq):
+    """Shortest window the low-pass can filter forward and backward"""
+    sos = lowpass_sos(fp, fs, fsamp)
+    #Default padding of sosfiltfilt
+    return 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())) + 1
+
+
+def remove_spikes(x, k=spike_k):
+    """
+    Replace single sample spikes (a jump of more than k times the mean
+    absolute sample difference, up and back down) by the mean of their
+    neighbours. x is 1D or 2D (windows in rows).
+    """
+    x = np.array(x, dtype=np.float64, ndmin=2)
+    if x.shape[1] < 3:
+        return x
+    d = np.diff(x, axis=1)
+    thr = k * np.mean(np.abs(d), axis=1, keepdims=True)
+    rise = d[:, :-1]
+    fall = d[:, 1:]
+    spikes = ((rise > thr) & (fall < -thr)) | ((rise < -thr) & (fall > thr))
+    mid = x[:, 1:-1]
+    mid[spikes] = ((x[:, :-2] + x[:, 2:]) / 2)[spikes]
+    return x
+
+
+def denoise(x, threshold=0.02, win_len=denoise_win, fsamp=samp_freq):
+    """
+    Remove noisy parts (as pyphysio DenoiseEDA): the absolute sample
+    difference smoothed with a triangular window of win_len seconds marks
+    samples above threshold as noise, which are interpolated linearly from
+    the other samples.
+    """
+    x = np.array(x, dtype=np.float64, ndmin=2)
+    n = x.shape[1]
+    if n < 2:
+        return x
+    d = np.abs(np.diff(x, axis=1))
+    d = np.concatenate([d, d[:, -1:]], axis=1)
+    tri = np.bartlett(max(int(win_len * fsamp), 3) + 2)[1:-1]
+    noise = ndimage.convolve1d(d, tri / tri.sum(), axis=1, mode='nearest')
+    noisy = noise > threshold
+    #Keep the first and last sample for the interpolation
+    noisy[:, 0] = False
+    noisy[:, -1] = False
+    idx = np.arange(n)
+    for row in np.nonzero(noisy.any(axis=1))[0]:
+        ok = ~noisy[row]
+        x[row] = np.interp(idx, idx[ok], x[row, ok])
+    return x
+
+
+def lowpass(x, fp, fs, fsamp=samp_freq):
+    """Elliptic low-pass, forward and backward, along the rows"""
+    return signal.sosfiltfilt(lowpass_sos(fp, fs, fsamp), x, axis=-1)
+
+
+def driver_estim(x, t1=bateman_t1, t2=bateman_t2, smooth=driver_smooth, fsamp=samp_freq):
+    """
+    Driver of the EDA: deconvolution with the Bateman function
+    exp(-t/t2) - exp(-t/t1). Its inverse is the difference filter
+    s[n+1] - (r1+r2) s[n] + r1 r2 s[n-1], with r = exp(-1/(t fsamp)). The
+    signal is extended with its first and last value at the edges. The
+    deconvolution amplifies noise, so the driver is smoothed with a Gaussian
+    of smooth seconds.
+    """
+    x = np.array(x, dtype=np.float64, ndmin=2)
+    r1 = np.exp(-1 / (t1 * fsamp))
+    r2 = np.exp(-1 / (t2 * fsamp))
+    #Unit gain at 0 Hz: (r2 - r1) / ((1 - r1) (1 - r2)) is the sum of the Bateman response
+    scale = 1 / ((1 - r1) * (1 - r2))
+    padded = np.concatenate([x[:, :1], x, x[:, -1:]], axis=1)
+    driver = scale * (padded[:, 2:] - (r1 + r2) * padded[:, 1:-1] + r1 * r2 * padded[:, :-2])
+    if smooth:
+        driver = ndimage.gaussian_filter1d(driver, smooth * fsamp, axis=1, mode='nearest')
+    return driver
+
+
+def peak_bounds(x, peaks, win_pre, win_post, fsamp=samp_freq):
+    """Start and end of each peak: the minimum within win_pre seconds before and win_post after it"""
+    pre = max(int(win_pre * fsamp), 1)
+    post = max(int(win_post * fsamp), 1)
+    n = len(x)
+    before = np.clip(peaks[:, None] + np.arange(-pre, 1), 0, n - 1)
+    after = np.clip(peaks[:, None] + np.arange(0, post + 1), 0, n - 1)
+    starts = before[np.arange(len(peaks)), np.argmin(x[before], axis=1)]
+    ends = after[np.arange(len(peaks)), np.argmin(x[after], axis=1)]
+    return starts, ends
+
+
+def find_peaks(x, delta):
+    """Peaks that rise at least delta above their surroundings (prominence)"""
+    peaks, _ = signal.find_peaks(x, prominence=delta)
+    return peaks
+
+
+def phasic_estim(driver, delta=0.02, grid_size=tonic_grid, win_pre=phasic_win_pre, win_post=phasic_win_post,
+                 fsamp=samp_freq):
+    """
+    Split one driver signal (1D) into tonic and phasic parts (as pyphysio
+    PhasicEstim): samples within the peaks of the driver are left out, the
+    tonic is the mean of the other samples in grid_size second bins,
+    interpolated linearly, and the phasic part is the driver minus the tonic.
+    """
+    n = len(driver)
+    in_peak = np.zeros(n, dtype=bool)
+    peaks = find_peaks(driver, delta)
+    if len(peaks):
+        starts, ends = peak_bounds(driver, peaks, win_pre, win_post, fsamp)
+        #Mark the samples from each start to its end
+        marks = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(marks, starts, 1)
+        np.add.at(marks, ends + 1, -1)
+        in_peak = np.cumsum(marks[:-1]) > 0
+    step = max(int(grid_size * fsamp), 1)
+    edges = np.arange(0, n, step)
+    counts = np.add.reduceat((~in_peak).astype(np.float64), edges)
+    sums = np.add.reduceat(np.where(in_peak, 0.0, driver), edges)
+    full = counts > 0
+    if not full.any():
+        tonic = np.full(n, np.min(driver))
+    else:
+        centres = np.minimum(edges + (step - 1) / 2, n - 1)
+        tonic = np.interp(np.arange(n), centres[full], sums[full] / counts[full])
+    return driver - tonic, tonic
+
+
+def decompose(values, fp=0.8, fs=1.1, threshold=0.02, delta=0.02, fsamp=samp_freq):
+    """
+    Driver, phasic and tonic signal of EDA windows: values is one window
+    (1D) or a batch of equal length windows (2D, one per row). Returns a dict
+    of 2D arrays (one row per window) and a list of error records for the
+    windows that failed (their rows are NaN).
+    """
+    x = np.array(values, dtype=np.float64, ndmin=2)
+    n_windows, n = x.shape
+    components = {name: np.full((n_windows, n), np.nan) for name in COMPONENTS}
+    errors = []
+
+    #Windows the filter chain can process
+    ok = np.ones(n_windows, dtype=bool)
+    bad_values = ~np.isfinite(x).all(axis=1)
+    for row in np.nonzero(bad_values)[0]:
+        errors.append({'index': int(row), 'stage': 'input', 'error': 'missing or infinite values'})
+    ok &= ~bad_values
+    if n < min_length(fp, fs, fsamp):
+        for row in np.nonzero(ok)[0]:
+            errors.append({'index': int(row), 'stage': 'lowpass',
+                           'error': 'window of ' + str(n) + ' samples is too short for the filter'})
+        ok[:] = False
+    rows = np.nonzero(ok)[0]
+    if len(rows) == 0:
+        return components, errors
+
+    #Cleaning and driver for the batch
+    clean = lowpass(denoise(remove_spikes(x[rows]), threshold, fsamp=fsamp), fp, fs, fsamp)
+    driver = driver_estim(clean, fsamp=fsamp)
+
+    #Phasic and tonic per window
+    for i, row in enumerate(rows):
+        try:
+            phasic, tonic = phasic_estim(driver[i], delta, fsamp=fsamp)
+        except Exception as error:
+            errors.append({'index': int(row), 'stage': 'phasic', 'error': repr(error)})
+            continue
+        components['driver'][row] = driver[i]
+        components['phasic'][row] = phasic
+        components['tonic'][row] = tonic
+    errors.sort(key=lambda error: error['index'])
+    return components, errors
+
+
+def indicators(phasic, tonic, delta=0.02, win_pre=1, win_post=1, fsamp=samp_freq):
+    """
+    Time domain and peak indicators of one window (as the pyphysio Mean,
+    StDev, Range, AUC, PeaksNum, PeaksMean and DurationMean), as a dict.
+    Peak magnitude is the rise from the peak start, duration the time from
+    start to end (seconds); both are NaN if there are no peaks.
+    """
+    phasic = np.asarray(phasic, dtype=np.float64)
+    tonic = np.asarray(tonic, dtype=np.float64)
+    feats = {'tonic_mean': np.mean(tonic), 'tonic_std': np.std(tonic), 'tonic_range': np.ptp(tonic),
+             'phasic_mean': np.mean(phasic), 'phasic_std': np.std(phasic), 'phasic_range': np.ptp(phasic),
+             'phasic_auc': np.sum(phasic) / fsamp}
+    peaks = find_peaks(phasic, delta)
+    feats['phasic_num'] = len(peaks)
+    if len(peaks):
+        starts, ends = peak_bounds(phasic, peaks, win_pre, win_post, fsamp)
+        feats['phasic_mag'] = np.mean(phasic[peaks] - phasic[starts])
+        feats['phasic_dur'] = np.mean(ends - starts) / fsamp
+    else:
+        feats['phasic_mag'] = np.nan
+        feats['phasic_dur'] = np.nan
+    return feats
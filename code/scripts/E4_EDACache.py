@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the EDA decomposition (driver, phasic and tonic signals)
+of E4_Features.py, so a rerun of the features does not repeat the
+deconvolution of windows it has seen before.
+
+    - Entries are content addressed: the key is a SHA-256 hash of the
+        subject, session, time range of the samples, the parameters of the
+        processing chain and the EDA values themselves. Changed data or
+        parameters give a new key, so old entries are never used by mistake.
+    - Each entry is one .npz file in a subfolder named after the first two
+        characters of the key. Files are written to a temporary name and
+        renamed, so parallel workers and crashed runs never leave half
+        written entries.
+    - The cache is limited in size (max_bytes). When it is full, the least
+        recently used entries (by file modification time, updated on every
+        hit) are removed.
+    - Windows are only reused when they are the same: the sleep SCR storm
+        window is a prefix of the sleep window but uses another low-pass
+        filter, and filtering forward and backward depends on the whole
+        window, so it has its own entries.
+
+"""
+
+#Import Libraries
+import os, json, hashlib, tempfile
+import numpy as np
+
+
+class EDACache:
+    """
+    Cache of EDA components in cache_dir, limited to max_bytes on disk. The
+    object only holds the folder and size limit, so it can be passed to
+    worker processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=5 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        #Size of the cache on disk, counted on the first write
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, values, params, sub_ID='', session='', start_time=None, end_time=None):
+        """Key of an EDA window: hash of its subject, session, time range, parameters and values"""
+        meta = {'sub_ID': str(sub_ID), 'session': str(session),
+                'start_time': str(start_time), 'end_time': str(end_time), 'params': params}
+        digest = hashlib.sha256(json.dumps(meta, sort_keys=True, default=str).encode())
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        """File of an entry"""
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def get(self, key):
+        """Components of an entry as a dict of arrays, or None if it is not in the cache"""
+        fullin = self.path(key)
+        try:
+            with np.load(fullin) as entry:
+                components = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, EOFError):
+            self.misses += 1
+            return None
+        #Mark as recently used
+        try:
+            os.utime(fullin)
+        except OSError:
+            pass
+        self.hits += 1
+        return components
+
+    def put(self, key, components):
+        """Store the components (dict of arrays) of an entry, and evict old entries if the cache is full"""
+        fullout = self.path(key)
+        os.makedirs(os.path.dirname(fullout), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fullout), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **components)
+            os.replace(tmp_path, fullout)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        #Other processes also write to the cache, so the folder is only
+        #scanned again when the count says it is full
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(fullout)
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """(modification time, size, path) of all entries"""
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npz'):
+                    fullin = os.path.join(root, name)
+                    try:
+                        stat = os.stat(fullin)
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, stat.st_size, fullin))
+        return found
+
+    def size(self):
+        """Total size of the entries on disk"""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below max_bytes"""
+        if self.max_bytes is None:
+            return
+        found = self.entries()
+        total = sum(size for _, size, _ in found)
+        for _, size, fullin in sorted(found):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fullin)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def cached(self, compute, values, params, **key_fields):
+        """
+        Components of an EDA window from the cache, or from compute(values)
+        (which returns a dict of arrays) stored in the cache.
+        """
+        key = self.key(values, params, **key_fields)
+        components = self.get(key)
+        if components is None:
+            components = compute(values)
+            self.put(key, components)
+        return components
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares the skin conductance features of two ways of processing the EDA in
+E4_Features.py:
+
+    - modes: every window decomposed on its own ('window', the original
+        method) and components sliced from whole recordings ('session').
+    - backends: the original pyphysio chain ('pyphysio') and the native
+        numpy/scipy chain of E4_EDA.py ('native'), on a random sample of
+        windows per subject (--sample), as pyphysio is slow.
+
+For each subject the SC features of the wake and sleep windows are
+calculated both ways, and per feature the report gives the number of
+windows with a value in each, the Pearson correlation, the mean and median
+absolute difference, the mean of both, and whether the difference is within
+tolerance: a mean absolute difference of at most max_rel_diff of the mean
+absolute reference value (window mode, pyphysio) plus atol, and a
+correlation of at least min_r (see tolerance_check). Comparing the backends
+exits with an error if a feature is not within tolerance. The report is
+saved as a CSV file, and the values per window can be saved with
+--windows-out.
+
+Usage:  python E4_EDACompare.py [--compare modes|backends] [--subjects sub_001 sub_002] [--sample 20]
+                                [--out EDA_mode_comparison.csv]
+
+"""
+
+#Import Libraries
+import os, sys, argparse
+import numpy as np
+import pandas as pd
+import E4_Features as E4F
+
+#The two ways of processing of each comparison (reference first), as eda_window_features options
+COMPARISONS = {'modes': {'window': {'eda_mode': 'window'}, 'session': {'eda_mode': 'session'}},
+               'backends': {'pyphysio': {'eda_mode': 'window', 'eda_backend': 'pyphysio'},
+                            'native': {'eda_mode': 'window', 'eda_backend': 'native'}}}
+#Tolerance: mean absolute difference relative to the mean absolute reference value (plus atol), and correlation
+max_rel_diff = 0.05
+atol = 1e-6
+min_r = 0.95
+#Windows per subject (wake and sleep each) in the backend comparison
+sample_windows = 20
+
+
+def subject_comparison(sub_ID, wake_windows, sleep_windows, root=None, eda_cache=None, variants=COMPARISONS['modes']):
+    """SC features of one subject for each variant (options of eda_window_features), as one data frame per variant"""
+    #EDA read whole when a variant decomposes whole recordings
+    session = any(options.get('eda_mode') == 'session' for options in variants.values())
+    data = E4F.load_windows_data(sub_ID, wake_windows, sleep_windows, root, 'session' if session else 'window')
+    results = {}
+    for name, options in variants.items():
+        parts = []
+        for sleep, (window_start, window_end) in [(False, wake_windows), (True, sleep_windows)]:
+            if len(window_start) == 0 or data['EDA'].df.size < 10:
+                continue
+            sc = E4F.eda_window_features(sub_ID, data, window_start, window_end, sleep, eda_cache, **options)
+            sc.insert(0, 'sleep', sleep)
+            sc.insert(0, 'castor_record_id', sub_ID)
+            parts.append(sc)
+        results[name] = pd.concat(parts) if parts else pd.DataFrame()
+    return results
+
+
+def sample_rows(windows, n, seed=0):
+    """Random sample of n windows (window_start, window_end), all if there are fewer"""
+    window_start, window_end = windows
+    if len(window_start) <= n:
+        return windows
+    rows = np.sort(np.random.default_rng(seed).choice(len(window_start), n, replace=False))
+    return window_start.iloc[rows], window_end.iloc[rows]
+
+
+def comparison_report(ref_df, other_df, names=('window', 'session')):
+    """Agreement of the SC features of two variants (names, reference first), one row per feature"""
+    a_name, b_name = names
+    rows = []
+    for col in [c for c in ref_df.columns if c.startswith('sc_')]:
+        a = ref_df[col].to_numpy(dtype=float)
+        b = other_df[col].to_numpy(dtype=float)
+        both = ~np.isnan(a) & ~np.isnan(b)
+        diff = np.abs(a[both] - b[both])
+        r = np.corrcoef(a[both], b[both])[0, 1] if both.sum() > 2 and np.std(a[both]) > 0 and np.std(b[both]) > 0 else np.nan
+        rows.append({'feature': col, 'n_' + a_name: int((~np.isnan(a)).sum()), 'n_' + b_name: int((~np.isnan(b)).sum()),
+                     'n_both': int(both.sum()), 'pearson_r': r,
+                     'mean_abs_diff': diff.mean() if len(diff) else np.nan,
+                     'median_abs_diff': np.median(diff) if len(diff) else np.nan,
+                     'mean_' + a_name: np.nanmean(a) if (~np.isnan(a)).any() else np.nan,
+                     'mean_' + b_name: np.nanmean(b) if (~np.isnan(b)).any() else np.nan,
+                     'mean_abs_' + a_name: np.abs(a[both]).mean() if both.any() else np.nan})
+    return tolerance_check(pd.DataFrame(rows), a_name)
+
+
+def tolerance_check(report, ref_name, max_rel_diff=max_rel_diff, min_r=min_r, atol=atol):
+    """
+    Add the relative difference (mean absolute difference over the mean
+    absolute reference value) and whether each feature is within tolerance:
+    a mean absolute difference of at most atol + max_rel_diff times the mean
+    absolute reference value (as numpy.isclose, so features that are about
+    zero in both pass), and a correlation of at least min_r unless the
+    difference is below atol or there is no correlation (constant values).
+    Features without windows in both are within tolerance.
+    """
+    ref = report['mean_abs_' + ref_name]
+    report['rel_diff'] = report['mean_abs_diff'] / ref.where(ref > 0, np.nan)
+    close = report['mean_abs_diff'] <= atol + max_rel_diff * ref
+    correlated = report['pearson_r'].isna() | (report['pearson_r'] >= min_r) | (report['mean_abs_diff'] <= atol)
+    report['within_tolerance'] = (report['n_both'] == 0) | (close & correlated)
+    return report.drop(columns='mean_abs_' + ref_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the EDA modes or backends of the SC features.')
+    parser.add_argument('--compare', default='modes', choices=list(COMPARISONS),
+                        help='window and session mode (default), or pyphysio and native backend')
+    parser.add_argument('--subjects', nargs='+', default=None, help='subject IDs to compare (e.g. sub_001)')
+    parser.add_argument('--sample', type=int, default=None,
+                        help='random windows per subject, wake and sleep each (default: all for modes, '
+                             + str(sample_windows) + ' for backends)')
+    parser.add_argument('--ema-dir', default=E4F.ema_dir, help='folder with the cleaned EMA files')
+    parser.add_argument('--root', default=E4F.data_root, help='folder with the subject data')
+    parser.add_argument('--out', default=None,
+                        help='report file (default: EDA_mode_comparison.csv or EDA_backend_comparison.csv in the EMA folder)')
+    parser.add_argument('--windows-out', default=None, help='also save the features per window and variant')
+    parser.add_argument('--no-eda-cache', dest='use_eda_cache', action='store_false', default=True,
+                        help='do not use the EDA component cache')
+    args = parser.parse_args(argv)
+    if args.compare == 'backends' and E4F.ph is None:
+        parser.error('--compare backends needs the pyphysio package')
+    eda_cache = E4F.EDACache(os.path.join(args.ema_dir, 'eda_cache'), E4F.eda_cache_gb * 1024**3) if args.use_eda_cache else None
+    variants = COMPARISONS[args.compare]
+    names = list(variants)
+    n_sample = args.sample if args.sample is not None else (sample_windows if args.compare == 'backends' else None)
+
+    #Windows of the wake and sleep EMA rows
+    Wake_df = E4F.prepare_ema(E4F.read_ema(args.ema_dir, "EMA_Clean"), sleep=False)
+    Sleep_df = E4F.prepare_ema(E4F.read_ema(args.ema_dir, "Sleep_Clean"), sleep=True)
+    subjects = args.subjects
+    if subjects is None:
+        subjects = sorted(pd.unique(pd.concat([Wake_df['castor_record_id'], Sleep_df['castor_record_id']]).dropna()))
+
+    results = {name: [] for name in names}
+    for sub_ID in subjects:
+        windows = []
+        for EMA_df, sleep in [(Wake_df, False), (Sleep_df, True)]:
+            sub_rows = EMA_df[EMA_df['castor_record_id'] == sub_ID]
+            windows.append(E4F.feature_windows(sub_rows, sleep=sleep))
+            if n_sample is not None:
+                windows[-1] = sample_rows(windows[-1], n_sample)
+        print('Comparing EDA ' + args.compare + ' for ' + sub_ID, flush=True)
+        for name, df in subject_comparison(sub_ID, windows[0], windows[1], args.root, eda_cache, variants).items():
+            results[name].append(df)
+
+    ref_df = pd.concat(results[names[0]])
+    other_df = pd.concat(results[names[1]])
+    report = comparison_report(ref_df, other_df, names)
+    out = args.out or os.path.join(args.ema_dir, 'EDA_' + args.compare[:-1] + '_comparison.csv')
+    report.to_csv(out, index=None)
+    print(report.to_string(index=False))
+    if args.windows_out:
+        #Rows are in the same order for both (wake and sleep row numbers overlap)
+        both = pd.concat([ref_df.reset_index(drop=True),
+                          other_df.filter(like='sc_').add_suffix('_' + names[1]).reset_index(drop=True)], axis=1)
+        both.to_csv(args.windows_out, index=None)
+    outside = report.loc[~report['within_tolerance'], 'feature'].tolist()
+    if outside:
+        print('Not within tolerance: ' + ', '.join(outside))
+    return 1 if outside and args.compare == 'backends' else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
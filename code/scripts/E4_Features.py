@@ -4,306 +4,876 @@
 This script extracts features from the E4 data during wake and sleep periods, 
 calcualtes different components of heart rate, and skin conductance within a 
 time window specified by self reported measures.  This code will go through 
-the cleaned EMA file (as a dataframe) line by line to extract the features 
-for a given subject and EMA sample.
+the cleaned EMA file (as a dataframe) subject by subject to extract the features 
+for each EMA sample. HR, IBI, temperature and ACC statistics are calculated for 
+all windows of a subject at once (see E4_Windows.batch_window_features), the 
+frequency domain HR features (LF/HF power, see E4_HRV) as well, and the 
+skin conductance features window by window.
+
+Each subject is a separate task: its E4 data is loaded once, and both the wake 
+and sleep features are calculated from it. Tasks run on a pool of worker 
+processes (--workers), and return their features to the main process, which 
+saves them in the checkpoint files (see E4_Checkpoint). The number of subjects 
+loaded at the same time is limited by an estimate of their size in memory 
+(--memory-gb). The EDA decomposition of each window is kept in an on-disk 
+cache (see E4_EDACache), so reruns skip the windows they processed before.
+
+Usage:  python E4_Features.py [--workers 8] [--memory-gb 32] [--subjects sub_001 sub_002] [--profile 2]
 
 Authors:    Rayyan Toutounji
 Date:       15-JUN-20
 """
 
 # Import Libraries
-import os
+import os, sys, time, argparse, traceback
 import numpy as np
 import pandas as pd
 import datetime as dt
-from scipy import signal
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait, as_completed
+from E4_IO import LazySubject, time_ranges, merged_rows, merged_name, MERGE_FORMATS
+from E4_Windows import batch_window_features, window_bounds_batch, sliding_windows
+from E4_HRV import batch_lf_hf, HRV_MODES
+from E4_Checkpoint import FeatureCheckpoint
+from E4_EDACache import EDACache
+from E4_Timing import StageTimer, timed, profiled, write_report, format_totals
+from E4_Schema import row_bytes
+import E4_EDA
 from datetime import datetime, timedelta
-# Import pyphysio for physio analysis
-import pyphysio as ph
-import pyphysio.filters.Filters as flt # Import filters
-import pyphysio.estimators.Estimators as est # Import Estimators
-import pyphysio.indicators.TimeDomain as td_ind # Import time domain
-import pyphysio.indicators.FrequencyDomain as fd_ind # Import frequency domain estimators
-import pyphysio.indicators.PeaksDescription as pk_ind # Import peak domain estimators
+# Import pyphysio for physio analysis (the default EDA backend if installed)
+try:
+    import pyphysio as ph
+    import pyphysio.filters.Filters as flt # Import filters
+    import pyphysio.estimators.Estimators as est # Import Estimators
+    import pyphysio.indicators.TimeDomain as td_ind # Import time domain
+    import pyphysio.indicators.FrequencyDomain as fd_ind # Import frequency domain estimators
+    import pyphysio.indicators.PeaksDescription as pk_ind # Import peak domain estimators
+except ImportError:
+    ph = None
 #Turnoff write warning in Pandas
 pd.options.mode.chained_assignment = None  
 
-#Import EMA data (cleaned beforehand)
-filepath = ("/project/3013068.02/stats/EMA/")
-os.chdir (str(filepath))
-Wake_df = pd.read_csv("EMA_Clean.csv")
-Sleep_df = pd.read_csv("Sleep_Clean.csv")
-EMA_dfs = [Wake_df, Sleep_df]
+#Checkpoints: finished rows are saved every checkpoint_every subjects, and a
+#restarted run skips them (set resume to False to start over)
+checkpoint_every = 5
+resume = True
+
+#Folders with the cleaned EMA data and the merged E4 data
+ema_dir = "/project/3013068.02/stats/EMA/"
+data_root = "/project/3013068.02/data/"
+
+#Feature columns
+feats=['hr_mean','ibi_sd', 'ibi_mean', 'ibi_min', 'ibi_max', 
+       'hr_rmssd', 'hr_sd','hr_min', 'hr_max', 'hr_hf', 'hr_lf', 'hr_lfhf',
+       'sc_tonic_mean','sc_tonic_std','sc_tonic_range',
+       'sc_phasic_mean', 'sc_phasic_std','sc_phasic_range',
+       'sc_phasic_mag', 'sc_phasic_dur', 'sc_phasic_num','sc_phasic_auc',
+       'temp_mean', 'temp_median', 'temp_sd', 'temp_slope',
+       'acc_x', 'acc_y','acc_z', 'acc_delta', 'acc_x_sd', 'acc_y_sd','acc_z_sd', 'acc_delta_sd',
+       'ibi_based_quality']
+#Extra features for SCR storms during sleep
+sleep_feat=['sc_storm_tonic_mean', 'sc_storm_phasic_mean', 'sc_storm_phasic_mag',
+            'sc_storm_phasic_dur', 'sc_storm_phasic_num', 'sc_storm_phasic_auc']
+#Features calculated for all windows of a subject at once (E4_Windows), and per window
+batch_feats=['hr_mean','ibi_sd', 'ibi_mean', 'ibi_min', 'ibi_max', 'hr_rmssd', 'hr_sd','hr_min', 'hr_max',
+             'temp_mean', 'temp_median', 'temp_sd', 'temp_slope',
+             'acc_x', 'acc_y','acc_z', 'acc_delta', 'acc_x_sd', 'acc_y_sd','acc_z_sd', 'acc_delta_sd',
+             'ibi_based_quality']
+#Frequency domain HR features (E4_HRV), also for all windows at once
+hrv_feats=['hr_lf', 'hr_hf', 'hr_lfhf']
+#Method of the LF/HF power: 'fft' (as before), 'welch' or 'lombscargle'
+hrv_mode = 'fft'
+#Parameters of the EDA processing chain (the low-pass fp differs for the SCR storms),
+#and size limit of the on-disk cache of its results (see E4_EDACache)
+eda_params = {'denoise_threshold': 0.02, 'fs': 1.1, 'ftype': 'ellip', 'delta': 0.02, 'samp_freq': 4}
+eda_cache_gb = 5
+#EDA decomposition per window ('window', as before) or once per recording ('session')
+eda_mode = 'window'
+EDA_MODES = ('window', 'session')
+#EDA processing: 'pyphysio' (the original chain, and values) when it is
+#installed, otherwise 'native' (E4_EDA, numpy/scipy, see E4_EDACompare.py for
+#how far its values are from pyphysio)
+eda_backend = 'pyphysio' if ph is not None else 'native'
+EDA_BACKENDS = ('native', 'pyphysio')
+#E4 data types used for the features (BVP is not used, and never loaded)
+data_types = ['IBI', 'HR', 'EDA', 'TEMP', 'ACC']
+#Read EDA, TEMP, HR and ACC from the memory-mapped signal store (E4_Cleaner.py --store) where it holds the merged samples
+use_store = False
+#Sliding window mode (--sliding): windows of window_minutes every stride_minutes over each week
+window_minutes = 10
+stride_minutes = 1
+
+
+def read_ema(ema_dir, name):
+    """
+    Cleaned EMA table from EMA_Cleaner.py ('EMA_Clean' or 'Sleep_Clean'): the
+    typed Parquet file if it is at least as new as the CSV, otherwise the CSV.
+    """
+    csv_file = os.path.join(ema_dir, name + '.csv')
+    parquet_file = os.path.join(ema_dir, name + '.parquet')
+    if os.path.isfile(parquet_file) and (not os.path.isfile(csv_file) or
+                                         os.path.getmtime(parquet_file) >= os.path.getmtime(csv_file)):
+        return pd.read_parquet(parquet_file)
+    return pd.read_csv(csv_file)
 
-#Extract Features from Both
-for x, EMA_df in enumerate(EMA_dfs):
+
+def feature_files(ema_dir):
+    """Feature files of the wake and sleep EMA data"""
+    return [os.path.join(ema_dir, "EMA_Clean_Features_10min.csv"),
+            os.path.join(ema_dir, "Sleep_Clean_Features_10min.csv")]
+
+
+def prepare_ema(EMA_df, sleep=False):
+    """Sort the EMA data by subject, convert the times, and add empty feature columns"""
     EMA_df=EMA_df.sort_values('castor_record_id')  # Sort by subject ID
-    #EMA_df=EMA_df[EMA_df.castor_record_id == 'sub_026'] #This line is for testing
     #Reformat datetimes for survey completion
     EMA_df['survey_completed_on']=pd.to_datetime(EMA_df['survey_completed_on'], format='%Y-%m-%d %H:%M:%S')
     
     #Reformat dates for sleep data + add extra coloumns for SCR storms
-    if x==1: 
+    if sleep: 
         EMA_df['sleep_down_dt']=pd.to_datetime(EMA_df['sleep_down_dt'], format='%Y-%m-%d %H:%M:%S')
         EMA_df['sleep_up_dt']=pd.to_datetime(EMA_df['sleep_up_dt'], format='%Y-%m-%d %H:%M:%S')
-        sleep_feat=['sc_storm_tonic_mean', 'sc_storm_phasic_mean', 'sc_storm_phasic_mag',
-                    'sc_storm_phasic_dur', 'sc_storm_phasic_num', 'sc_storm_phasic_auc']
         for i in sleep_feat:
             EMA_df[i]=np.nan
             
     #Initialize empty columns for features
-    feats=['hr_mean','ibi_sd', 'ibi_mean', 'ibi_min', 'ibi_max', 
-           'hr_rmssd', 'hr_sd','hr_min', 'hr_max', 'hr_hf', 'hr_lf', 'hr_lfhf',
-           'sc_tonic_mean','sc_tonic_std','sc_tonic_range',
-           'sc_phasic_mean', 'sc_phasic_std','sc_phasic_range',
-           'sc_phasic_mag', 'sc_phasic_dur', 'sc_phasic_num','sc_phasic_auc',
-           'temp_mean', 'temp_median', 'temp_sd', 'temp_slope',
-           'acc_x', 'acc_y','acc_z', 'acc_delta', 'acc_x_sd', 'acc_y_sd','acc_z_sd', 'acc_delta_sd',
-           'ibi_based_quality']
     for i in feats:
         EMA_df[i]=np.nan
+    return EMA_df
+
+
+def feature_columns(sleep=False):
+    """All feature columns of the wake or sleep data"""
+    return (sleep_feat if sleep else []) + feats
+
+
+def feature_windows(EMA_df, sleep=False):
+    """Start and end time of the feature window of each EMA row"""
+    if not sleep:#For wake
+        window_start=EMA_df['survey_completed_on'] - pd.Timedelta(minutes=13)
+        window_end=EMA_df['survey_completed_on'] - pd.Timedelta(minutes=3)
+    else:#For sleep
+        window_start=EMA_df['sleep_down_dt']
+        window_end=EMA_df['sleep_up_dt']
+    return window_start, window_end
+
+
+def subject_ids(root=None):
+    """Subject IDs (sub_001) of the subject folders in root"""
+    root = data_root if root is None else root
+    prefix = "3013068.02_BaLS_sub_"
+    if not os.path.isdir(root):
+        return []
+    return sorted('sub_' + name[len(prefix):] for name in os.listdir(root)
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def subject_merge_dirs(sub_ID, root=None):
+    """Merge directories of the two sessions of a subject that exist and have files"""
+    root = data_root if root is None else root
+    #Two session in data
+    sessions = ['control', 'stress']
+    merge_dirs = []
+    for session_type in sessions:
+        #Set the file path and check if it exists to avoid errors. If it doesnt make empty DFs instead
+        filepath1 = os.path.join(root, "3013068.02_BaLS_" + sub_ID, "logs", "e4", session_type, "merge")
+        if os.path.isdir(filepath1)==True:                              
+            if len(os.listdir(filepath1) ) >= 1:
+                merge_dirs.append(filepath1)
+    return merge_dirs
+
+
+def estimate_subject_bytes(sub_ID, root=None):
+    """
+    Rough size in memory of the E4 data of a subject: the bytes per row of
+    the schema (E4_Schema.row_bytes) times the row counts of Parquet files,
+    the file size for other formats.
+    """
+    n_bytes = 0
+    for merge_dir in subject_merge_dirs(sub_ID, root):
+        for data_type in data_types:
+            n_rows = merged_rows(merge_dir, data_type)
+            if n_rows is not None:
+                n_bytes += n_rows * row_bytes(data_type)
+                continue
+            for out_format in MERGE_FORMATS:
+                fullin = os.path.join(merge_dir, merged_name(data_type, out_format))
+                if os.path.isfile(fullin):
+                    n_bytes += os.path.getsize(fullin)
+                    break
+    return n_bytes
+
+
+def load_subject(sub_ID, root=None, ranges=None, timer=None, whole_types=(), store=use_store):
+    """
+    E4 data of both sessions of a subject. Each data type is loaded when it is
+    first used, joined and sorted by time, with sorted time stamps for
+    windowing by binary search. ranges limits the data read to these
+    (start, end) times, except for the data types in whole_types. With
+    store, EDA, TEMP, HR and ACC are read from the signal store where it can
+    be used. Loading is timed as the 'load' stage of timer.
+    """
+    return LazySubject(subject_merge_dirs(sub_ID, root), ranges, timer, whole_types, store)
+
 
+def load_windows_data(sub_ID, wake_windows, sleep_windows, root=None, eda_mode=eda_mode, timer=None, store=use_store):
+    """
+    E4 data of a subject for its wake and sleep windows: only the data in
+    the (joined) windows is read, but EDA is read whole in session mode, as
+    SessionEDA needs the whole recordings.
+    """
+    ranges = time_ranges(pd.concat([wake_windows[0], sleep_windows[0]]),
+                         pd.concat([wake_windows[1], sleep_windows[1]]))
+    return load_subject(sub_ID, root, ranges, timer, ['EDA'] if eda_mode == 'session' else [], store)
+
+
+def decompose_eda_pyphysio(values, fp=0.8):
+    """
+    Driver, phasic and tonic signal of an EDA window at 4 Hz with the pyphysio 
+    chain (despike, denoise, elliptic low-pass at fp Hz, driver estimation, 
+    phasic/tonic separation), as a dict of arrays.
+    """
+    # Make eda signal into pyphysio
+    eda_data = ph.EvenlySignal(values=np.asarray(values, dtype=float), sampling_freq=4, signal_type ="eda", start_time=0)
+    # Data cleaning (despike, highpass, low pass threshold)
+    eda_despike= flt.RemoveSpikes()(eda_data)
+    eda_denoise= flt.DenoiseEDA(threshold=eda_params['denoise_threshold'])(eda_despike)
+    eda_clean= ph.IIRFilter(fp=fp, fs = eda_params['fs'], ftype=eda_params['ftype'])(eda_denoise)
+    # Estimate signal drivers, 
+    eda_driver = ph.DriverEstim()(eda_clean)
+    # Separate tonic and phasic components
+    eda_phasic, eda_tonic, _ = ph.PhasicEstim(delta=eda_params['delta'])(eda_driver)
+    return {'driver': np.asarray(eda_driver), 'phasic': np.asarray(eda_phasic), 'tonic': np.asarray(eda_tonic)}
+
+
+def decompose_eda(values, fp=0.8, backend=eda_backend):
+    """
+    Driver, phasic and tonic signal of EDA windows as a dict of arrays, with 
+    the native chain (E4_EDA, values 1D or 2D with one window per row) or 
+    pyphysio (one window). Raises EDAWindowError if a window fails.
+    """
+    if backend == 'pyphysio':
+        try:
+            return decompose_eda_pyphysio(values, fp)
+        except Exception as error:
+            raise EDAWindowError('pyphysio', repr(error))
+    components, errors = E4_EDA.decompose(values, fp=fp, fs=eda_params['fs'], threshold=eda_params['denoise_threshold'],
+                                          delta=eda_params['delta'])
+    if errors:
+        raise EDAWindowError(errors[0]['stage'], errors[0]['error'])
+    if np.ndim(values) == 1:
+        return {name: component[0] for name, component in components.items()}
+    return components
+
+
+class EDAWindowError(Exception):
+    """EDA processing of a window failed, at stage (e.g. 'lowpass', 'phasic', 'pyphysio')"""
+
+    def __init__(self, stage, error):
+        super().__init__(stage + ': ' + error)
+        self.stage = stage
+        self.error = error
+
+
+def eda_key_params(fp, backend):
+    """Parameters of the EDA chain, for the cache key"""
+    return dict(eda_params, fp=fp, backend=backend)
+
+
+def eda_components(eda_window, fp=0.8, cache=None, sub_ID='', session='', backend=eda_backend):
+    """
+    Driver, phasic and tonic signal of an EDA window (rows with Time and 
+    Data), as a dict of arrays. With an EDACache, the components are taken 
+    from the cache when this window was processed before with the same 
+    parameters.
+    """
+    values = eda_window['Data'].to_numpy(dtype=float)
+    if cache is None:
+        return decompose_eda(values, fp, backend)
+    times = eda_window['Time']
+    return cache.cached(lambda v: decompose_eda(v, fp, backend), values, eda_key_params(fp, backend), sub_ID=sub_ID,
+                        session=session, start_time=times.iloc[0], end_time=times.iloc[-1])
+
+
+def eda_components_batch(eda, firsts, stops, fp=0.8, cache=None, sub_ID='', backend=eda_backend):
+    """
+    Components of many windows (rows firsts to stops of the EDA SignalWindows).
+    Windows found in the cache are not processed again, the others are 
+    processed in batches of equal length with the native chain. Returns a 
+    list with the components (or None) of each window, and a list of error 
+    records {'index', 'stage', 'error'}.
+    """
+    results = [None] * len(firsts)
+    errors = []
+    todo = {}
+    values = eda.df['Data'].to_numpy(dtype=float)
+    keys = {}
+    for i, (a, b) in enumerate(zip(firsts, stops)):
+        if cache is not None:
+            keys[i] = cache.key(values[a:b], eda_key_params(fp, backend), sub_ID=sub_ID,
+                                start_time=eda.df['Time'].iloc[a], end_time=eda.df['Time'].iloc[b - 1])
+            results[i] = cache.get(keys[i])
+            if results[i] is not None:
+                continue
+        todo.setdefault(b - a, []).append(i)
     
-    sub_echo='o' # used for tracking which subject we are at
-    #Go through sleep df row by row
-    for ind in EMA_df.index:
-        #Get sub_ID
-        sub_ID=EMA_df['castor_record_id'][ind]
-        # Survey completion time
-        survey_time=EMA_df['survey_completed_on'][ind]
-        # Select time window for feature extraction
-        if x==0:#For wake
-            start_time=survey_time - pd.Timedelta(minutes=13)
-            end_time=survey_time - pd.Timedelta(minutes=3)
-            df_name='wake'
-        elif x==1:#For sleep
-            start_time=EMA_df['sleep_down_dt'][ind]
-            end_time=EMA_df['sleep_up_dt'][ind]
-            df_name='sleep'
-          
-        #Check if subject is new to reduce loading times
-        if sub_echo != sub_ID:
-            sub_echo=sub_ID
-            now = dt.datetime.now()
-            current_time=now.strftime("%Y-%m-%d %H:%M:%S")
-            print ("Subject " + sub_echo + " " + df_name +" data started at " + current_time)
-            
-            #Clear variables for memory issues
-            full_BVP=None
-            full_IBI= None
-            full_HR=None
-            full_SCR=None
-            full_temp=None
-            full_ACC=None
-            #Make empty DF to append all data
-            full_BVP=pd.DataFrame()
-            full_IBI=pd.DataFrame()
-            full_HR=pd.DataFrame()
-            full_SCR=pd.DataFrame()
-            full_temp=pd.DataFrame()
-            full_ACC=pd.DataFrame()
-            
-            #Two session in data
-            sessions = ['control', 'stress']
-            for session_type in sessions:
-                #Set the file path and check if it exists to avoid errors. If it doesnt make empty DFs instead
-                filepath1 = ("/project/3013068.02/data/3013068.02_BaLS_" + sub_ID + "/logs/e4/"+str(session_type) + "/merge")
-                if os.path.isdir(filepath1)==True:                              
-                    if len(os.listdir(filepath1) ) >= 1:
-                        os.chdir (str(filepath1))
-                         ## BVP
-                        one_bvp= pd.read_csv("full_BVP.csv", sep='\t')
-                        one_bvp['Time']=pd.to_datetime(one_bvp['Time'], format='%Y-%m-%d %H:%M:%S')
-                        full_BVP=full_BVP.append(one_bvp)
-                        ## IBI
-                        one_IBI= pd.read_csv("full_IBI.csv", sep='\t')
-                        one_IBI['Time']=pd.to_datetime(one_IBI['Time'], format='%Y-%m-%d %H:%M:%S')
-                        full_IBI=full_IBI.append(one_IBI)
-                        ## HR
-                        one_HR= pd.read_csv("full_HR.csv", sep='\t')
-                        one_HR['Time']=pd.to_datetime(one_HR['Time'], format='%Y-%m-%d %H:%M:%S')
-                        full_HR=full_HR.append(one_HR)
-                        ## SCR
-                        one_SCR= pd.read_csv("full_EDA.csv", sep='\t')
-                        one_SCR['Time']=pd.to_datetime(one_SCR['Time'], format='%Y-%m-%d %H:%M:%S')
-                        full_SCR=full_SCR.append(one_SCR) 
-                        ## Temp
-                        one_temp= pd.read_csv("full_TEMP.csv", sep='\t')
-                        one_temp['Time']=pd.to_datetime(one_temp['Time'], format='%Y-%m-%d %H:%M:%S')
-                        full_temp=full_temp.append(one_temp)
-                        ## ACC
-                        one_acc= pd.read_csv("full_ACC.csv", sep='\t')
-                        one_acc['Time']=pd.to_datetime(one_acc['Time'], format='%Y-%m-%d %H:%M:%S')
-                        full_ACC=full_ACC.append(one_acc)
-                 
-            
-        #Now check if the data frames are empty by sampling one, to make sure we 
-        # dont try to source empty DFs that flag errors. 
-        if full_SCR.size >= 10:
-            
-            #Select the data in time window + make a copy for the FFT
-            temp_bvp = full_BVP[(full_BVP.Time > start_time) & (full_BVP.Time < end_time)]  
-            temp_IBI = full_IBI[(full_IBI.Time > start_time) & (full_IBI.Time < end_time)]   
-            temp_HR = full_HR[(full_HR.Time > start_time) & (full_HR.Time < end_time)] 
-            temp_SCR= full_SCR[(full_SCR.Time > start_time) & (full_SCR.Time < end_time)] 
-            temp_temp= full_temp[(full_temp.Time > start_time) & (full_temp.Time < end_time)]  
-            temp_ACC = full_ACC[(full_ACC.Time > start_time) & (full_ACC.Time < end_time)] 
-            
-            #Only run if file longer than 10 samples
-            if temp_IBI.size > 100:
-                
-                #Set index as time for FFT, and resample to 4hz
-                IBI_fft = temp_IBI
-                IBI_fft = IBI_fft.set_index(IBI_fft.Time)
-                IBI_fft = IBI_fft.drop('Time', axis=1)
-                IBI_fft = IBI_fft.resample('250ms').apply(np.mean)
-                IBI_fft = IBI_fft.interpolate(method='nearest')
+    for n, rows in todo.items():
+        if backend == 'pyphysio':
+            batch = []
+            for i in rows:
+                try:
+                    batch.append((i, decompose_eda(values[firsts[i]:stops[i]], fp, backend), None))
+                except EDAWindowError as error:
+                    batch.append((i, None, {'index': i, 'stage': error.stage, 'error': error.error}))
+        else:
+            components, batch_errors = E4_EDA.decompose(np.stack([values[firsts[i]:stops[i]] for i in rows]), fp=fp,
+                                                        fs=eda_params['fs'], threshold=eda_params['denoise_threshold'],
+                                                        delta=eda_params['delta'])
+            failed = {error['index']: error for error in batch_errors}
+            batch = []
+            for j, i in enumerate(rows):
+                if j in failed:
+                    batch.append((i, None, dict(failed[j], index=i)))
+                else:
+                    batch.append((i, {name: component[j] for name, component in components.items()}, None))
+        for i, components, error in batch:
+            if error is not None:
+                errors.append(error)
+                continue
+            results[i] = components
+            if cache is not None:
+                cache.put(keys[i], components)
+    return results, errors
+
+
+def sc_indicators(components, backend=eda_backend, peak_windows=(1, 8)):
+    """
+    Skin conductance indicators of a window from its phasic and tonic 
+    components (tonic/phasic mean, std and range, phasic peak magnitude, 
+    duration and number, and area under the phasic curve). peak_windows are
+    the seconds before and after a peak for its start and end (None for the
+    defaults of the backend).
+    """
+    if backend == 'pyphysio':
+        eda = eda_signals(components)
+        eda_phasic, eda_tonic = eda['phasic'], eda['tonic']
+        peak_args = {} if peak_windows is None else {'win_pre': peak_windows[0], 'win_post': peak_windows[1]}
+        return {'tonic_mean': td_ind.Mean(delta=0.02)(eda_tonic),
+                'tonic_std': td_ind.StDev(delta=0.02)(eda_tonic),
+                'tonic_range': td_ind.Range(delta=0.02)(eda_tonic),
+                'phasic_mean': td_ind.Mean(delta=0.02)(eda_phasic),
+                'phasic_std': td_ind.StDev(delta=0.02)(eda_phasic),
+                'phasic_range': td_ind.Range(delta=0.02)(eda_phasic),
+                'phasic_mag': pk_ind.PeaksMean(delta=0.02, **peak_args)(eda_phasic),
+                'phasic_dur': pk_ind.DurationMean(delta=0.02, **peak_args)(eda_phasic),
+                'phasic_num': pk_ind.PeaksNum(delta=0.02)(eda_phasic),
+                'phasic_auc': td_ind.AUC(delta=0.02)(eda_phasic)}
+    peak_args = {} if peak_windows is None else {'win_pre': peak_windows[0], 'win_post': peak_windows[1]}
+    return E4_EDA.indicators(components['phasic'], components['tonic'], delta=eda_params['delta'], **peak_args)
+
+
+def eda_signals(components):
+    """EDA components (dict of arrays) as pyphysio signals for the indicators"""
+    return {name: ph.EvenlySignal(values=component, sampling_freq=4, signal_type='eda', start_time=0)
+            for name, component in components.items()}
+
+
+class SessionEDA:
+    """
+    EDA components of whole recordings: the EDA data of a subject is split 
+    into continuous segments (no gap longer than max_gap), and each segment 
+    is decomposed once, when a window in it is first used. Windows are then 
+    slices of the segment components, without filter transients at the 
+    window edges. A window over a gap gets the components of both sides.
+    """
+
+    def __init__(self, eda, fp=0.8, cache=None, sub_ID='', max_gap=pd.Timedelta(seconds=1), backend=eda_backend):
+        self.eda = eda
+        self.fp = fp
+        self.cache = cache
+        self.sub_ID = sub_ID
+        self.backend = backend
+        breaks = np.nonzero(np.diff(eda.times) > pd.Timedelta(max_gap).to_timedelta64())[0] + 1
+        self.starts = np.concatenate([[0], breaks]).astype(np.int64)
+        self.stops = np.concatenate([breaks, [len(eda)]]).astype(np.int64)
+        self.segments = {}
+
+    def segment(self, k):
+        """Components of segment k (decomposed on first use). A failed segment raises on every use"""
+        if k not in self.segments:
+            try:
+                self.segments[k] = eda_components(self.eda.df.iloc[self.starts[k]:self.stops[k]], self.fp,
+                                                  self.cache, self.sub_ID, backend=self.backend)
+            except EDAWindowError as error:
+                self.segments[k] = error
+        if isinstance(self.segments[k], Exception):
+            raise self.segments[k]
+        return self.segments[k]
+
+    def window(self, first, stop):
+        """Components of the EDA rows first to stop, as a dict of arrays"""
+        k_first = int(np.searchsorted(self.stops, first, side='right'))
+        k_last = int(np.searchsorted(self.starts, stop - 1, side='right')) - 1
+        parts = []
+        for k in range(k_first, k_last + 1):
+            a = max(first, self.starts[k]) - self.starts[k]
+            b = min(stop, self.stops[k]) - self.starts[k]
+            parts.append({name: component[a:b] for name, component in self.segment(k).items()})
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    def windows(self, firsts, stops):
+        """Components of many windows, as eda_components_batch"""
+        results = []
+        errors = []
+        for i, (a, b) in enumerate(zip(firsts, stops)):
+            try:
+                results.append(self.window(a, b))
+            except EDAWindowError as error:
+                results.append(None)
+                errors.append({'index': i, 'stage': error.stage, 'error': error.error})
+        return results, errors
+
+
+def eda_window_features(sub_ID, data, window_start, window_end, sleep=False, eda_cache=None, eda_mode=eda_mode,
+                        eda_backend=eda_backend, errors=None, timer=None):
+    """
+    Skin conductance features of all windows of one subject, as a data frame
+    with the EMA row index. With eda_mode 'window' every window is 
+    decomposed on its own (the original method, in batches of equal length 
+    windows), with 'session' the components are sliced from whole 
+    recordings (see SessionEDA). Windows that fail are added to the errors 
+    list (if given) as records with the subject, window and failed stage.
+    The window search is timed as the 'slice' stage of timer.
+    """
+    sc_feats=[i for i in feature_columns(sleep) if i.startswith('sc_')]
+    row_feats = {i: np.full(len(window_start), np.nan) for i in sc_feats}
+    eda = data['EDA']
+    if len(eda) == 0 or len(window_start) == 0:
+        return pd.DataFrame(row_feats, index=window_start.index)
+    
+    #Select the data in time window (rows of the full data)
+    with timed(timer, 'slice'):
+        first, stop = window_bounds_batch(eda.times, window_start, window_end)
+    values = eda.df['Data'].to_numpy()
+    ##If SC data too short, leave nans
+    rows = np.array([row for row in range(len(first))
+                     if (stop[row] - first[row] > 20) and (np.mean(values[first[row]:stop[row]]) > 0.009)], dtype=np.int64)
+    
+    def components(firsts, stops, fp):
+        """Components of the windows, for the EDA mode"""
+        if eda_mode == 'session':
+            return SessionEDA(eda, fp=fp, cache=eda_cache, sub_ID=sub_ID, backend=eda_backend).windows(firsts, stops)
+        return eda_components_batch(eda, firsts, stops, fp=fp, cache=eda_cache, sub_ID=sub_ID, backend=eda_backend)
+    
+    def failed(row, kind, error):
+        if errors is not None:
+            errors.append({'castor_record_id': sub_ID, 'window': kind, 'row': window_start.index[row],
+                           'start_time': window_start.iloc[row], 'end_time': window_end.iloc[row],
+                           'stage': error['stage'], 'error': error['error']})
+    
+    # Data cleaning, drivers, tonic and phasic components (or from the cache)
+    eda_windows, eda_errors = components(first[rows], stop[rows], fp=0.8)
+    for error in eda_errors:
+        failed(rows[error['index']], 'sleep' if sleep else 'wake', error)
+    for row, eda_window in zip(rows, eda_windows):
+        if eda_window is not None:
+            for name, value in sc_indicators(eda_window, eda_backend, peak_windows=(1, 8)).items():
+                row_feats['sc_' + name][row] = value
+    
+    # For sleep, also get SCR storms (first quarter of the window, lower low-pass)
+    if sleep and len(rows):
+        storm_stop = np.array([eda.bounds(window_start.iloc[row],
+                                          eda.df['Time'].iloc[first[row] + int(round((stop[row] - first[row])*0.25))])[1]
+                               for row in rows], dtype=np.int64)
+        storm_windows, storm_errors = components(first[rows], storm_stop, fp=0.1)
+        for error in storm_errors:
+            failed(rows[error['index']], 'storm', error)
+        for row, eda_window, storm_window in zip(rows, eda_windows, storm_windows):
+            if storm_window is None:
+                continue
+            storm = sc_indicators(storm_window, eda_backend, peak_windows=None)
+            row_feats['sc_storm_tonic_mean'][row] = storm['tonic_mean']
+            row_feats['sc_storm_phasic_mean'][row] = storm['phasic_mean']
+            # Phasic peaks of the storms are taken from the phasic component of the whole window
+            if eda_window is not None:
+                peaks = sc_indicators(eda_window, eda_backend, peak_windows=None)
+                for name in ['phasic_mag', 'phasic_dur', 'phasic_num', 'phasic_auc']:
+                    row_feats['sc_storm_' + name][row] = peaks[name]
+    
+    return pd.DataFrame(row_feats, index=window_start.index)
+
+
+def window_features(sub_ID, data, window_start, window_end, sleep=False, hrv_mode=hrv_mode, eda_cache=None,
+                    eda_mode=eda_mode, eda_backend=eda_backend, errors=None, timer=None):
+    """
+    Features of all windows of one subject. data holds the SignalWindows of
+    the subject by data type, window_start and window_end the window of each
+    EMA row. hrv_mode selects the LF/HF method (see E4_HRV), eda_cache is an
+    optional EDACache for the EDA components, eda_mode selects per window or
+    whole recording EDA decomposition, eda_backend the native (E4_EDA) or 
+    pyphysio EDA processing. EDA windows that fail are added to errors. 
+    The stages (slice, hrv, eda, temp, acc) are timed with timer (an
+    E4_Timing.StageTimer), if given. Returns a data frame with the EMA row
+    index and one column per feature.
+    """
+    sub_feats = pd.DataFrame(np.nan, index=window_start.index, columns=feature_columns(sleep))
+    if len(sub_feats) == 0:
+        return sub_feats
+    
+    #Now check if the data frames are empty by sampling one, to make sure we 
+    # dont try to source empty DFs that flag errors. 
+    if data['EDA'].df.size < 10:
+        return sub_feats
+    
+    #HR, IBI, temperature and ACC features for all windows of the subject, written column-wise
+    batch = batch_window_features({'IBI': data['IBI'], 'HR': data['HR'], 'TEMP': data['TEMP'], 'ACC': data['ACC']},
+                                  window_start, window_end, timer)
+    sub_feats[batch_feats] = batch[batch_feats].to_numpy()
+    
+    #Frequency domain HR features (LF, HF) for all windows of the subject
+    if len(data['IBI']) > 0:
+        with timed(timer, 'slice'):
+            first, stop = window_bounds_batch(data['IBI'].times, window_start, window_end)
+        with timed(timer, 'hrv'):
+            sub_feats['hr_lf'], sub_feats['hr_hf'], sub_feats['hr_lfhf'] = batch_lf_hf(
+                data['IBI'].times, data['IBI'].df['Data'].to_numpy(), first, stop, hrv_mode)
+    
+    #Skin conductance features, written column-wise
+    with timed(timer, 'eda'):
+        sc = eda_window_features(sub_ID, data, window_start, window_end, sleep, eda_cache, eda_mode, eda_backend,
+                                 errors, timer)
+    sub_feats[list(sc.columns)] = sc.to_numpy()
+    return sub_feats
+
+
+def subject_features(sub_ID, wake_windows, sleep_windows, root=None, options=None, profile_dir=None):
+    """
+    Task for one subject: load its E4 data once, and calculate the wake and
+    sleep features. wake_windows and sleep_windows are (window_start,
+    window_end) of the subject's EMA rows, options are keyword arguments of
+    window_features (hrv_mode, eda_cache, eda_mode, eda_backend) and store
+    (read from the signal store, see load_subject). Returns the
+    wake and sleep feature data frames, the error records of the EDA 
+    windows that failed, and the timing of the subject (wall time and the
+    time and calls per stage, see E4_Timing). With profile_dir, the subject
+    runs with cProfile and tracemalloc and their output is saved there.
+    """
+    if profile_dir is not None:
+        result, profile = profiled(subject_features, (sub_ID, wake_windows, sleep_windows, root, options),
+                                   os.path.join(profile_dir, sub_ID))
+        result[3]['profile'] = profile
+        return result
+    
+    options = dict(options or {})
+    store = options.pop('store', use_store)
+    errors = []
+    timer = StageTimer()
+    start = time.perf_counter()
+    data = load_windows_data(sub_ID, wake_windows, sleep_windows, root, options.get('eda_mode', eda_mode), timer, store)
+    wake_feats = window_features(sub_ID, data, *wake_windows, sleep=False, errors=errors, timer=timer, **options)
+    sleep_feats = window_features(sub_ID, data, *sleep_windows, sleep=True, errors=errors, timer=timer, **options)
+    timing = {'castor_record_id': sub_ID, 'wake_windows': len(wake_windows[0]), 'sleep_windows': len(sleep_windows[0]),
+              'seconds': time.perf_counter() - start, 'pid': os.getpid(), 'data_mb': data.memory_mb(),
+              'stages': timer.report()}
+    return wake_feats, sleep_feats, errors, timing
+
+
+def sliding_features(sub_ID, root=None, length=pd.Timedelta(minutes=window_minutes),
+                     stride=pd.Timedelta(minutes=stride_minutes)):
+    """
+    Task for the sliding window mode: the HR, IBI, temperature and ACC
+    features (batch_feats) of windows of length every stride over each week
+    of a subject, from its first to its last sample. The weeks are loaded one
+    at a time. Returns a data frame with the subject, week, window start and
+    end and the features (windows without data left out), and the timing of
+    the subject.
+    """
+    timer = StageTimer()
+    start = time.perf_counter()
+    parts = []
+    for merge_dir in subject_merge_dirs(sub_ID, root):
+        data = LazySubject([merge_dir], timer=timer)
+        windows = {data_type: data[data_type] for data_type in ['IBI', 'HR', 'TEMP', 'ACC']}
+        spans = [(win.times[0], win.times[-1]) for win in windows.values() if len(win) > 0]
+        if not spans:
+            continue
+        window_start, window_end = sliding_windows(min(a for a, _ in spans), max(b for _, b in spans), length, stride)
+        feats = batch_window_features(windows, window_start, window_end, timer)[batch_feats]
+        feats.insert(0, 'window_end', window_end.to_numpy())
+        feats.insert(0, 'window_start', window_start.to_numpy())
+        feats.insert(0, 'week', os.path.basename(os.path.dirname(merge_dir)))
+        feats.insert(0, 'castor_record_id', sub_ID)
+        parts.append(feats[feats[batch_feats].notna().any(axis=1).to_numpy()])
+    columns = ['castor_record_id', 'week', 'window_start', 'window_end'] + batch_feats
+    feats = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+    timing = {'castor_record_id': sub_ID, 'windows': len(feats), 'seconds': time.perf_counter() - start,
+              'pid': os.getpid(), 'stages': timer.report()}
+    return feats, timing
+
+
+def run_sliding(sub_IDs, out_dir, workers=1, root=None, length=pd.Timedelta(minutes=window_minutes),
+                stride=pd.Timedelta(minutes=stride_minutes), resume=True, timing_report=None):
+    """
+    Sliding window features of the subjects, saved per subject as
+    <sub_ID>.csv in out_dir. With resume, subjects with a file are skipped.
+    Returns the subjects that failed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    todo = [sub_ID for sub_ID in sub_IDs if not (resume and os.path.isfile(os.path.join(out_dir, sub_ID + '.csv')))]
+    print('Sliding window features (%g min every %g min) for ' % (length / pd.Timedelta(minutes=1), stride / pd.Timedelta(minutes=1)) + str(len(todo)) +
+          ' subjects with ' + str(workers) + ' worker(s)', flush=True)
+    failed = []
+    timings = []
+
+    def save(sub_ID, future_result):
+        try:
+            feats, timing = future_result()
+        except Exception:
+            print('Subject ' + sub_ID + ' failed:\n' + traceback.format_exc(), flush=True)
+            failed.append(sub_ID)
+            return
+        write_timer = StageTimer()
+        with write_timer.stage('write'):
+            feats.to_csv(os.path.join(out_dir, sub_ID + '.csv'), index=None, header=True)
+        timing['stages'].update(write_timer.report())
+        timings.append(timing)
+        print('Subject ' + sub_ID + ': ' + str(len(feats)) + ' windows', flush=True)
+
+    if workers <= 1:
+        for sub_ID in todo:
+            save(sub_ID, lambda: sliding_features(sub_ID, root, length, stride))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(sliding_features, sub_ID, root, length, stride): sub_ID for sub_ID in todo}
+            for future in as_completed(futures):
+                save(futures[future], future.result)
+
+    if timings:
+        timing_file = timing_report or os.path.join(out_dir, "timing.json")
+        totals = write_report(timing_file, timings)
+        print('Time per stage (see ' + timing_file + '):\n' + format_totals(totals))
+    if failed:
+        print(str(len(failed)) + ' subject(s) failed: ' + ', '.join(failed))
+    return failed
+
+
+def update_errors_file(errors_file, window_errors, done_subjects, keep=True):
+    """
+    Save the EDA windows that failed in errors_file: the records of the
+    subjects in done_subjects are replaced by window_errors, and with keep
+    the records of the other subjects in the file stay (subjects skipped by
+    a resumed or --subjects run). The file is removed if no records are
+    left. Returns the number of records in the file.
+    """
+    parts = []
+    if keep and os.path.isfile(errors_file):
+        old = pd.read_csv(errors_file)
+        parts.append(old[~old['castor_record_id'].isin(list(done_subjects))])
+    if window_errors:
+        parts.append(pd.DataFrame(window_errors))
+    errors = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    if len(errors) > 0:
+        errors.to_csv(errors_file, index=None)
+    elif os.path.isfile(errors_file):
+        os.remove(errors_file)
+    return len(errors)
+
+
+def run_subjects(tasks, workers=1, memory_bytes=None, root=None, options=None, profile=(), profile_dir=None):
+    """
+    Run the subject tasks, (sub_ID, wake_windows, sleep_windows), on a pool of
+    worker processes (in this process if workers is 1), with the feature
+    options of subject_features. Subjects are only
+    started while the estimated memory of the loaded subjects stays below
+    memory_bytes (at least one subject always runs). The subjects in profile
+    are profiled, with the output in profile_dir. Yields (sub_ID, result,
+    error) as subjects finish.
+    """
+    def started(sub_ID):
+        now = dt.datetime.now()
+        print ("Subject " + sub_ID + " data started at " + now.strftime("%Y-%m-%d %H:%M:%S"), flush=True)
+
+    if workers <= 1:
+        for sub_ID, wake_windows, sleep_windows in tasks:
+            started(sub_ID)
+            try:
+                yield sub_ID, subject_features(sub_ID, wake_windows, sleep_windows, root, options,
+                                               profile_dir if sub_ID in profile else None), None
+            except Exception:
+                yield sub_ID, None, traceback.format_exc()
+        return
+
+    queue = list(tasks)
+    running = {}
+    loaded_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while queue or running:
+            #Start subjects while there is a free worker and memory left
+            while queue and len(running) < workers:
+                size = estimate_subject_bytes(queue[0][0], root)
+                if running and memory_bytes is not None and loaded_bytes + size > memory_bytes:
+                    break
+                sub_ID, wake_windows, sleep_windows = queue.pop(0)
+                started(sub_ID)
+                future = pool.submit(subject_features, sub_ID, wake_windows, sleep_windows, root, options,
+                                     profile_dir if sub_ID in profile else None)
+                running[future] = (sub_ID, size)
+                loaded_bytes += size
             
-                #Apply a hanning window to the data
-                signal_len = IBI_fft.Data.size
-                hann_window = np.hanning(signal_len)
-                hann_window = hann_window/np.sum(hann_window)
-                IBI_fft = IBI_fft['Data']*hann_window
-                
-                #Do fast fourier transformation, with frequency
-                IBI_fft = np.abs(np.fft.fft(IBI_fft)) #Fast fourier  
-                IBI_freqs = IBI_fft**2   # Power
-                #IBI_freqs= np.fft.fftfreq(IBI_fft.shape[-1])
-                
-                #Set cutoffs for high and low frequency components    
-                LF_start = np.round(0.05/(4/signal_len))
-                LF_stop = np.round(0.15/(4/signal_len))
-                HF_start = np.round(0.15/(4/signal_len))
-                HF_stop = np.round(0.4/(4/signal_len))
-                
-                #Calcualte LF, HF, and Ratio
-                EMA_df['hr_lf'][ind]=np.sum(IBI_freqs[int(LF_start):int((LF_stop))])
-                EMA_df['hr_hf'][ind]=np.sum(IBI_freqs[int(HF_start):int((HF_stop))])
-                EMA_df['hr_lfhf'][ind]= (EMA_df['hr_lf'][ind])/(EMA_df['hr_hf'][ind])
-                        
-                #Calculate mean, standard deviation, max, min, RMSSD HR from data
-                EMA_df['ibi_mean'][ind] = np.mean(temp_IBI['Data'])
-                EMA_df['ibi_sd'][ind] = np.std(temp_IBI['Data']) 
-                EMA_df['ibi_min'][ind] = np.min(temp_IBI['Data']) 
-                EMA_df['ibi_max'][ind] = np.max(temp_IBI['Data']) 
-                EMA_df['hr_rmssd'][ind] = np.sqrt(np.mean(np.square(np.diff(temp_IBI['Data']))))
-                EMA_df['hr_mean'][ind] = np.mean(temp_HR.Data)
-                EMA_df['hr_sd'][ind] = np.std(temp_HR['Data']) 
-                EMA_df['hr_min'][ind] = np.min(temp_HR['Data']) 
-                EMA_df['hr_max'][ind] = np.max(temp_HR['Data']) 
-                
-                # Get quality index from IBI:
-                ibi_durations=(np.sum(temp_IBI.Data))/1000
-                ibi_quality_index=ibi_durations/((10*60))
-                EMA_df['ibi_based_quality'][ind]=ibi_quality_index
-            #SC part
-            ##If SC data too short, fill with nans
-            if (temp_SCR['Data'].size > 20) & (np.mean(temp_SCR.Data) > 0.009):
-
-                # Make eda signal into pyphysio
-                eda_data=np.array(temp_SCR.Data)           
-                eda_data = ph.EvenlySignal(values=eda_data, sampling_freq=4, signal_type ="eda", start_time=0)  
-                
+            #Wait for a subject to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                sub_ID, size = running.pop(future)
+                loaded_bytes -= size
                 try:
-                    # Data cleaning (despike, highpass, low pass threshold)
-                    eda_despike= flt.RemoveSpikes()(eda_data)
-                    eda_denoise= flt.DenoiseEDA(threshold=0.02)(eda_despike)
-                    eda_clean= ph.IIRFilter(fp=0.8, fs = 1.1, ftype='ellip')(eda_denoise)
-                    
-                    # Estimate signal drivers, 
-                    eda_driver = ph.DriverEstim()(eda_clean)
-                    # Separate tonic and phasic components
-                    eda_phasic, eda_tonic, _ = ph.PhasicEstim(delta=0.02)(eda_driver)
-                    
-                    #Get Tonic Dirvet Components
-                    EMA_df['sc_tonic_mean'][ind]=td_ind.Mean(delta=0.02)(eda_tonic)
-                    EMA_df['sc_tonic_std'][ind]=td_ind.StDev(delta=0.02)(eda_tonic)
-                    EMA_df['sc_tonic_range'][ind]=td_ind.Range(delta=0.02)(eda_tonic)
-                    # Phasic components
-                    EMA_df['sc_phasic_mean'][ind] =td_ind.Mean(delta=0.02)(eda_phasic)
-                    EMA_df['sc_phasic_std'][ind] =td_ind.StDev(delta=0.02)(eda_phasic)
-                    EMA_df['sc_phasic_range'][ind] =td_ind.Range(delta=0.02)(eda_phasic)
-                    # Phasic Peaks
-                    EMA_df['sc_phasic_mag'][ind]=pk_ind.PeaksMean(delta=0.02, win_pre=1, win_post=8)(eda_phasic)
-                    EMA_df['sc_phasic_dur'][ind]= pk_ind.DurationMean(delta=0.02, win_pre=1, win_post=8)(eda_phasic)
-                    EMA_df['sc_phasic_num'][ind]=pk_ind.PeaksNum(delta=0.02)(eda_phasic)
-                    EMA_df['sc_phasic_auc'][ind]=td_ind.AUC(delta=0.02)(eda_phasic)
-                except:
-                    print ( sub_ID + ' time point ' + str(start_time)+  ' to ' +  str(end_time)  + ' failed...' )
-                
-                # For sleep, also get SCR storms
-                if x==1: 
-                    scr_storm_len=int(round(len(temp_SCR.Data)*0.25))
-                    scr_end= temp_SCR.Time.iloc[scr_storm_len]
-                    temp_SCR_storm=full_SCR[(full_SCR.Time > start_time) & (full_SCR.Time < scr_end)] 
-                    
-                    # Make eda signal into pyphysio
-                    eda_storm_data=np.array(temp_SCR_storm.Data)           
-                    eda_storm_data = ph.EvenlySignal(values=eda_storm_data, sampling_freq=4, 
-                                                     signal_type = 'eda', start_time=0)  
-                    try:
-                        # Data cleaning (despike, highpass, low pass threshold)
-                        eda_storm_despike= flt.RemoveSpikes()(eda_storm_data)
-                        eda_storm_denoise= flt.DenoiseEDA(threshold=0.02)(eda_storm_despike)
-                        eda_storm_clean= ph.IIRFilter(fp=0.1, fs = 1.1, ftype='ellip')(eda_storm_denoise)
-                        
-                        # Estimate signal drivers, 
-                        eda_storm_driver = ph.DriverEstim()(eda_storm_clean)
-                        # Separate tonic and phasic components
-                        eda_storm_phasic, eda_storm_tonic, _ = ph.PhasicEstim(delta=0.02)(eda_storm_driver)
-                        
-                        # Add to dataframe
-                        EMA_df['sc_storm_tonic_mean'][ind]=td_ind.Mean(delta=0.02)(eda_storm_tonic)
-                        # Phasic components
-                        EMA_df['sc_storm_phasic_mean'][ind] =td_ind.Mean(delta=0.02)(eda_storm_phasic)
-                        # Phasic Peaks
-                        EMA_df['sc_storm_phasic_mag'][ind]=pk_ind.PeaksMean(delta=0.02)(eda_phasic)
-                        EMA_df['sc_storm_phasic_dur'][ind]= pk_ind.DurationMean(delta=0.02)(eda_phasic)
-                        EMA_df['sc_storm_phasic_num'][ind]=pk_ind.PeaksNum(delta=0.02)(eda_phasic)
-                        EMA_df['sc_storm_phasic_auc'][ind]=td_ind.AUC(delta=0.02)(eda_phasic)    
-                    except:
-                        print ( sub_ID + ' time point ' + str(start_time)+  ' and ' +  str(end_time)  + ' failed...' )
-                        
-            #Skin temperarture: 
-            if temp_temp.size > 10:  
-                #ST mean
-                EMA_df['temp_mean'][ind]=temp_temp['Data'].mean()
-                #ST median
-                EMA_df['temp_median'][ind]=temp_temp['Data'].median()
-                # ST SD
-                EMA_df['temp_sd'][ind]=temp_temp['Data'].std()
-                #ST slope
-                line_fit=np.polyfit(range(len(temp_temp['Data'].values)),temp_temp['Data'].values,1)  #fit line through data
-                EMA_df['temp_slope'][ind]=line_fit[0]
+                    yield sub_ID, future.result(), None
+                except Exception:
+                    yield sub_ID, None, traceback.format_exc()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract E4 features for the wake and sleep EMA surveys.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, one subject each (default: 1, 0 uses all cores)')
+    parser.add_argument('--memory-gb', type=float, default=None,
+                        help='limit for the estimated memory of subjects loaded at the same time')
+    parser.add_argument('--subjects', nargs='+', default=None, help='subject IDs to run (e.g. sub_001)')
+    parser.add_argument('--checkpoint-every', type=int, default=checkpoint_every,
+                        help='number of subjects between checkpoint writes')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', default=resume,
+                        help='start over instead of skipping rows in the checkpoint files')
+    parser.add_argument('--ema-dir', default=ema_dir, help='folder with the cleaned EMA files')
+    parser.add_argument('--root', default=data_root, help='folder with the subject data')
+    parser.add_argument('--hrv-mode', default=hrv_mode, choices=HRV_MODES,
+                        help='method of the LF/HF power (default: fft, the original values)')
+    parser.add_argument('--eda-mode', default=eda_mode, choices=EDA_MODES,
+                        help='EDA decomposition per window (default) or once per recording (session)')
+    parser.add_argument('--eda-backend', default=eda_backend, choices=EDA_BACKENDS,
+                        help='EDA processing: pyphysio (default if installed, the original values) or the '
+                             'native numpy/scipy chain (default without pyphysio)')
+    parser.add_argument('--eda-cache', default=None,
+                        help='folder of the EDA component cache (default: eda_cache in the EMA folder)')
+    parser.add_argument('--eda-cache-gb', type=float, default=eda_cache_gb, help='size limit of the EDA cache')
+    parser.add_argument('--no-eda-cache', dest='use_eda_cache', action='store_false', default=True,
+                        help='process all EDA windows again, without the cache')
+    parser.add_argument('--use-store', action='store_true', default=use_store,
+                        help='read EDA, TEMP, HR and ACC from the signal store (E4_Cleaner.py --store) where it can be used')
+    parser.add_argument('--timing-report', default=None,
+                        help='JSON file with the time per stage of each subject (E4_Feature_Timing.json in the EMA folder)')
+    parser.add_argument('--profile', type=int, default=0,
+                        help='run this many subjects (spread over the list) with cProfile and tracemalloc')
+    parser.add_argument('--profile-dir', default=None, help='folder for the profiles (profiles in the EMA folder)')
+    parser.add_argument('--sliding', action='store_true',
+                        help='features of sliding windows over each week instead of the EMA windows (HR, IBI, TEMP, ACC)')
+    parser.add_argument('--window-minutes', type=float, default=window_minutes, help='window length with --sliding')
+    parser.add_argument('--stride-minutes', type=float, default=stride_minutes, help='window step with --sliding')
+    args = parser.parse_args(argv)
+    if args.eda_backend == 'pyphysio' and ph is None:
+        parser.error('--eda-backend pyphysio needs the pyphysio package')
+    if args.eda_backend == 'native' and not args.sliding:
+        print('EDA features with the native chain (E4_EDA), not the original pyphysio values')
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    if args.sliding:
+        #Continuous features, one file per subject in the EMA folder
+        length = pd.Timedelta(minutes=args.window_minutes)
+        stride = pd.Timedelta(minutes=args.stride_minutes)
+        out_dir = os.path.join(args.ema_dir, 'Sliding_Features_%gmin_%gmin' % (args.window_minutes, args.stride_minutes))
+        failed = run_sliding(args.subjects or subject_ids(args.root), out_dir, workers, args.root, length, stride,
+                             args.resume, args.timing_report)
+        return 1 if failed else 0
+    memory_bytes = args.memory_gb * 1024**3 if args.memory_gb else None
+    eda_cache = None
+    if args.use_eda_cache:
+        eda_cache = EDACache(args.eda_cache or os.path.join(args.ema_dir, 'eda_cache'), args.eda_cache_gb * 1024**3)
+
+    #Import EMA data (cleaned beforehand)
+    Wake_df = prepare_ema(read_ema(args.ema_dir, "EMA_Clean"), sleep=False)
+    Sleep_df = prepare_ema(read_ema(args.ema_dir, "Sleep_Clean"), sleep=True)
+    EMA_dfs = [Wake_df, Sleep_df]
+    out_files = feature_files(args.ema_dir)
+    
+    #Checkpoints with the rows finished so far, and windows of the rows still to do
+    checkpoints = []
+    pending = []
+    for x, EMA_df in enumerate(EMA_dfs):
+        checkpoint = FeatureCheckpoint(out_files[x], EMA_df, feature_columns(x==1),
+                                       flush_every=args.checkpoint_every, resume=args.resume)
+        todo = EMA_df[~checkpoint.is_done(EMA_df)]
+        if args.subjects is not None:
+            todo = todo[todo['castor_record_id'].isin(args.subjects)]
+            #The features of the other subjects are kept from the last feature file
+            if os.path.isfile(out_files[x]):
+                last = pd.read_csv(out_files[x])
+                checkpoint.add(last[~last['castor_record_id'].isin(args.subjects)])
+        window_start, window_end = feature_windows(todo, sleep=(x==1))
+        checkpoints.append(checkpoint)
+        pending.append((todo, window_start, window_end))
+    
+    #One task per subject, with its wake and sleep windows
+    subjects = pd.unique(pd.concat([todo['castor_record_id'] for todo, _, _ in pending]).dropna())
+    tasks = []
+    for sub_ID in sorted(subjects):
+        windows = []
+        for todo, window_start, window_end in pending:
+            rows = todo.index[todo['castor_record_id'] == sub_ID]
+            windows.append((window_start[rows], window_end[rows]))
+        tasks.append((sub_ID, windows[0], windows[1]))
+    print('Extracting features for ' + str(len(tasks)) + ' subjects with ' + str(workers) + ' worker(s)')
+    #Subjects to profile, spread over the list
+    profile = set()
+    if args.profile > 0 and tasks:
+        step = max(len(tasks) // args.profile, 1)
+        profile = {sub_ID for sub_ID, _, _ in tasks[::step][:args.profile]}
+    profile_dir = args.profile_dir or os.path.join(args.ema_dir, 'profiles')
     
+    #Add the features of each finished subject, and save them in the checkpoints
+    failed = []
+    window_errors = []
+    done_subjects = []
+    timings = []
+    main_timer = StageTimer()
+    options = {'hrv_mode': args.hrv_mode, 'eda_cache': eda_cache, 'eda_mode': args.eda_mode,
+               'eda_backend': args.eda_backend, 'store': args.use_store}
+    for sub_ID, result, error in run_subjects(tasks, workers, memory_bytes, args.root, options, profile, profile_dir):
+        if error is not None:
+            print('Subject ' + sub_ID + ' failed:\n' + error, flush=True)
+            failed.append(sub_ID)
+            continue
+        wake_feats, sleep_feats, sub_errors, timing = result
+        if sub_errors:
+            print('Subject ' + sub_ID + ': ' + str(len(sub_errors)) + ' EDA window(s) failed', flush=True)
+            window_errors.extend(sub_errors)
+        #Saving the rows in the checkpoints is the write stage of the subject
+        write_timer = StageTimer()
+        with write_timer.stage('write'):
+            for EMA_df, checkpoint, sub_feats in zip(EMA_dfs, checkpoints, [wake_feats, sleep_feats]):
+                if len(sub_feats) > 0:
+                    EMA_df.loc[sub_feats.index, sub_feats.columns] = sub_feats.to_numpy()
+                    checkpoint.add(EMA_df.loc[sub_feats.index])
+        timing['stages'].update(write_timer.report())
+        timings.append(timing)
+        done_subjects.append(sub_ID)
     
-            # Accelorometer Data
-            if temp_ACC['ACC_X'].size > 20:
-                
-                # Get absolute differences
-                temp_ACC['ACC_X']=np.array(abs(temp_ACC['ACC_X'].diff(-1)))
-                temp_ACC['ACC_Y']=np.array(abs(temp_ACC['ACC_Y'].diff(-1)))
-                temp_ACC['ACC_Z']=np.array(abs(temp_ACC['ACC_Z'].diff(-1)))
-                #Calculate the sum of squares from the difference for total ACC
-                temp_ACC['ACC_tot']=np.sqrt(temp_ACC['ACC_X']**2+temp_ACC['ACC_Y']**2+temp_ACC['ACC_Z']**2)
-                #Apply Temporal filter of 1 second
-                N=32
-                acc_delta=np.convolve(temp_ACC['ACC_tot'], np.ones((N,))/N, mode='valid')
-                # Append mean displacements + SDs to df
-                EMA_df['acc_x'][ind]=np.mean(temp_ACC['ACC_X'])
-                EMA_df['acc_x_sd'][ind]=np.std(temp_ACC['ACC_X'])
-                EMA_df['acc_y'][ind]=np.mean(temp_ACC['ACC_Y'])
-                EMA_df['acc_y_sd'][ind]=np.std(temp_ACC['ACC_Y'])
-                EMA_df['acc_z'][ind]=np.mean(temp_ACC['ACC_Z'])
-                EMA_df['acc_z_sd'][ind]=np.std(temp_ACC['ACC_Z'])
-                EMA_df['acc_delta'][ind]=np.nanmean(temp_ACC['ACC_tot'])
-                EMA_df['acc_delta_sd'][ind]=np.nanstd(temp_ACC['ACC_tot'])
-                
-            # #Write out dataframe everytime
-            if x==0:
-                  feature_file="/project/3013068.02/stats/EMA/EMA_Clean_Features_10min.csv"
-            else:
-                  feature_file="/project/3013068.02/stats/EMA/Sleep_Clean_Features_10min.csv"
-            # #Write it out every time:
-            EMA_df.to_csv (feature_file, index = None, header=True)
-             
+    #Write out dataframes with all finished rows (failed subjects stay in the checkpoint for a rerun)
+    with main_timer.stage('write'):
+        for EMA_df, checkpoint in zip(EMA_dfs, checkpoints):
+            checkpoint.finalize(EMA_df, keep=bool(failed))
+    #Time per stage of each subject, and the totals
+    timing_file = args.timing_report or os.path.join(args.ema_dir, "E4_Feature_Timing.json")
+    totals = write_report(timing_file, timings, main_timer.report())
+    print('Time per stage (see ' + timing_file + '):\n' + format_totals(totals))
+    if timings:
+        print('Data in memory per subject: up to %.1f MB' % max(timing['data_mb'] for timing in timings))
+    #EDA windows that failed, with the stage and error (kept for the subjects not run now, as their rows)
+    errors_file = os.path.join(args.ema_dir, "E4_Feature_Errors.csv")
+    n_errors = update_errors_file(errors_file, window_errors, done_subjects, args.resume or args.subjects is not None)
+    if window_errors:
+        print(str(len(window_errors)) + ' EDA window(s) failed, see ' + errors_file)
+    elif n_errors:
+        print('No EDA windows failed in this run, ' + str(n_errors) + ' of earlier runs in ' + errors_file)
+    if failed:
+        print(str(len(failed)) + ' subject(s) failed: ' + ', '.join(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frequency domain HRV features (LF, HF and LF/HF power) of the IBI data, for
+E4_Features.py. Three modes:
+
+    - 'fft' (default): the IBIs are averaged in 250 ms bins (4 Hz), empty
+        bins take the nearest bin with data, a normalised Hann window is
+        applied, and LF/HF are the summed FFT power in the frequency bins
+        round(f * n / 4). These are the values of the original per window
+        code (pandas resample + np.fft.fft), computed with numpy bin counts
+        and an rfft of all windows with the same length at once.
+    - 'welch': the same 4 Hz grid, with a Welch power spectral density
+        (scipy.signal.welch) integrated over the bands.
+    - 'lombscargle': Lomb-Scargle periodogram (scipy.signal.lombscargle)
+        on the irregular beat times, without resampling, integrated over
+        the bands.
+
+Only 'fft' gives values comparable to earlier feature files; the other two
+modes give band powers in ms^2.
+
+"""
+
+#Import Libraries
+import functools
+import numpy as np
+from scipy import signal
+
+#Resampling grid of the IBI data (4 Hz)
+resample_freq = 4.0
+bin_ns = int(1e9 / resample_freq)
+#Frequency bands (Hz)
+lf_band = (0.05, 0.15)
+hf_band = (0.15, 0.4)
+#Segment length of the Welch estimate (samples at 4 Hz, 64 s)
+welch_nperseg = 256
+#Windows need more than this many IBIs (as the other HR features)
+min_ibis = 50
+
+HRV_MODES = ('fft', 'welch', 'lombscargle')
+
+
+@functools.lru_cache(maxsize=None)
+def fft_band_bins(n_samples, samp_freq=resample_freq):
+    """
+    FFT bin ranges (LF start, LF stop, HF start, HF stop) for a window of
+    n_samples, as np.round(f / (samp_freq / n_samples)) of the band edges.
+    Cached by window length.
+    """
+    step = samp_freq / n_samples
+    return tuple(int(np.round(f / step)) for f in (lf_band[0], lf_band[1], hf_band[0], hf_band[1]))
+
+
+def _band_masks(freqs):
+    """Boolean LF and HF masks of a frequency axis"""
+    return (freqs >= lf_band[0]) & (freqs < lf_band[1]), (freqs >= hf_band[0]) & (freqs < hf_band[1])
+
+
+@functools.lru_cache(maxsize=None)
+def welch_bands(nperseg, samp_freq=resample_freq):
+    """Frequency step and LF/HF masks of a Welch PSD with segments of nperseg. Cached by segment length."""
+    freqs = np.fft.rfftfreq(nperseg, 1 / samp_freq)
+    return (freqs[1] - freqs[0],) + _band_masks(freqs)
+
+
+@functools.lru_cache(maxsize=None)
+def lombscargle_bands(duration):
+    """
+    Frequencies (steps of 1/duration up to the top of the HF band) and LF/HF
+    masks of a Lomb-Scargle periodogram for a window of duration whole
+    seconds. Cached by window length.
+    """
+    freqs = np.arange(1, int(hf_band[1] * duration) + 1) / duration
+    return (freqs,) + _band_masks(freqs)
+
+
+def resample_ibi(times_ns, values):
+    """
+    Mean IBI in 250 ms bins from the first to the last beat (bins aligned to
+    whole 250 ms since the epoch, as pandas resample('250ms')). Empty bins
+    take the value of the nearest bin with data. Ties are broken as pandas
+    interpolate(method='nearest') does, by midpoints of the bin times in ns
+    as float64, so the values are the same as the original code.
+    """
+    bins = times_ns // bin_ns
+    first_bin = bins[0]
+    bins = bins - first_bin
+    n_bins = int(bins[-1]) + 1
+    counts = np.bincount(bins, minlength=n_bins)
+    sums = np.bincount(bins, weights=values, minlength=n_bins)
+    full = np.nonzero(counts)[0]
+    means = sums[full] / counts[full]
+    if len(full) == n_bins:
+        return means
+    #Nearest bin with data, from the midpoints between bins with data
+    bin_times = ((first_bin + np.arange(n_bins)) * bin_ns).astype(np.float64)
+    midpoints = bin_times[full] / 2.0
+    midpoints = midpoints[1:] + midpoints[:-1]
+    return means[np.searchsorted(midpoints, bin_times, side='left')]
+
+
+def _fft_lf_hf(grids):
+    """LF and HF of the resampled windows in grids, batched by window length"""
+    lf = np.full(len(grids), np.nan)
+    hf = np.full(len(grids), np.nan)
+    by_len = {}
+    for i, grid in enumerate(grids):
+        by_len.setdefault(len(grid), []).append(i)
+    for n, rows in by_len.items():
+        hann_window = np.hanning(n)
+        hann_window = hann_window / np.sum(hann_window)
+        #Power of the positive frequencies (the bands are below the Nyquist frequency)
+        power = np.abs(np.fft.rfft(np.stack([grids[i] for i in rows]) * hann_window, axis=1))**2
+        lf_start, lf_stop, hf_start, hf_stop = fft_band_bins(n)
+        lf[rows] = power[:, lf_start:lf_stop].sum(axis=1)
+        hf[rows] = power[:, hf_start:hf_stop].sum(axis=1)
+    return lf, hf
+
+
+def _welch_lf_hf(grid):
+    """LF and HF of one resampled window from a Welch PSD"""
+    nperseg = min(welch_nperseg, len(grid))
+    _, psd = signal.welch(grid, fs=resample_freq, nperseg=nperseg)
+    step, lf_mask, hf_mask = welch_bands(nperseg)
+    return np.sum(psd[lf_mask]) * step, np.sum(psd[hf_mask]) * step
+
+
+def _lombscargle_lf_hf(times_ns, values):
+    """LF and HF of one window from a Lomb-Scargle periodogram of the irregular IBIs"""
+    t = (times_ns - times_ns[0]) / 1e9
+    freqs, lf_mask, hf_mask = lombscargle_bands(max(int(round(t[-1])), 1))
+    pgram = signal.lombscargle(t, values - np.mean(values), 2 * np.pi * freqs)
+    #Periodogram to power: 2/N per frequency step of 1/duration
+    power = pgram * 2 / len(values)
+    return np.sum(power[lf_mask]), np.sum(power[hf_mask])
+
+
+def batch_lf_hf(times, values, first, stop, mode='fft'):
+    """
+    LF, HF and LF/HF of the IBIs values[first:stop] for every window. times
+    are the (sorted) datetime64 time stamps of the IBIs. Windows with too
+    few IBIs give NaN. Returns three arrays.
+    """
+    if mode not in HRV_MODES:
+        raise ValueError('unknown HRV mode ' + str(mode) + ', use one of ' + ', '.join(HRV_MODES))
+    n_windows = len(first)
+    lf = np.full(n_windows, np.nan)
+    hf = np.full(n_windows, np.nan)
+    times_ns = np.asarray(times).astype('datetime64[ns]').astype(np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    rows = np.nonzero((stop - first) > min_ibis)[0]
+
+    if mode == 'lombscargle':
+        for row in rows:
+            a, b = first[row], stop[row]
+            lf[row], hf[row] = _lombscargle_lf_hf(times_ns[a:b], values[a:b])
+    else:
+        grids = [resample_ibi(times_ns[first[row]:stop[row]], values[first[row]:stop[row]]) for row in rows]
+        if mode == 'fft':
+            lf[rows], hf[rows] = _fft_lf_hf(grids)
+        else:
+            for row, grid in zip(rows, grids):
+                lf[row], hf[row] = _welch_lf_hf(grid)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lfhf = lf / hf
+    return lf, hf, lfhf
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for reading the E4 session exports used by the cleaning,
+feature and plotting scripts.
+
+    - Time stamps for evenly sampled signals (ACC, EDA, BVP, HR, TEMP) are
+        built in one step from the start time of the recording and the
+        sampling frequency, instead of adding the sampling time sample by
+        sample. Each time stamp is calculated from its own sample number, so
+        no rounding error builds up over long recordings.
+    - Merged files can be written as Parquet or Feather (typed time and 
+        signal columns, see E4_Schema) next to the old tab separated CSV.
+        Readers use the binary file when it exists, and fall back to the CSV.
+        Data that is read gets the types of the schema.
+    - Subject data can be loaded lazily (LazySubject): a data type is only
+        read when it is used, and only for the time ranges that are needed
+        (passed as filters when reading Parquet). With store, the evenly
+        sampled signals are read from the memory-mapped signal store (see
+        E4_Store) where it holds the same samples as the merged file.
+
+"""
+
+#Import Libraries
+import os
+import numpy as np
+import pandas as pd
+from E4_Accumulator import SessionAccumulator
+from E4_Windows import SignalWindows
+from E4_Timing import timed
+from E4_Schema import apply_schema, frame_mb
+from E4_Store import read_store
+
+
+def make_time_axis(start_time, samp_freq, n_samples, first_sample=0):
+    """
+    Return the time stamps of an evenly sampled E4 recording as a
+    datetime64[ns] array. start_time is the unix epoch (in seconds) from the
+    first line of the E4 file, samp_freq the sampling frequency in Hz from
+    the second line. first_sample is the sample number of the first time
+    stamp, for reading a recording in chunks.
+    """
+    #Start time in nanoseconds since epoch
+    start_ns = int(round(float(start_time) * 1e9))
+
+    #Sampling time in nanoseconds. E4 rates (1, 4, 32, 64 Hz) give whole
+    #nanoseconds, so integer math keeps the time stamps exact
+    samp_ns = 1e9 / float(samp_freq)
+    sample_nr = np.arange(int(first_sample), int(first_sample) + int(n_samples), dtype=np.int64)
+    if samp_ns.is_integer():
+        offsets = sample_nr * int(samp_ns)
+    else:
+        offsets = np.rint(sample_nr * samp_ns).astype(np.int64)
+
+    return (start_ns + offsets).astype('datetime64[ns]')
+
+
+#File formats for the merged files, in the order they are looked for when
+#reading. CSV is the old tab separated text format, and is read last so that
+#sessions merged before the binary formats were added still load.
+MERGE_FORMATS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+#Rows per record batch when merged Parquet files are read into preallocated columns
+batch_rows = 1000000
+
+
+def merged_name(data_type, out_format='csv'):
+    """File name of a merged file, e.g. ('EDA.csv', 'parquet') -> full_EDA.parquet"""
+    data_type = os.path.splitext(data_type)[0]
+    return 'full_' + data_type + MERGE_FORMATS[out_format]
+
+
+def write_merged(df, merge_dir, data_type, out_format='parquet'):
+    """
+    Write a merged data frame for one data type to the merge directory.
+    Parquet and Feather keep the types of E4_Schema (datetime64 time, int8
+    ACC and float32 signals), CSV keeps the tab separated text format. Files of the
+    same data type in other formats are removed so they cannot be read
+    instead of the new file. Returns the path of the written file.
+    """
+    if out_format not in MERGE_FORMATS:
+        raise ValueError('Unknown output format: ' + str(out_format))
+    fullout = os.path.join(merge_dir, merged_name(data_type, out_format))
+
+    if out_format == 'csv':
+        df.to_csv(fullout, sep='\t', index=False)
+    else:
+        #Typed columns of the schema: datetime64[ns] time, int8 ACC, float32 signals
+        df = apply_schema(df.reset_index(drop=True), data_type)
+        if out_format == 'parquet':
+            #Row groups of 65536 rows, so time range filters can skip most of the file
+            df.to_parquet(fullout, index=False, row_group_size=2**16)
+        else:
+            df.to_feather(fullout)
+
+    remove_other_formats(merge_dir, data_type, out_format)
+    return fullout
+
+
+def remove_other_formats(merge_dir, data_type, out_format):
+    """Remove the merged files of a data type in formats other than out_format"""
+    for other_format in MERGE_FORMATS:
+        if other_format != out_format:
+            other = os.path.join(merge_dir, merged_name(data_type, other_format))
+            if os.path.isfile(other):
+                os.remove(other)
+
+
+def time_ranges(start_times, end_times, max_gap=pd.Timedelta(hours=1)):
+    """
+    Union of time windows as a short list of (start, end) ranges, for reading
+    only the data that the windows need. Windows that overlap or are less than
+    max_gap apart are joined into one range. Windows with a missing time are
+    left out.
+    """
+    windows = pd.DataFrame({'start': pd.to_datetime(pd.Series(start_times)).to_numpy(),
+                            'end': pd.to_datetime(pd.Series(end_times)).to_numpy()}).dropna()
+    windows = windows[windows['end'] > windows['start']].sort_values('start')
+    ranges = []
+    for start, end in zip(windows['start'], windows['end']):
+        if ranges and start - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return [(start, end) for start, end in ranges]
+
+
+def _select_ranges(df, ranges):
+    """Rows of a data frame with start <= Time <= end for any of the ranges"""
+    times = df['Time'].to_numpy()
+    keep = np.zeros(len(df), dtype=bool)
+    for start, end in ranges:
+        keep |= (times >= pd.Timestamp(start).to_datetime64()) & (times <= pd.Timestamp(end).to_datetime64())
+    return df[keep].reset_index(drop=True)
+
+
+def merged_file(merge_dir, data_type):
+    """Merged file of a data type and its format, as read by read_merged"""
+    for out_format in MERGE_FORMATS:
+        fullin = os.path.join(merge_dir, merged_name(data_type, out_format))
+        if os.path.isfile(fullin):
+            return fullin, out_format
+    raise FileNotFoundError('No merged ' + str(data_type) + ' file in ' + str(merge_dir))
+
+
+def _empty_merged(fullin, in_format):
+    """Data frame without rows with the columns of a merged file, from its schema (or header)"""
+    if in_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(fullin).empty_table().to_pandas()
+    if in_format == 'feather':
+        import pyarrow as pa
+        with pa.memory_map(fullin) as source:
+            return pa.ipc.open_file(source).schema.empty_table().to_pandas()
+    df = pd.read_csv(fullin, sep='\t', nrows=0)
+    df['Time'] = pd.to_datetime(df['Time'])
+    return df
+
+
+def read_merged(merge_dir, data_type, ranges=None, schema=True):
+    """
+    Read the merged file of one data type (e.g. 'EDA') from a merge directory.
+    Binary files are used when they exist, otherwise the tab separated CSV is
+    read and the time column converted to datetime. With ranges, a list of
+    (start, end) times, only the rows inside these ranges are returned; for
+    Parquet the ranges are passed as filters, so row groups outside them are
+    not read at all, and an empty list of ranges only reads the columns. The
+    columns get the types of E4_Schema, unless schema is False (types as
+    stored).
+    """
+    fullin, in_format = merged_file(merge_dir, data_type)
+    if ranges is not None and len(ranges) == 0:
+        df = _empty_merged(fullin, in_format)
+    elif in_format == 'parquet':
+        if ranges is None:
+            df = pd.read_parquet(fullin)
+        else:
+            filters = [[('Time', '>=', pd.Timestamp(start)), ('Time', '<=', pd.Timestamp(end))]
+                       for start, end in ranges]
+            df = pd.read_parquet(fullin, filters=filters).reset_index(drop=True)
+    else:
+        if in_format == 'feather':
+            df = pd.read_feather(fullin)
+        else:
+            #Format is inferred, as ACC/BVP time stamps have fractional seconds
+            df = pd.read_csv(fullin, sep='\t')
+            df['Time'] = pd.to_datetime(df['Time'])
+        if ranges is not None:
+            df = _select_ranges(df, ranges)
+    return apply_schema(df, data_type) if schema else df
+
+
+def merged_rows(merge_dir, data_type):
+    """
+    Number of rows in the merged file of one data type, read from the Parquet
+    metadata without loading the data. None if unknown (Feather, CSV).
+    """
+    fullin = os.path.join(merge_dir, merged_name(data_type, 'parquet'))
+    if not os.path.isfile(fullin):
+        return None
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(fullin).metadata.num_rows
+
+
+def iter_merged_batches(merge_dir, data_type, rows=batch_rows):
+    """
+    Merged Parquet file of one data type as data frames of up to rows rows
+    (its record batches) with the types of E4_Schema, so only one batch is
+    in memory at a time.
+    """
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(os.path.join(merge_dir, merged_name(data_type, 'parquet'))).iter_batches(batch_size=rows):
+        yield apply_schema(batch.to_pandas(), data_type)
+
+
+def read_merged_sessions(merge_dirs, data_type, ranges=None):
+    """
+    Read and join the merged files of one data type from several merge
+    directories (e.g. the control and stress week of a subject), sorted by
+    time. When all files are Parquet and read whole, the columns are
+    preallocated from the row counts in their metadata and filled batch by
+    batch (see iter_merged_batches), so the peak memory is about the size of
+    the result. ranges limits the rows read, see read_merged (no file is
+    opened for an empty list).
+    """
+    if ranges is not None and len(ranges) == 0:
+        #No windows: nothing to read (as for files without rows in the ranges)
+        return pd.DataFrame()
+    n_rows = [merged_rows(merge_dir, data_type) for merge_dir in merge_dirs]
+    n_rows = sum(n_rows) if merge_dirs and None not in n_rows and ranges is None else None
+    sessions_acc = SessionAccumulator(n_rows=n_rows)
+    for merge_dir in merge_dirs:
+        if n_rows is None:
+            sessions_acc.add(read_merged(merge_dir, data_type, ranges))
+        else:
+            for df in iter_merged_batches(merge_dir, data_type, batch_rows):
+                sessions_acc.add(df)
+    return sessions_acc.result()
+
+
+def store_dir(merge_dir):
+    """Signal store directory of a merge directory (store/ next to merge/)"""
+    return os.path.join(os.path.dirname(os.path.normpath(merge_dir)), 'store')
+
+
+def read_store_sessions(merge_dirs, data_type, ranges=None):
+    """
+    Read and join one data type from the signal stores of several merge
+    directories, as read_merged_sessions. Returns None if the store of a
+    merge directory with a merged file cannot be used for it (see
+    E4_Store.read_store), so the merged files are read instead.
+    """
+    if ranges is not None and len(ranges) == 0:
+        return pd.DataFrame()
+    sessions_acc = SessionAccumulator()
+    for merge_dir in merge_dirs:
+        try:
+            fullin, _ = merged_file(merge_dir, data_type)
+        except FileNotFoundError:
+            continue
+        df = read_store(store_dir(merge_dir), data_type, ranges, fullin)
+        if df is None:
+            return None
+        sessions_acc.add(apply_schema(df, data_type))
+    return sessions_acc.result()
+
+
+class LazySubject:
+    """
+    E4 data of a subject, loaded per data type when it is first used (e.g.
+    subject['EDA']) and kept as SignalWindows. Data types that are never
+    used (BVP in the feature extraction) are never read. With ranges, only
+    the data inside these (start, end) ranges is read (see time_ranges),
+    except for the data types in whole_types, which are read whole (e.g. EDA
+    for components of whole recordings). With store, the data types of the
+    signal store are read from it where it can be used (see
+    read_store_sessions), and from the merged files otherwise. Reading is
+    timed as the 'load' stage of timer (an E4_Timing.StageTimer), if given.
+    """
+
+    def __init__(self, merge_dirs, ranges=None, timer=None, whole_types=(), store=False):
+        self.merge_dirs = list(merge_dirs)
+        self.ranges = ranges
+        self.timer = timer
+        self.whole_types = set(whole_types)
+        self.store = store
+        self.data = {}
+
+    def __getitem__(self, data_type):
+        if data_type not in self.data:
+            ranges = None if data_type in self.whole_types else self.ranges
+            with timed(self.timer, 'load'):
+                df = read_store_sessions(self.merge_dirs, data_type, ranges) if self.store else None
+                if df is None:
+                    df = read_merged_sessions(self.merge_dirs, data_type, ranges)
+                self.data[data_type] = SignalWindows(df)
+        return self.data[data_type]
+
+    def loaded(self):
+        """Data types loaded so far"""
+        return list(self.data)
+
+    def memory_mb(self):
+        """Memory of the data types loaded so far in MB"""
+        return sum(frame_mb(windows.df) for windows in self.data.values())
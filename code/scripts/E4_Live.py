@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live feature extraction for E4 data that arrives while it is recorded, for
+example to send an EMA prompt when the stress indicators rise.
+
+    - Samples arrive per modality (IBI, HR, EDA, TEMP, ACC) as batches of
+        time stamps (ns since epoch) and values, and are kept in a ring
+        buffer per modality (RingBuffer) sized for a little more than one
+        window, so memory does not grow with the length of the stream.
+    - Every cadence of data time (60 s by default) the features of the
+        window ending at that time (10 minutes by default) are calculated
+        with the same code as E4_Features.py (window_features: HR/IBI
+        statistics, RMSSD, LF/HF, EDA tonic/phasic, temperature slope, ACC
+        displacement), once the stream is lag seconds past it, so the
+        slower modalities have arrived.
+    - run_engine reads the stream and calculates the features in a worker
+        thread, so reading never waits for the features. While one window is
+        calculated at most one more waits; older waiting windows are dropped
+        (and counted), so the features never fall further behind than one
+        calculation.
+    - FileReplay plays back the merged files of a subject week as such a
+        stream, speed times faster than real time, to test offline. Gaps
+        between recordings longer than skip_gap are skipped.
+
+Usage:  python E4_Live.py --subject 1 --session control [--speed 600] [--cadence-seconds 60] [--out live.csv]
+"""
+
+#Import Libraries
+import os, sys, asyncio, inspect, argparse
+import numpy as np
+import pandas as pd
+from E4_IO import merged_file
+from E4_Stream import iter_merged_chunks
+from E4_Windows import SignalWindows
+import E4_Features
+
+#Modalities of the stream and their channels
+live_types = ['IBI', 'HR', 'EDA', 'TEMP', 'ACC']
+live_channels = {'EDA': ['Data'], 'TEMP': ['Data'], 'HR': ['Data'], 'IBI': ['Data'], 'ACC': ['ACC_X', 'ACC_Y', 'ACC_Z']}
+#Samples per second used to size the ring buffers (IBI: the highest heart rate)
+buffer_rates = {'EDA': 4, 'TEMP': 4, 'HR': 1, 'ACC': 32, 'IBI': 4}
+#Feature window, time between feature vectors, and wait for late modalities (data time)
+window_minutes = 10
+cadence_seconds = 60
+lag_seconds = 2
+#Folder with the subject data (for the replay)
+data_root = E4_Features.data_root
+
+
+class RingBuffer:
+    """
+    The last capacity samples of one modality: time stamps (ns since epoch)
+    and values (samples x channels). Samples older than the last one added
+    are dropped, so the buffer stays in time order.
+    """
+
+    def __init__(self, capacity, n_channels=1):
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity, dtype=np.int64)
+        self.values = np.zeros((self.capacity, n_channels), dtype=np.float64)
+        self.n = 0
+
+    def __len__(self):
+        return min(self.n, self.capacity)
+
+    def latest(self):
+        """Time of the last sample (ns), None if empty"""
+        return int(self.times[(self.n - 1) % self.capacity]) if self.n else None
+
+    def append(self, times, values):
+        """Add samples (time order) at the end, overwriting the oldest"""
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), -1)
+        if self.n:
+            keep = times > self.latest()
+            times, values = times[keep], values[keep]
+        if len(times) > self.capacity:
+            times, values = times[-self.capacity:], values[-self.capacity:]
+        pos = self.n % self.capacity
+        first = min(len(times), self.capacity - pos)
+        self.times[pos:pos + first] = times[:first]
+        self.values[pos:pos + first] = values[:first]
+        self.times[:len(times) - first] = times[first:]
+        self.values[:len(times) - first] = values[first:]
+        self.n += len(times)
+
+    def ordered(self):
+        """Time stamps and values in time order (copies)"""
+        if self.n <= self.capacity:
+            return self.times[:self.n].copy(), self.values[:self.n].copy()
+        pos = self.n % self.capacity
+        return (np.concatenate([self.times[pos:], self.times[:pos]]),
+                np.concatenate([self.values[pos:], self.values[:pos]]))
+
+    def window(self, start_ns, end_ns):
+        """Samples with start_ns < time < end_ns, as (times, values) copies"""
+        times, values = self.ordered()
+        first = np.searchsorted(times, start_ns, side='right')
+        stop = np.searchsorted(times, end_ns, side='left')
+        return times[first:stop], values[first:stop]
+
+
+class LiveFeatures:
+    """
+    Ring buffers of the modalities of one wristband, and the features of
+    their last window. window is a Timedelta, options are keyword arguments
+    of E4_Features.window_features (hrv_mode, eda_backend, ...).
+    """
+
+    def __init__(self, window=pd.Timedelta(minutes=window_minutes), sub_ID='live', lag=pd.Timedelta(seconds=lag_seconds),
+                 options=None):
+        self.window_ns = pd.Timedelta(window).value
+        self.sub_ID = sub_ID
+        self.options = options or {}
+        #A window, the lag, and a margin for batches that arrive together
+        seconds = self.window_ns / 1e9 * 1.5 + pd.Timedelta(lag).total_seconds()
+        self.buffers = {data_type: RingBuffer(buffer_rates[data_type] * seconds + 64, len(live_channels[data_type]))
+                        for data_type in live_types}
+
+    def add(self, data_type, times_ns, values):
+        """Add a batch of samples of one modality"""
+        if data_type in self.buffers:
+            self.buffers[data_type].append(times_ns, values)
+
+    def latest(self):
+        """Time of the newest sample of any modality (ns), None before the first"""
+        times = [buf.latest() for buf in self.buffers.values() if len(buf)]
+        return max(times) if times else None
+
+    def snapshot(self, end_ns):
+        """Copies of the data of the window ending at end_ns, as data frames per modality"""
+        frames = {}
+        for data_type, buf in self.buffers.items():
+            times, values = buf.window(end_ns - self.window_ns, end_ns)
+            df = pd.DataFrame(values, columns=live_channels[data_type])
+            df.insert(0, 'Time', times.astype('datetime64[ns]'))
+            frames[data_type] = df
+        return frames
+
+    def features(self, snapshot, end_ns):
+        """Feature vector (dict) of a snapshot of the window ending at end_ns"""
+        data = {data_type: SignalWindows(df) for data_type, df in snapshot.items()}
+        window_end = pd.Series([pd.Timestamp(end_ns)])
+        window_start = window_end - pd.Timedelta(self.window_ns)
+        feats = E4_Features.window_features(self.sub_ID, data, window_start, window_end, sleep=False, **self.options)
+        vector = {'time': window_end.iloc[0]}
+        vector.update(feats.iloc[0].to_dict())
+        return vector
+
+
+def stream_gaps(last, times_ns, gap_ns):
+    """
+    Gaps longer than gap_ns before the samples of a batch (times_ns), after
+    the newest sample so far (last, ns), as a list of (before, after) times.
+    """
+    if last is None or len(times_ns) == 0:
+        return []
+    times = np.concatenate([[last], np.asarray(times_ns, dtype=np.int64)])
+    newest = np.maximum.accumulate(times)
+    jumps = np.nonzero(times[1:] - newest[:-1] > gap_ns)[0]
+    return [(int(newest[i]), int(times[i + 1])) for i in jumps]
+
+
+async def run_engine(source, engine, on_vector, cadence=pd.Timedelta(seconds=cadence_seconds),
+                     lag=pd.Timedelta(seconds=lag_seconds)):
+    """
+    Feed the batches of source (async iterable of (data_type, times_ns,
+    values)) into engine (LiveFeatures), and calculate the features of the
+    window ending at every multiple of cadence (data time) once the stream
+    is lag past it (or the stream ended). Windows without data, in a gap of
+    the stream longer than a window, are skipped; the windows before a gap
+    and at the end of the stream are all calculated. on_vector is called (and
+    awaited if it is a coroutine) with each feature vector, which also has
+    the latency (wall time in s from the batch that completed the window to
+    the features) and the number of windows dropped so far (because the
+    features fell behind). Returns the number of vectors and dropped
+    windows.
+    """
+    loop = asyncio.get_running_loop()
+    cadence_ns = pd.Timedelta(cadence).value
+    lag_ns = pd.Timedelta(lag).value
+    #Window waiting to be calculated (at most one)
+    ticks = asyncio.Queue(maxsize=1)
+    stats = {'vectors': 0, 'dropped': 0}
+
+    async def emit():
+        while True:
+            item = await ticks.get()
+            if item is None:
+                return
+            end_ns, snapshot, received = item
+            vector = await loop.run_in_executor(None, engine.features, snapshot, end_ns)
+            vector['latency_s'] = loop.time() - received
+            vector['dropped'] = stats['dropped']
+            stats['vectors'] += 1
+            result = on_vector(vector)
+            if inspect.isawaitable(result):
+                await result
+            ticks.task_done()
+
+    def queue_ticks(until, received):
+        #Queue the windows ending up to until, replacing one that still waits
+        nonlocal next_tick
+        while until >= next_tick:
+            if ticks.full():
+                ticks.get_nowait()
+                ticks.task_done()
+                stats['dropped'] += 1
+            ticks.put_nowait((next_tick, engine.snapshot(next_tick), received))
+            next_tick += cadence_ns
+
+    async def flush_ticks(until, received):
+        #Queue the windows ending up to until and wait until they are calculated (none dropped)
+        nonlocal next_tick
+        while until >= next_tick:
+            await ticks.put((next_tick, engine.snapshot(next_tick), received))
+            next_tick += cadence_ns
+        await ticks.join()
+
+    emitter = asyncio.create_task(emit())
+    next_tick = None
+    try:
+        async for data_type, times_ns, values in source:
+            received = loop.time()
+            last = engine.latest()
+            engine.add(data_type, times_ns, values)
+            now = engine.latest()
+            if now is None:
+                continue
+            if next_tick is None:
+                next_tick = (now // cadence_ns + 1) * cadence_ns
+            for before, after in stream_gaps(last, times_ns, engine.window_ns):
+                #Gap without data (e.g. between recordings): all windows with data before it (they
+                #come at once, as no data came in the gap), then on from the first window with data
+                #after it; the windows in the gap are skipped
+                await flush_ticks(min(before + engine.window_ns, now - lag_ns), received)
+                next_tick = max(next_tick, -(-after // cadence_ns) * cadence_ns)
+            queue_ticks(now - lag_ns, received)
+            #Let the features run between batches
+            await asyncio.sleep(0)
+        #At the end of the stream all data of the last windows has arrived
+        if next_tick is not None:
+            await flush_ticks(engine.latest(), loop.time())
+        await ticks.put(None)
+        await emitter
+    finally:
+        emitter.cancel()
+    return stats
+
+
+class FileReplay:
+    """
+    Merged files of a subject week (session_dir with merge/) played back as a
+    live stream: an async iterable of (data_type, times_ns, values) batches,
+    released when the replay clock reaches their time stamps. The clock runs
+    speed times faster than real time from start (the first sample if None)
+    and stops at end. Gaps without data longer than skip_gap (data time)
+    are skipped. The clock is checked every tick seconds (wall time), so
+    each step releases about speed * tick seconds of data (step); modalities
+    that are later in the same step arrive after the first, so the lag of
+    run_engine should be longer than a step.
+    """
+
+    def __init__(self, session_dir, data_types=live_types, speed=60, start=None, end=None, tick=0.05,
+                 skip_gap=pd.Timedelta(minutes=5), rows=100000):
+        self.merge_dir = os.path.join(session_dir, 'merge')
+        self.data_types = [data_type for data_type in data_types if self._exists(data_type)]
+        self.speed = speed
+        self.start_ns = None if start is None else pd.Timestamp(start).value
+        self.end_ns = None if end is None else pd.Timestamp(end).value
+        self.tick = tick
+        self.skip_gap_ns = pd.Timedelta(skip_gap).value
+        self.rows = rows
+        #Data time released at once: the lag of the features should be longer
+        self.step = pd.Timedelta(seconds=speed * tick)
+
+    def _exists(self, data_type):
+        try:
+            merged_file(self.merge_dir, data_type)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _chunks(self, data_type):
+        """Chunks of one modality as (times_ns, values), inside start and end"""
+        for df in iter_merged_chunks(*merged_file(self.merge_dir, data_type), rows=self.rows):
+            times = df['Time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+            keep = np.ones(len(times), dtype=bool)
+            if self.start_ns is not None:
+                keep &= times >= self.start_ns
+            if self.end_ns is not None:
+                keep &= times <= self.end_ns
+            if keep.any():
+                yield times[keep], df[live_channels[data_type]].to_numpy(dtype=np.float64)[keep]
+            if self.end_ns is not None and len(times) and times[-1] > self.end_ns:
+                return
+
+    def __aiter__(self):
+        return self._replay()
+
+    async def _replay(self):
+        loop = asyncio.get_running_loop()
+        readers = {data_type: self._chunks(data_type) for data_type in self.data_types}
+        #Current chunk and position of each modality
+        pending = {}
+        for data_type, reader in readers.items():
+            chunk = await loop.run_in_executor(None, next, reader, None)
+            if chunk is not None:
+                pending[data_type] = [chunk[0], chunk[1], 0]
+        if not pending:
+            return
+        data0 = self.start_ns if self.start_ns is not None else min(p[0][0] for p in pending.values())
+        wall0 = loop.time()
+        skipped = 0
+        while pending:
+            now_ns = data0 + int((loop.time() - wall0) * self.speed * 1e9) + skipped
+            for data_type in list(pending):
+                times, values, pos = pending[data_type]
+                stop = int(np.searchsorted(times, now_ns, side='right'))
+                if stop > pos:
+                    yield data_type, times[pos:stop], values[pos:stop]
+                    pending[data_type][2] = stop
+                if stop == len(times):
+                    chunk = await loop.run_in_executor(None, next, readers[data_type], None)
+                    if chunk is None:
+                        del pending[data_type]
+                    else:
+                        pending[data_type] = [chunk[0], chunk[1], 0]
+            if not pending:
+                return
+            #Skip long gaps between recordings
+            next_ns = min(times[pos] for times, _, pos in pending.values())
+            if next_ns - now_ns > self.skip_gap_ns:
+                skipped += next_ns - now_ns
+            await asyncio.sleep(self.tick)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay merged E4 data as a live stream and calculate its features.')
+    parser.add_argument('--subject', required=True, help='participant number (e.g. 1, 2, 3...)')
+    parser.add_argument('--session', default='control', choices=['control', 'stress'], help='week to replay')
+    parser.add_argument('--root', default=data_root, help='folder with the subject data')
+    parser.add_argument('--speed', type=float, default=600, help='replay speed (times real time)')
+    parser.add_argument('--start', default=None, help='data time to start the replay (default: first sample)')
+    parser.add_argument('--minutes', type=float, default=None, help='minutes of data to replay (default: all)')
+    parser.add_argument('--window-minutes', type=float, default=window_minutes, help='feature window')
+    parser.add_argument('--cadence-seconds', type=float, default=cadence_seconds, help='time between feature vectors')
+    parser.add_argument('--lag-seconds', type=float, default=lag_seconds, help='wait for late modalities')
+    parser.add_argument('--out', default=None, help='save the feature vectors as CSV')
+    args = parser.parse_args(argv)
+
+    sub_ID = 'sub_' + str(args.subject).rjust(3, '0')
+    session_dir = os.path.join(args.root, "3013068.02_BaLS_" + sub_ID, "logs", "e4", args.session)
+    end = None
+    if args.minutes is not None:
+        start = pd.Timestamp(args.start) if args.start else read_first_time(session_dir)
+        end = start + pd.Timedelta(minutes=args.minutes)
+    source = FileReplay(session_dir, speed=args.speed, start=args.start, end=end)
+    #Wait at least two replay steps, so all modalities of the window have arrived
+    lag = max(pd.Timedelta(seconds=args.lag_seconds), 2 * source.step)
+    engine = LiveFeatures(pd.Timedelta(minutes=args.window_minutes), sub_ID, lag)
+    vectors = []
+
+    def on_vector(vector):
+        vectors.append(vector)
+        print('%s  hr %6.1f  ibi %6.1f  sc tonic %6.3f  temp %5.2f  acc %6.2f  latency %.3f s  dropped %d' % (
+              vector['time'], vector['hr_mean'], vector['ibi_mean'], vector['sc_tonic_mean'], vector['temp_mean'],
+              vector['acc_delta'], vector['latency_s'], vector['dropped']), flush=True)
+
+    stats = asyncio.run(run_engine(source, engine, on_vector, pd.Timedelta(seconds=args.cadence_seconds), lag))
+    print(str(stats['vectors']) + ' feature vectors, ' + str(stats['dropped']) + ' windows dropped')
+    if args.out:
+        pd.DataFrame(vectors).to_csv(args.out, index=None, header=True)
+    return 0
+
+
+def read_first_time(session_dir):
+    """Time of the first sample of a subject week (any modality)"""
+    firsts = []
+    for data_type in live_types:
+        try:
+            fullin, in_format = merged_file(os.path.join(session_dir, 'merge'), data_type)
+        except FileNotFoundError:
+            continue
+        for df in iter_merged_chunks(fullin, in_format, rows=1):
+            firsts.append(pd.Timestamp(df['Time'].iloc[0]))
+            break
+    return min(firsts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifests of the merged E4 files, so E4_Cleaner.py only merges session
+folders that have new or changed sessions.
+
+    - Each merged file has a manifest in the merge directory
+        (manifest_EDA.json for full_EDA.parquet, etc.), with the session
+        directories it was made from and the size and modification time of
+        their export file, the output format, and whether the signal store
+        was written. One manifest per data type, so parallel tasks of the
+        same week never write the same file.
+    - A rerun compares the session exports on disk with the manifest:
+        nothing changed gives 'skip', only new sessions gives 'append' (the
+        new sessions are merged into the existing sorted output), and
+        anything else (a changed or removed session, another format, a
+        missing output or store) gives 'full', a merge of all sessions.
+    - The manifest is written after the output, to a temporary file that is
+        renamed, so an interrupted merge is merged again on the next run.
+
+"""
+
+#Import Libraries
+import os, json
+
+#Version of the manifest, merges with another version are done again
+manifest_version = 1
+
+
+def source_files(filepath, dir_list, data_type):
+    """Size and modification time (ns) of the export of data_type in each session directory that has one"""
+    sources = {}
+    for k in dir_list:
+        file_name = os.path.join(filepath, k, data_type)
+        if os.path.isfile(file_name):
+            stat = os.stat(file_name)
+            sources[k] = [stat.st_size, stat.st_mtime_ns]
+    return sources
+
+
+class MergeManifest:
+    """Manifest of the merged file of one data type in a session folder (filepath)"""
+
+    def __init__(self, filepath, data_type):
+        self.merge_dir = os.path.join(filepath, 'merge')
+        self.data_type = data_type
+        self.path = os.path.join(self.merge_dir, 'manifest_' + os.path.splitext(data_type)[0] + '.json')
+        self.entry = self.read()
+
+    def read(self):
+        """Contents of the manifest, or None if there is none (or it cannot be read)"""
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('version') == manifest_version else None
+
+    def plan(self, sources, out_format, store, output):
+        """
+        What to do for the session exports in sources (see source_files):
+        ('skip', []), ('append', new session directories) or ('full', []).
+        output is the path of the merged file in out_format, and store
+        whether the signal store is needed.
+        """
+        entry = self.entry
+        full = ('full', [])
+        if entry is None or entry['format'] != out_format or not os.path.isfile(output):
+            return full
+        if store and not entry['store']:
+            return full
+        merged = entry['sessions']
+        #Sessions that were changed or removed since the merge
+        for k, source in merged.items():
+            if sources.get(k) != source:
+                return full
+        new_dirs = sorted(k for k in sources if k not in merged)
+        return ('append', new_dirs) if new_dirs else ('skip', [])
+
+    def write(self, sources, out_format, store, n_rows):
+        """Record the merged sessions, after the output was written"""
+        self.entry = {'version': manifest_version, 'data_type': self.data_type, 'format': out_format,
+                      'store': bool(store), 'n_rows': int(n_rows), 'sessions': sources}
+        os.makedirs(self.merge_dir, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entry, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Remove the manifest, so the next run merges all sessions"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.entry = None
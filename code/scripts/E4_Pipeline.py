@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the preprocessing stages in the order of the README, on any data folder
+and subset of subjects:
+
+    - ema:      EMA_Cleaner.py, cleaning the wake and sleep surveys of the
+                    Castor export
+    - merge:    E4_Cleaner.py, merging the E4 sessions of each subject week
+    - features: E4_Features.py, the features of the EMA windows
+
+Only the stages whose inputs changed do work:
+
+    - ema runs when the cleaned files are missing or older than the Castor
+        export or stress_weeks.csv.
+    - merge checks every subject week, and skips the data types whose
+        sessions did not change since the last merge (see E4_Manifest).
+    - features run for all subjects when the feature files are missing,
+        older than the cleaned EMA files, or a run was not finished (a
+        checkpoint file is left), and otherwise only for the subjects whose
+        merged files are newer than the feature files. The features of the
+        other subjects are kept.
+
+--force runs every stage again. The stages stop at the first one that fails.
+
+For array jobs on the cluster, run the merge stage per subject, as it only
+writes in the folder of the subject, and the EMA and feature stages once,
+as they write shared files:
+
+    python E4_Pipeline.py --stages ema
+    python E4_Pipeline.py --stages merge --subjects $SLURM_ARRAY_TASK_ID   (array job)
+    python E4_Pipeline.py --stages features --workers 8                    (after the array job)
+
+The stages are also functions (run_ema, run_merge, run_features,
+run_pipeline) for use from other scripts.
+
+Usage:  python E4_Pipeline.py [--root /project/3013068.02/data/] [--ema-dir /project/3013068.02/stats/EMA/]
+                              [--subjects 1 2 3] [--workers 8] [--stages ema merge features] [--force]
+"""
+
+#Import Libraries
+import os, sys, argparse
+import E4_Cleaner
+import EMA_Cleaner
+import E4_Features
+from E4_IO import merged_name, MERGE_FORMATS
+from EMA_Calendar import find_stress_weeks
+
+#Stages, in the order they run
+STAGES = ('ema', 'merge', 'features')
+#Cleaned EMA tables (EMA_Cleaner output, E4_Features input)
+ema_names = ['EMA_Clean', 'Sleep_Clean']
+
+
+class StageError(Exception):
+    """A stage that did not finish (failed tasks or subjects)"""
+
+
+def _mtimes(files):
+    """Modification times of the files that exist"""
+    return [os.path.getmtime(f) for f in files if os.path.isfile(f)]
+
+
+def is_stale(inputs, outputs):
+    """True if an output file is missing or older than the newest input file"""
+    if not all(os.path.isfile(f) for f in outputs):
+        return True
+    return max(_mtimes(inputs), default=0) > min(_mtimes(outputs))
+
+
+def sub_ID(sub_nr):
+    """Subject ID of the EMA data (sub_001) for a subject number"""
+    return 'sub_' + str(sub_nr).rjust(3, '0')
+
+
+def subject_numbers(root):
+    """Numbers of the subject folders in root"""
+    return [int(ID[len('sub_'):]) for ID in E4_Features.subject_ids(root)]
+
+
+def merged_files(sub_nr, root):
+    """Merged files of both weeks of a subject that exist"""
+    files = []
+    for session_type in E4_Cleaner.sessions:
+        merge_dir = os.path.join(E4_Cleaner.session_path(sub_nr, session_type, root), 'merge')
+        for data_type in E4_Features.data_types:
+            files += [os.path.join(merge_dir, merged_name(data_type, out_format)) for out_format in MERGE_FORMATS]
+    return [f for f in files if os.path.isfile(f)]
+
+
+def ema_clean_files(ema_dir):
+    """Cleaned EMA files (CSV and Parquet)"""
+    return [os.path.join(ema_dir, name + ext) for name in ema_names for ext in ('.csv', '.parquet')]
+
+
+def run_ema(ema_dir, file_name=EMA_Cleaner.file, force=False):
+    """Clean the Castor export in ema_dir if it changed. Returns 'done' or 'up to date'."""
+    inputs = [os.path.join(ema_dir, file_name), find_stress_weeks(ema_dir)]
+    if not force and not is_stale(inputs, ema_clean_files(ema_dir)):
+        return 'up to date'
+    EMA_Cleaner.main(['--ema-dir', ema_dir, '--file', file_name])
+    return 'done'
+
+
+def run_merge(root, subjects=None, workers=1, force=False, options=()):
+    """
+    Merge the E4 sessions of the subjects (numbers, all if None) that
+    changed, with extra E4_Cleaner options (e.g. ['--tiles']). Returns 'done'.
+    """
+    argv = ['--root', root, '--workers', str(workers)] + list(options)
+    if subjects is not None:
+        argv += ['--subjects'] + [str(sub_nr) for sub_nr in subjects]
+    if force:
+        argv.append('--force')
+    if E4_Cleaner.main(argv) != 0:
+        raise StageError('merge: some tasks failed')
+    return 'done'
+
+
+def feature_subjects(root, ema_dir, subjects=None, force=False):
+    """
+    Subjects (numbers) to extract the features of: None for all (of the
+    subjects filter) when the EMA data changed, the feature files are
+    missing or a run was not finished, otherwise the subjects whose merged
+    files are newer than the feature files (empty if nothing changed).
+    """
+    outputs = E4_Features.feature_files(ema_dir)
+    checkpoints = [os.path.splitext(f)[0] + '.checkpoint.csv' for f in outputs]
+    if force or any(os.path.isfile(f) for f in checkpoints) or is_stale(ema_clean_files(ema_dir), outputs):
+        return None
+    since = min(_mtimes(outputs))
+    candidates = subject_numbers(root) if subjects is None else subjects
+    return [sub_nr for sub_nr in candidates if max(_mtimes(merged_files(sub_nr, root)), default=0) > since]
+
+
+def run_features(root, ema_dir, subjects=None, workers=1, force=False, options=()):
+    """
+    Extract the features of the subjects (numbers, all if None) whose inputs
+    changed, with extra E4_Features options (e.g. ['--memory-gb', '32']).
+    Returns 'done' or 'up to date'.
+    """
+    changed = feature_subjects(root, ema_dir, subjects, force)
+    if changed is not None and not changed:
+        return 'up to date'
+    run = subjects if changed is None else changed
+    argv = ['--root', root, '--ema-dir', ema_dir, '--workers', str(workers)] + list(options)
+    if run is not None:
+        argv += ['--subjects'] + [sub_ID(sub_nr) for sub_nr in run]
+    if force:
+        argv.append('--no-resume')
+    if E4_Features.main(argv) != 0:
+        raise StageError('features: some subjects failed')
+    return 'done'
+
+
+def run_pipeline(root, ema_dir, stages=STAGES, subjects=None, workers=1, force=False, ema_file=EMA_Cleaner.file,
+                 merge_options=(), feature_options=()):
+    """
+    Run the stages (in pipeline order) on the data in root and ema_dir for
+    the subjects (numbers, all if None). Returns a dict with the result of
+    each stage; raises StageError for a stage that fails.
+    """
+    results = {}
+    for stage in [stage for stage in STAGES if stage in stages]:
+        print('\n== ' + stage + ' ==', flush=True)
+        if stage == 'ema':
+            results[stage] = run_ema(ema_dir, ema_file, force)
+        elif stage == 'merge':
+            results[stage] = run_merge(root, subjects, workers, force, merge_options)
+        else:
+            results[stage] = run_features(root, ema_dir, subjects, workers, force, feature_options)
+        print(stage + ': ' + results[stage], flush=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the EMA cleaning, E4 merge and feature stages.')
+    parser.add_argument('--root', default=E4_Cleaner.data_root, help='folder with the subject data')
+    parser.add_argument('--ema-dir', default=E4_Features.ema_dir, help='folder with the EMA data')
+    parser.add_argument('--ema-file', default=EMA_Cleaner.file, help='file name of the Castor export')
+    parser.add_argument('--subjects', type=int, nargs='+', default=None, help='subject numbers (default: all)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default: 1, 0 uses all cores)')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES, help='stages to run')
+    parser.add_argument('--force', action='store_true', help='run the stages again, also if nothing changed')
+    parser.add_argument('--tiles', action='store_true', help='also build the plot tiles in the merge stage')
+    parser.add_argument('--memory-gb', type=float, default=None, help='memory limit of the feature stage')
+    args = parser.parse_args(argv)
+
+    merge_options = ['--tiles'] if args.tiles else []
+    feature_options = ['--memory-gb', str(args.memory_gb)] if args.memory_gb else []
+    try:
+        run_pipeline(args.root, args.ema_dir, args.stages, args.subjects, args.workers, args.force, args.ema_file,
+                     merge_options, feature_options)
+    except StageError as error:
+        print('\nStopped: ' + str(error))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,92 +2,164 @@
 # -*- coding: utf-8 -*-
 """
 This script will plot an E4 session for a given subject and session
+
+The signals are drawn from multi-resolution tiles (see E4_Tiles), built from
+the merged files the first time a session is plotted: the whole week is
+shown as the mean per bin with a min/max band, and finer tiles (down to the
+samples themselves) are loaded when zooming in. Select a time range with the
+mouse on any plot to zoom in, press Reset to show the whole week again.
+
+The subject and week can be given on the command line, otherwise they are
+asked for. plot_session makes the figure without showing it, for use from
+other scripts.
+
+Usage:  python E4_Plots.py [--subject 1] [--session control] [--root /project/3013068.02/data/]
 """
 #Import Libraries
-import os
+import os, sys, argparse
 import readline
 import numpy as np
 import pandas as pd
 import datetime as dt
 from datetime import datetime, timedelta
+from E4_Tiles import TilePyramid
 import matplotlib
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button, RadioButtons
 from matplotlib.widgets import SpanSelector
 
 #Turnoff write warning in Pandas
-pd.options.mode.chained_assignment = None  
-          
-#Input
-sub = input ("\nParticipant number? ( e.g. 1 , 2, 3...): ")
-session_type= input('\nSession (control or stress): ')
-sub_nr = sub.rjust (3, '0')
-print ("\nLoading...")
-
-#Set file path, and import IBI, HR, SCR File
-filepath1 = ("/project/3013068.02/data/3013068.02_BaLS_sub_" + sub_nr+ "/logs/e4/"+str(session_type) + "/merge")
-os.chdir (str(filepath1))
-#IBI
-df_IBI=pd.read_csv("full_IBI.csv", sep='\t')
-df_IBI['Time']=pd.to_datetime(df_IBI['Time'], format='%Y-%m-%d %H:%M:%S')
-df_IBI=df_IBI.set_index('Time')
-df_IBI=df_IBI.resample('1S').fillna('ffill', limit=600) # resample and inteprolate
-#HR
-df_HR= pd.read_csv("full_HR.csv", sep='\t')
-df_HR['Time']=pd.to_datetime(df_HR['Time'], format='%Y-%m-%d %H:%M:%S')
-df_HR=df_HR.set_index('Time')
-df_HR=df_HR.resample("1S").asfreq() # Resample 1HZ
-#SCR
-df_SCR= pd.read_csv("full_EDA.csv", sep='\t')
-df_SCR['Time']=pd.to_datetime(df_SCR['Time'], format='%Y-%m-%d %H:%M:%S')
-df_SCR=df_SCR.set_index('Time')
-df_SCR=df_SCR.resample("250L").asfreq()#Resample 4HZ
-#Temp
-df_temp= pd.read_csv("full_TEMP.csv", sep='\t')
-df_temp['Time']=pd.to_datetime(df_temp['Time'], format='%Y-%m-%d %H:%M:%S')
-df_temp=df_temp.set_index('Time')
-df_temp=df_temp.resample('250L').asfreq() #Resample 4HZ
-#ACC
-df_acc= pd.read_csv("full_ACC.csv", sep='\t')
-df_acc['Time']=pd.to_datetime(df_acc['Time'], format='%Y-%m-%d %H:%M:%S')
-df_acc=df_acc.set_index('Time')
-df_acc=df_acc.resample('31250us').asfreq() # Resample 32HZ
-# Plots
-Title=('E4 Data\nSubject ' + sub_nr +', '+session_type +' week')
-plt.rcParams["font.family"] = 'Cambria'
-plt.style.use('ggplot')
-# Plot
-fig, axs = plt.subplots(5, sharex=True)
-fig.suptitle(Title)
-
-# HR
-axs[0].plot(df_HR.index.values, df_HR.Data, 'purple', )
-axs[0].grid(b=True, which='both', axis='both', color='lightgrey', markevery=5)
-axs[0].set(xlabel=' ', ylabel='Heart Rate')
-axs[0].set_ylim(ymin=50, ymax=160)
-# IBI
-axs[1].plot(df_IBI.index.values, df_IBI.Data, 'steelblue')
-axs[1].grid(b=True, which='both', axis='both', color='lightgrey', markevery=5) 
-axs[1].set(xlabel=' ', ylabel='IBI (ms)')
-# SCR
-axs[2].plot(df_SCR.index.values, df_SCR.Data, 'gold')
-axs[2].grid(b=False, which='both', axis='both', color='lightgrey', markevery=5) 
-axs[2].set(xlabel=' ', ylabel='SC ($\mu$S)')
-axs[2].set_ylim(ymin=-5, ymax=10)
-# Temp
-axs[3].plot(df_temp.index.values, df_temp.Data, 'tomato')
-axs[3].grid(b=True, which='both', axis='both', color='lightgrey', markevery=5)
-axs[3].set(xlabel=' ', ylabel='Temp ($^\circ$C)')
-axs[3].set_ylim(ymin=15, ymax=45)
-# ACC
-axs[4].plot(df_acc.index.values, df_acc.ACC_X, 'blue', alpha=0.4)
-axs[4].plot(df_acc.index.values, df_acc.ACC_Y, 'red', alpha=0.4)
-axs[4].plot(df_acc.index.values, df_acc.ACC_Z, 'green', alpha=0.4)
-axs[4].grid(b=True, which='both', axis='both', color='lightgrey', markevery=5)
-axs[4].set(xlabel='Time', ylabel='ACC')
-axs[4].set_ylim(ymin=-10)
-
-# Plot
-plt.show()
+pd.options.mode.chained_assignment = None
+
+#Folder with the subject data
+data_root = "/project/3013068.02/data/"
+
+
+def plot_session(sub, session_type, root=data_root):
+    """
+    Figure of the E4 data of a subject (number) and week ('control' or
+    'stress'), drawn from the tiles of the merged files. The zoom selectors
+    and Reset button are kept in fig.widgets. Returns the figure.
+    """
+    sub_nr = str(sub).rjust (3, '0')
+
+    #Set session path, and load the tiles of HR, IBI, SCR, Temp and ACC (built from the merged files if needed)
+    filepath1 = os.path.join(root, "3013068.02_BaLS_sub_" + sub_nr, "logs", "e4", str(session_type))
+    tiles_HR = TilePyramid(filepath1, 'HR')
+    tiles_IBI = TilePyramid(filepath1, 'IBI')
+    tiles_SCR = TilePyramid(filepath1, 'EDA')
+    tiles_temp = TilePyramid(filepath1, 'TEMP')
+    tiles_acc = TilePyramid(filepath1, 'ACC')
+    #Whole week
+    bounds = [tiles.bounds() for tiles in [tiles_HR, tiles_IBI, tiles_SCR, tiles_temp, tiles_acc]]
+    week_start = min(start for start, _ in bounds if start is not None)
+    week_end = max(end for _, end in bounds if end is not None)
+
+    # Plots
+    Title=('E4 Data\nSubject ' + sub_nr +', '+session_type +' week')
+    plt.rcParams["font.family"] = 'Cambria'
+    plt.style.use('ggplot')
+    # Plot
+    fig, axs = plt.subplots(5, sharex=True)
+    fig.suptitle(Title)
+
+    #Panels: axis, tiles, and a colour (and transparency) per channel
+    panels = [(axs[0], tiles_HR, ['purple'], 1),
+              (axs[1], tiles_IBI, ['steelblue'], 1),
+              (axs[2], tiles_SCR, ['gold'], 1),
+              (axs[3], tiles_temp, ['tomato'], 1),
+              (axs[4], tiles_acc, ['blue', 'red', 'green'], 0.4)]
+    lines = [[ax.plot([], [], color, alpha=alpha)[0] for color in colors] for ax, _, colors, alpha in panels]
+    bands = [[] for _ in panels]
+    shown = [None]
+
+    def draw(start, end):
+        """Draw the tiles (or samples) of the time range start to end in all panels"""
+        if shown[0] == (start, end):
+            return
+        shown[0] = (start, end)
+        for n, (ax, tiles, colors, alpha) in enumerate(panels):
+            view = tiles.view(start, end)
+            for band in bands[n]:
+                band.remove()
+            bands[n] = []
+            for ch, color in enumerate(colors):
+                lines[n][ch].set_data(view['time'], view['mean'][:, ch])
+                #Range of the samples in each bin
+                if view['level'] is not None:
+                    bands[n].append(ax.fill_between(view['time'], view['min'][:, ch], view['max'][:, ch],
+                                                    color=color, alpha=alpha * 0.3, linewidth=0))
+        fig.canvas.draw_idle()
+
+    def on_xlim(ax):
+        """Load the tiles of the visible range after zooming or panning"""
+        xmin, xmax = ax.get_xlim()
+        draw(pd.Timestamp(mdates.num2date(xmin)).tz_localize(None), pd.Timestamp(mdates.num2date(xmax)).tz_localize(None))
+
+    def on_select(xmin, xmax):
+        """Zoom in on the range selected with the mouse"""
+        if xmax > xmin:
+            axs[0].set_xlim(xmin, xmax)
+
+    def on_reset(event):
+        """Show the whole week again"""
+        axs[0].set_xlim(week_start, week_end)
+
+    #Whole week first
+    draw(pd.Timestamp(week_start), pd.Timestamp(week_end))
+    for ax in axs:
+        ax.relim()
+        ax.autoscale_view()
+    axs[0].set_xlim(week_start, week_end)
+
+    # HR
+    axs[0].grid(True, which='both', axis='both', color='lightgrey', markevery=5)
+    axs[0].set(xlabel=' ', ylabel='Heart Rate')
+    axs[0].set_ylim(ymin=50, ymax=160)
+    # IBI
+    axs[1].grid(True, which='both', axis='both', color='lightgrey', markevery=5)
+    axs[1].set(xlabel=' ', ylabel='IBI (ms)')
+    # SCR
+    axs[2].grid(False, which='both', axis='both', color='lightgrey', markevery=5)
+    axs[2].set(xlabel=' ', ylabel='SC ($\mu$S)')
+    axs[2].set_ylim(ymin=-5, ymax=10)
+    # Temp
+    axs[3].grid(True, which='both', axis='both', color='lightgrey', markevery=5)
+    axs[3].set(xlabel=' ', ylabel='Temp ($^\circ$C)')
+    axs[3].set_ylim(ymin=15, ymax=45)
+    # ACC
+    axs[4].grid(True, which='both', axis='both', color='lightgrey', markevery=5)
+    axs[4].set(xlabel='Time', ylabel='ACC')
+    axs[4].set_ylim(ymin=-10)
+
+    #Zoom: select a range on any plot, or use the toolbar. Shared axes only report changes to the axis used
+    for ax in axs:
+        ax.callbacks.connect('xlim_changed', on_xlim)
+    selectors = [SpanSelector(ax, on_select, 'horizontal', useblit=True) for ax in axs]
+    reset_button = Button(fig.add_axes([0.9, 0.01, 0.08, 0.04]), 'Reset')
+    reset_button.on_clicked(on_reset)
+    #Widgets only respond while they are referenced
+    fig.widgets = selectors + [reset_button]
+    return fig
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plot the E4 data of a subject and week.')
+    parser.add_argument('--subject', default=None, help='participant number (e.g. 1, 2, 3...), asked if not given')
+    parser.add_argument('--session', default=None, choices=['control', 'stress'], help='week, asked if not given')
+    parser.add_argument('--root', default=data_root, help='folder with the subject data')
+    args = parser.parse_args(argv)
+
+    #Input
+    sub = args.subject or input ("\nParticipant number? ( e.g. 1 , 2, 3...): ")
+    session_type = args.session or input('\nSession (control or stress): ')
+    print ("\nLoading...")
+    plot_session(sub, session_type, args.root)
+    # Plot
+    plt.show()
+    return 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Types of the merged E4 signals, used when E4_Cleaner.py writes the merged
+files (Parquet/Feather) and when E4_Features.py and E4_Plots.py load them,
+so that several subjects fit in the memory of one worker.
+
+    - ACC as int8: the E4 stores acceleration as whole counts of 1/64 g
+        (-128 to 127), so three int8 columns hold the same values as three
+        floats in a quarter (float32) or an eighth (float64) of the memory.
+        ACC that does not fit (missing or fractional values) stays float32.
+    - EDA, TEMP, HR, BVP and IBI as float32, the precision of the sensors.
+    - Time as datetime64[ns], which pandas stores as int64 nanoseconds since
+        epoch, so windowing by binary search and the time axes of the plots
+        work on it directly.
+
+Older merged files (float32 ACC, or tab separated CSV with float64 columns)
+are converted to the schema when they are read. The memory of the data of a
+subject as the old float64 frames, as stored, and with the schema can be
+reported with:
+
+Usage:  python E4_Schema.py --subject 1 [--root /project/3013068.02/data/]
+"""
+
+#Import Libraries
+import os, sys, argparse
+import numpy as np
+import pandas as pd
+
+#Type of the time column (int64 ns since epoch)
+TIME_DTYPE = np.dtype('datetime64[ns]')
+#Type of the signal columns per data type
+SCHEMA = {'ACC': np.dtype(np.int8), 'EDA': np.dtype(np.float32), 'TEMP': np.dtype(np.float32),
+          'HR': np.dtype(np.float32), 'BVP': np.dtype(np.float32), 'IBI': np.dtype(np.float32)}
+#Type of signals that do not fit their schema type, and of unknown data types
+FALLBACK_DTYPE = np.dtype(np.float32)
+#Signal columns per data type
+CHANNELS = {'ACC': ['ACC_X', 'ACC_Y', 'ACC_Z']}
+#Folder with the subject data
+data_root = "/project/3013068.02/data/"
+
+
+def type_name(data_type):
+    """Data type without extension, e.g. 'ACC.csv' -> 'ACC'"""
+    return os.path.splitext(data_type)[0]
+
+
+def fits(values, dtype):
+    """True if the values can be stored as dtype without changing them"""
+    values = np.asarray(values)
+    if values.dtype == dtype or np.issubdtype(dtype, np.floating) or values.size == 0:
+        return True
+    if not np.issubdtype(values.dtype, np.number):
+        return False
+    info = np.iinfo(dtype)
+    if np.issubdtype(values.dtype, np.integer):
+        return values.size == 0 or (values.min() >= info.min and values.max() <= info.max)
+    return bool(np.all(np.isfinite(values)) and np.all(values == np.round(values))
+                and (values.size == 0 or (values.min() >= info.min and values.max() <= info.max)))
+
+
+def signal_dtype(data_type, df=None):
+    """Type of the signal columns of a data type, for the data frame df if given (fallback if it does not fit)"""
+    dtype = SCHEMA.get(type_name(data_type), FALLBACK_DTYPE)
+    if df is not None and not all(fits(df[col].to_numpy(), dtype) for col in df.columns if col != 'Time'):
+        return FALLBACK_DTYPE
+    return dtype
+
+
+def apply_schema(df, data_type, dtype=None):
+    """
+    Data frame of a data type with the types of the schema: datetime64[ns]
+    time and the signal type (signal_dtype, or dtype if given). Columns that
+    already have their type are not copied.
+    """
+    dtype = signal_dtype(data_type, df) if dtype is None else np.dtype(dtype)
+    types = {col: dtype for col in df.columns if col != 'Time' and df[col].dtype != dtype}
+    if 'Time' in df.columns and df['Time'].dtype != TIME_DTYPE:
+        types['Time'] = TIME_DTYPE
+        if not pd.api.types.is_datetime64_any_dtype(df['Time']):
+            df = df.assign(Time=pd.to_datetime(df['Time']))
+    return df.astype(types) if types else df
+
+
+def row_bytes(data_type):
+    """Bytes per row in memory with the schema (time and signal columns)"""
+    channels = CHANNELS.get(type_name(data_type), ['Data'])
+    return TIME_DTYPE.itemsize + len(channels) * SCHEMA.get(type_name(data_type), FALLBACK_DTYPE).itemsize
+
+
+def frame_mb(df):
+    """Memory of a data frame in MB (with its index)"""
+    return df.memory_usage(index=True, deep=True).sum() / 1024**2
+
+
+def float64_mb(df):
+    """Memory of a data frame in MB if all its signal columns were float64, as the old merged frames"""
+    return (len(df) * 8 * len(df.columns) + df.index.memory_usage()) / 1024**2
+
+
+def memory_report(merge_dirs, data_types=tuple(SCHEMA)):
+    """
+    Memory (MB) of the merged data of each data type in merge_dirs: as
+    float64 frames, as stored in the files, and with the schema. Returns a
+    data frame with one row per data type and a total row.
+    """
+    from E4_IO import merged_file, read_merged
+    rows = []
+    for data_type in data_types:
+        row = {'data_type': data_type, 'rows': 0, 'float64_mb': 0.0, 'stored_mb': 0.0, 'schema_mb': 0.0}
+        for merge_dir in merge_dirs:
+            try:
+                merged_file(merge_dir, data_type)
+            except FileNotFoundError:
+                continue
+            stored = read_merged(merge_dir, data_type, schema=False)
+            row['rows'] += len(stored)
+            row['float64_mb'] += float64_mb(stored)
+            row['stored_mb'] += frame_mb(stored)
+            row['schema_mb'] += frame_mb(apply_schema(stored, data_type))
+        rows.append(row)
+    report = pd.DataFrame(rows)
+    total = report.sum(numeric_only=True)
+    total['data_type'] = 'total'
+    return pd.concat([report, total.to_frame().T], ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report the memory of the merged E4 data of a subject with the schema.')
+    parser.add_argument('--subject', required=True, help='participant number (e.g. 1, 2, 3...)')
+    parser.add_argument('--root', default=data_root, help='folder with the subject data')
+    args = parser.parse_args(argv)
+
+    import E4_Features
+    sub_ID = 'sub_' + str(args.subject).rjust(3, '0')
+    report = memory_report(E4_Features.subject_merge_dirs(sub_ID, args.root))
+    print('%-6s %12s %12s %12s %12s' % ('type', 'rows', 'float64 MB', 'stored MB', 'schema MB'))
+    for _, row in report.iterrows():
+        print('%-6s %12d %12.1f %12.1f %12.1f' % (row['data_type'], row['rows'], row['float64_mb'], row['stored_mb'],
+                                                 row['schema_mb']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped store of the merged E4 signals, built by E4_Cleaner.py with
+--store. For each evenly sampled data type (EDA, TEMP, BVP, HR, ACC) of a
+subject session folder, the store holds:
+
+    - <TYPE>.npy: float32 array (samples x channels) on a fixed sampling
+        grid from the first to the last sample of the week. Time between
+        E4 sessions is filled with NaN, so the sample number of any time is
+        (time - start time) * sampling frequency.
+    - <TYPE>.json: start time (ns since epoch), sampling frequency, channel
+        names, the sample ranges recorded by the E4 (the gaps between
+        sessions are the ranges in between), and the number of samples that
+        did not fit the grid: samples on a grid index that already had one
+        (overlapping sessions, only the last is kept) and samples whose time
+        is not the time of their grid index (sessions out of phase with the
+        first). E4_Cleaner.py reports these, and the store is only read in
+        place of the merged file if there are none (see read_store).
+
+Both files are written to a temporary file that is renamed, so a store that
+is being read is never changed in place, and an interrupted write leaves the
+old store. Windows are read with np.load(mmap_mode='r'), so a window is a
+slice of the file on disk (no copy, and only the pages of the window are
+read). IBI is not evenly sampled, and is not part of the store.
+
+"""
+
+#Import Libraries
+import os, json
+import numpy as np
+import pandas as pd
+
+#Data types in the store, with their channels
+store_channels = {'EDA': ['Data'], 'TEMP': ['Data'], 'BVP': ['Data'], 'HR': ['Data'],
+                  'ACC': ['ACC_X', 'ACC_Y', 'ACC_Z']}
+
+
+def _type_name(data_type):
+    """Data type without file extension, e.g. 'EDA.csv' -> 'EDA'"""
+    return os.path.splitext(data_type)[0]
+
+
+def write_store(df, store_dir, data_type, samp_freq=None):
+    """
+    Write the merged data frame of one data type to the store directory.
+    samp_freq is taken from the median time between samples if not given.
+    Returns the path of the array file.
+    """
+    times = df['Time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+    if samp_freq is None:
+        #E4 rates are whole numbers of Hz
+        samp_freq = float(np.round(1e9 / np.median(np.diff(times)))) if len(times) > 1 else 1.0
+    if len(times) == 0:
+        return write_store_chunks([], store_dir, data_type, None, None, samp_freq)
+    return write_store_chunks([df], store_dir, data_type, int(times[0]), int(times[-1]), samp_freq)
+
+
+def write_store_chunks(chunks, store_dir, data_type, start_ns, end_ns, samp_freq):
+    """
+    Write the merged data of one data type to the store directory from data
+    frames in time order (e.g. chunks of a file too large for memory).
+    start_ns and end_ns are the first and last time stamp (ns since epoch),
+    which fix the size of the array. Returns the path of the array file.
+    """
+    name = _type_name(data_type)
+    channels = store_channels[name]
+    os.makedirs(store_dir, exist_ok=True)
+    period_ns = 1e9 / samp_freq
+    start_ns = int(start_ns) if start_ns is not None else 0
+    n_samples = int(np.rint((end_ns - start_ns) / period_ns)) + 1 if end_ns is not None else 0
+
+    #Write the array to a temporary file, NaN between sessions
+    fullout = os.path.join(store_dir, name + '.npy')
+    tmp_out = os.path.join(store_dir, name + '.tmp.npy')
+    values = np.lib.format.open_memmap(tmp_out, mode='w+', dtype=np.float32, shape=(n_samples, len(channels)))
+    values[:] = np.nan
+    #Sample ranges recorded by the E4: split where samples are more than one step apart
+    segments = []
+    n_rows = 0
+    #Samples on a grid index at or before the highest index so far, and samples off the grid
+    n_overlap = 0
+    n_misaligned = 0
+    max_index = -1
+    for df in chunks:
+        if len(df) == 0:
+            continue
+        times = df['Time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+        #Sample number of each sample on the fixed grid from the first sample
+        index = np.rint((times - start_ns) / period_ns).astype(np.int64)
+        highest = np.maximum.accumulate(np.concatenate([[max_index], index]))
+        n_overlap += int(np.count_nonzero(index <= highest[:-1]))
+        n_misaligned += int(np.count_nonzero(times != start_ns + np.rint(index * period_ns).astype(np.int64)))
+        max_index = int(highest[-1])
+        n_rows += len(df)
+        for ch, col in enumerate(channels):
+            values[index, ch] = df[col].to_numpy(dtype=np.float32)
+        breaks = np.nonzero(np.diff(index) > 1)[0]
+        firsts = np.concatenate([[index[0]], index[breaks + 1]])
+        stops = np.concatenate([index[breaks] + 1, [index[-1] + 1]])
+        for a, b in zip(firsts, stops):
+            if segments and a <= segments[-1][1]:
+                segments[-1][1] = max(segments[-1][1], int(b))
+            else:
+                segments.append([int(a), int(b)])
+    values.flush()
+    del values
+    os.replace(tmp_out, fullout)
+
+    meta = {'data_type': name, 'start_ns': start_ns, 'samp_freq': samp_freq, 'n_samples': n_samples,
+            'channels': channels, 'segments': segments, 'n_rows': n_rows, 'overlap_samples': n_overlap,
+            'misaligned_samples': n_misaligned}
+    meta_path = os.path.join(store_dir, name + '.json')
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_path + '.tmp', meta_path)
+    return fullout
+
+
+def store_issues(store_dir, data_type):
+    """
+    Samples of the merged data that the store of a data type does not hold
+    as they are, as a message (e.g. '12 samples overlap'), or None if the
+    store holds all samples (or there is no store).
+    """
+    try:
+        with open(os.path.join(store_dir, _type_name(data_type) + '.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    issues = []
+    if meta.get('overlap_samples'):
+        issues.append(str(meta['overlap_samples']) + ' samples overlap')
+    if meta.get('misaligned_samples'):
+        issues.append(str(meta['misaligned_samples']) + ' samples out of phase')
+    return ', '.join(issues) if issues else None
+
+
+class SignalStore:
+    """
+    Read access to one data type in a store directory. values is the
+    memory-mapped (samples x channels) array, time windows are turned into
+    sample ranges by arithmetic.
+    """
+
+    def __init__(self, store_dir, data_type):
+        name = _type_name(data_type)
+        with open(os.path.join(store_dir, name + '.json')) as f:
+            self.meta = json.load(f)
+        self.values = np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r')
+        self.start_ns = self.meta['start_ns']
+        self.samp_freq = self.meta['samp_freq']
+        self.channels = self.meta['channels']
+        self.segments = self.meta['segments']
+        self.period_ns = 1e9 / self.samp_freq
+        #Whether the store holds every merged sample at its own time (unknown for older stores)
+        self.exact = self.meta.get('overlap_samples') == 0 and self.meta.get('misaligned_samples') == 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def _offset(self, time):
+        """Time in samples from the start of the store (float)"""
+        time_ns = pd.Timestamp(time).to_datetime64().astype('datetime64[ns]').astype(np.int64)
+        return (time_ns - self.start_ns) / self.period_ns
+
+    def bounds(self, start_time, end_time):
+        """Sample range (first, stop) with start_time < time < end_time"""
+        first = int(np.floor(self._offset(start_time))) + 1
+        stop = int(np.ceil(self._offset(end_time)))
+        first = min(max(first, 0), len(self))
+        stop = min(max(stop, first), len(self))
+        return first, stop
+
+    def window(self, start_time, end_time, channel=None):
+        """
+        Values with start_time < time < end_time, as a slice of the memory
+        mapped array (no copy). Samples between sessions are NaN. channel
+        selects one channel by name, otherwise all channels are returned.
+        """
+        first, stop = self.bounds(start_time, end_time)
+        values = self.values[first:stop]
+        if channel is not None:
+            values = values[:, self.channels.index(channel)]
+        return values
+
+    def times(self, first, stop):
+        """Time stamps of the samples first to stop, as datetime64[ns]"""
+        return self.index_times(np.arange(first, stop))
+
+    def index_times(self, index):
+        """Time stamps of the samples with these sample numbers, as datetime64[ns]"""
+        offsets = np.rint(np.asarray(index) * self.period_ns).astype(np.int64)
+        return (self.start_ns + offsets).astype('datetime64[ns]')
+
+    def recorded(self, ranges=None):
+        """
+        Samples recorded by the E4 (inside the segments) as a data frame with
+        the channel and time columns, as the merged file. With ranges, a list
+        of (start, end) times, only the samples with start <= time <= end
+        are copied from the array.
+        """
+        if ranges is None:
+            bounds = [(0, len(self))]
+        else:
+            bounds = [(int(np.ceil(self._offset(start))), int(np.floor(self._offset(end))) + 1) for start, end in ranges]
+        #Parts of the segments inside the ranges, in time order (ranges that overlap are read once)
+        parts = sorted((max(a, first), min(b, stop)) for first, stop in bounds for a, b in self.segments
+                       if min(b, stop) > max(a, first))
+        joined = []
+        for a, b in parts:
+            if joined and a <= joined[-1][1]:
+                joined[-1][1] = max(joined[-1][1], b)
+            else:
+                joined.append([a, b])
+        if joined:
+            index = np.concatenate([np.arange(a, b) for a, b in joined])
+            values = np.concatenate([self.values[a:b] for a, b in joined])
+        else:
+            index = np.array([], dtype=np.int64)
+            values = np.empty((0, len(self.channels)), dtype=np.float32)
+        #Time column last, as in the merged files of the evenly sampled signals
+        df = pd.DataFrame(values, columns=self.channels)
+        df['Time'] = self.index_times(index)
+        return df
+
+
+def read_store(store_dir, data_type, ranges=None, merged_path=None):
+    """
+    Samples of one data type from a store directory (see SignalStore.recorded),
+    or None if the store cannot stand in for the merged file: there is no
+    store for the data type, it does not hold every merged sample at its own
+    time, or it is older than the merged file merged_path (e.g. sessions
+    were added without --store).
+    """
+    name = _type_name(data_type)
+    meta_path = os.path.join(store_dir, name + '.json')
+    if name not in store_channels or not os.path.isfile(meta_path):
+        return None
+    if merged_path is not None and os.stat(meta_path).st_mtime_ns < os.stat(merged_path).st_mtime_ns:
+        return None
+    store = SignalStore(store_dir, data_type)
+    if not store.exact or len(store) != store.meta['n_samples']:
+        return None
+    return store.recorded(ranges)
+
+
+def build_store(full_df, session_dir, data_type):
+    """Store one merged data type of a subject session folder in its store directory, if evenly sampled"""
+    if _type_name(data_type) not in store_channels or len(full_df) == 0:
+        return None
+    return write_store(full_df, os.path.join(session_dir, 'store'), data_type)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming merge of E4 session exports, for E4_Cleaner.py --stream. Sessions
+are read in chunks of a fixed number of rows and each chunk is written to
+the merged file right away, so the memory used does not grow with the
+length of the recordings.
+
+    - The two header lines of an evenly sampled export (start time, sampling
+        frequency) are read first, and the time stamps of each chunk are
+        calculated from its first sample number (see E4_IO.make_time_axis).
+        IBI exports have one header line, and the time of each beat is the
+        start time plus its onset.
+    - Sessions are written in the order of their start times. A chunk that
+        starts before the end of the data written so far (overlapping
+        sessions) stops the streaming merge with SessionOverlapError, so the
+        caller can merge that week in memory instead.
+    - The memory-mapped signal store (see E4_Store) is filled in a second
+        pass over the merged file, also in chunks.
+    - The output is written to a temporary file and renamed when complete,
+        as Parquet (row groups per chunk), Feather (Arrow IPC record
+        batches) or tab separated CSV, with the same columns and types as
+        E4_IO.write_merged (E4_Schema). ACC is written as int8 while its
+        chunks fit; the file is rewritten as float32 at the first chunk that
+        does not.
+
+"""
+
+#Import Libraries
+import os, json
+import numpy as np
+import pandas as pd
+from E4_IO import make_time_axis, merged_name, remove_other_formats, MERGE_FORMATS
+from E4_Store import store_channels, write_store_chunks, _type_name
+from E4_Schema import apply_schema, signal_dtype, FALLBACK_DTYPE
+
+#Rows per chunk (1M rows of ACC are about 50 MB in memory)
+chunk_rows = 1000000
+
+
+class SessionOverlapError(Exception):
+    """Sessions overlap in time, so they cannot be merged by streaming"""
+
+
+def read_header(file_name):
+    """
+    Start time (unix epoch, s) and sampling frequency (Hz) from the header of
+    an E4 export. The sampling frequency is None for IBI exports.
+    """
+    with open(file_name) as f:
+        first = f.readline().split(',')
+        second = f.readline().split(',')
+    start_time = float(first[0])
+    if len(first) > 1 and first[1].strip() == 'IBI':
+        return start_time, None
+    return start_time, float(second[0])
+
+
+def read_session_chunks(file_name, data_type, rows=chunk_rows):
+    """
+    Data frames of rows samples of one session export, with time stamps and
+    the columns of the in-memory merge (Data and Time, ACC_X/Y/Z and Time, or
+    Time and Data for IBI in ms). Empty files give no chunks.
+    """
+    if os.stat(file_name).st_size == 0:
+        return
+    start_time, samp_freq = read_header(file_name)
+
+    if data_type == 'IBI.csv':
+        for df in pd.read_csv(file_name, sep=',', header=None, skiprows=1, names=['Time', 'Data'], chunksize=rows):
+            df['Time'] = pd.to_datetime(start_time + df['Time'], unit='s')
+            df['Data'] = df['Data']*1000
+            yield df.reset_index(drop=True)
+        return
+
+    names = ['ACC_X', 'ACC_Y', 'ACC_Z'] if data_type == 'ACC.csv' else ['Data']
+    first_sample = 0
+    #Float columns, as the in-memory merge (which reads the header rows as data)
+    for df in pd.read_csv(file_name, sep=',', header=None, skiprows=2, names=names,
+                          usecols=range(len(names)), dtype=np.float64, chunksize=rows):
+        df['Time'] = make_time_axis(start_time, samp_freq, len(df), first_sample)
+        first_sample += len(df)
+        yield df.reset_index(drop=True)
+
+
+class MergedSink:
+    """
+    Merged output file written chunk by chunk. Chunks must come in time
+    order. close() moves the complete file into place and removes files of
+    the same data type in other formats, abort() removes the partial file.
+    """
+
+    def __init__(self, merge_dir, data_type, out_format='parquet'):
+        if out_format not in MERGE_FORMATS:
+            raise ValueError('Unknown output format: ' + str(out_format))
+        self.merge_dir = merge_dir
+        self.data_type = data_type
+        self.out_format = out_format
+        self.path = os.path.join(merge_dir, merged_name(data_type, out_format))
+        self.tmp_path = self.path + '.tmp'
+        self.writer = None
+        self.n_rows = 0
+        #First and last time stamp written (ns since epoch)
+        self.first_ns = None
+        self.last_ns = None
+        #Type of the signal columns in the file (E4_Schema)
+        self.dtype = None
+
+    def _widen(self):
+        """Rewrite the chunks written so far with the fallback signal type, for a chunk that does not fit the schema"""
+        import pyarrow as pa
+        self.writer.close()
+        self.writer = None
+        if self.out_format == 'parquet':
+            import pyarrow.parquet as pq
+            table = pq.read_table(self.tmp_path)
+        else:
+            with pa.OSFile(self.tmp_path, 'rb') as source:
+                table = pa.ipc.open_file(source).read_all()
+        self.dtype = FALLBACK_DTYPE
+        fields = [pa.field(name, pa.from_numpy_dtype(self.dtype)) if name != 'Time' else table.schema.field(name)
+                  for name in table.column_names]
+        table = table.cast(pa.schema(fields))
+        if self.out_format == 'parquet':
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            self.writer.write_table(table, row_group_size=2**16)
+        else:
+            self.writer = pa.ipc.new_file(self.tmp_path, table.schema)
+            self.writer.write_table(table)
+
+    def write(self, df):
+        """Append one chunk"""
+        if len(df) == 0:
+            return
+        times = df['Time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+        if (self.last_ns is not None and times[0] < self.last_ns) or np.any(times[1:] < times[:-1]):
+            raise SessionOverlapError(self.data_type + ' sessions overlap or are not in time order')
+        if self.first_ns is None:
+            self.first_ns = int(times[0])
+        self.last_ns = int(times[-1])
+
+        if self.out_format == 'csv':
+            df.to_csv(self.tmp_path, sep='\t', index=False, mode='w' if self.n_rows == 0 else 'a',
+                      header=self.n_rows == 0)
+        else:
+            import pyarrow as pa
+            #Typed columns of the schema, with the signal type of the first chunk
+            if self.dtype is None:
+                self.dtype = signal_dtype(self.data_type, df)
+            elif self.dtype != FALLBACK_DTYPE and signal_dtype(self.data_type, df) == FALLBACK_DTYPE:
+                self._widen()
+            df = apply_schema(df, self.data_type, self.dtype)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                if self.out_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.tmp_path, table.schema)
+            if self.out_format == 'parquet':
+                #Row groups of 65536 rows, as write_merged
+                self.writer.write_table(table, row_group_size=2**16)
+            else:
+                self.writer.write_table(table)
+        self.n_rows += len(df)
+
+    def close(self):
+        """Finish the file and move it into place. Returns its path, or None if nothing was written"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.n_rows == 0:
+            return None
+        os.replace(self.tmp_path, self.path)
+        remove_other_formats(self.merge_dir, self.data_type, self.out_format)
+        return self.path
+
+    def abort(self):
+        """Remove the partial file"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def iter_merged_chunks(path, out_format, rows=chunk_rows):
+    """Read a merged file back in chunks of rows"""
+    if out_format == 'csv':
+        for df in pd.read_csv(path, sep='\t', chunksize=rows):
+            df['Time'] = pd.to_datetime(df['Time'])
+            yield df
+        return
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format='parquet' if out_format == 'parquet' else 'ipc')
+    for batch in dataset.to_batches(batch_size=rows):
+        yield batch.to_pandas()
+
+
+def _store_freq(filepath, data_type, files):
+    """Sampling frequency for the store: from the header of the first session, or the existing store"""
+    if files:
+        return read_header(files[0])[1]
+    try:
+        with open(os.path.join(filepath, 'store', _type_name(data_type) + '.json')) as f:
+            return json.load(f)['samp_freq']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def stream_merge(filepath, dir_list, data_type, out_format='parquet', rows=chunk_rows, store=False, existing=None):
+    """
+    Merge the exports of one data type from the session directories dir_list
+    of a session folder into its merge directory, chunk by chunk, and fill
+    the signal store if store is True. existing is a merged file in
+    out_format whose rows come before the sessions (to add new sessions to
+    an earlier merge). Returns the sink (path, number of rows, first and
+    last time), or raises SessionOverlapError (nothing is written then).
+    """
+    merge_dir = os.path.join(filepath, 'merge')
+    os.makedirs(merge_dir, exist_ok=True)
+
+    #Sessions with data, in order of their start time
+    files = [os.path.join(filepath, k, data_type) for k in dir_list]
+    files = [f for f in files if os.path.isfile(f) and os.stat(f).st_size != 0]
+    files.sort(key=lambda f: read_header(f)[0])
+
+    sink = MergedSink(merge_dir, data_type, out_format)
+    try:
+        if existing is not None:
+            for df in iter_merged_chunks(existing, out_format, rows):
+                sink.write(df)
+        for file_name in files:
+            for df in read_session_chunks(file_name, data_type, rows):
+                sink.write(df)
+    except BaseException:
+        sink.abort()
+        raise
+    sink.close()
+    if store and (files or existing is not None):
+        stream_store(sink, filepath, _store_freq(filepath, data_type, files), rows)
+    return sink
+
+
+def stream_store(sink, filepath, samp_freq, rows=chunk_rows):
+    """
+    Write the store of an evenly sampled data type from its merged file
+    (sink of stream_merge) in chunks. IBI and empty files are skipped.
+    """
+    if _type_name(sink.data_type) not in store_channels or sink.n_rows == 0 or samp_freq is None:
+        return None
+    return write_store_chunks(iter_merged_chunks(sink.path, sink.out_format, rows), os.path.join(filepath, 'store'),
+                              sink.data_type, sink.first_ns, sink.last_ns, samp_freq)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution summaries (tiles) of the merged E4 signals, so E4_Plots.py
+does not have to draw millions of samples to show a week.
+
+    - For each data type of a subject session folder, tiles/<TYPE>.npz holds
+        a pyramid of levels. Each level splits time into bins of a fixed size
+        (1 s, 4 s, 16 s, ... 4096 s, aligned to the epoch) and keeps the
+        minimum, maximum, mean and number of samples per channel of every bin
+        with data.
+    - The finest level is built from the merged file read in chunks, and each
+        coarser level from the level below it, so a week is read only once.
+    - The pyramid is built again when it is older than the merged file
+        (update_tiles).
+    - A plot asks for the level of the visible time range (level_for): the
+        finest level with at most max_points bins in the range, or the raw
+        samples (read from the merged file for that range only) when there
+        are few enough of them.
+    - Bins or samples further apart than a gap (one and a half bins or
+        sampling periods, 10 minutes for IBI as the plot's forward fill) are
+        separated by a NaN row, so lines are not drawn across the time
+        between sessions.
+
+"""
+
+#Import Libraries
+import os, tempfile
+import numpy as np
+import pandas as pd
+from E4_IO import merged_file, read_merged
+from E4_Stream import iter_merged_chunks
+
+#Bin sizes of the levels (seconds), finest first
+tile_levels = (1, 4, 16, 64, 256, 1024, 4096)
+#Most points (bins or samples) drawn for a visible range
+max_points = 2000
+#Channels of each data type
+tile_channels = {'EDA': ['Data'], 'TEMP': ['Data'], 'BVP': ['Data'], 'HR': ['Data'], 'IBI': ['Data'],
+                 'ACC': ['ACC_X', 'ACC_Y', 'ACC_Z']}
+#Longest time between samples drawn as a line (ns), if not 1.5 sampling periods
+max_gap_ns = {'IBI': 600 * 10**9}
+
+STATS = ('min', 'max', 'mean')
+
+
+def tile_path(session_dir, data_type):
+    """File of the tiles of one data type in a subject session folder"""
+    return os.path.join(session_dir, 'tiles', os.path.splitext(data_type)[0] + '.npz')
+
+
+def _reduce(bins, mins, maxs, sums, counts):
+    """Join the rows of consecutive equal bins (bins are sorted)"""
+    if len(bins) == 0:
+        return bins, mins, maxs, sums, counts
+    starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+    return (bins[starts], np.minimum.reduceat(mins, starts, axis=0), np.maximum.reduceat(maxs, starts, axis=0),
+            np.add.reduceat(sums, starts, axis=0), np.add.reduceat(counts, starts))
+
+
+def chunk_stats(times_ns, values, bin_ns):
+    """Bin numbers (time // bin_ns), minimum, maximum, sum and count per bin of one chunk of samples"""
+    ok = np.isfinite(values).all(axis=1)
+    times_ns = times_ns[ok]
+    values = values[ok].astype(np.float64)
+    return _reduce(times_ns // bin_ns, values, values, values, np.ones(len(values), dtype=np.int64))
+
+
+def build_tiles(chunks, fullout, channels, levels=tile_levels):
+    """
+    Write the tile pyramid of the data frames in chunks (time order, with a
+    Time column and the channel columns) to fullout. Returns the path.
+    """
+    bin_ns = [int(level * 1e9) for level in levels]
+    parts = []
+    for df in chunks:
+        if len(df) == 0:
+            continue
+        times_ns = df['Time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+        parts.append(chunk_stats(times_ns, df[channels].to_numpy(dtype=np.float64), bin_ns[0]))
+
+    #Finest level: bins split over two chunks are joined
+    n_ch = len(channels)
+    if parts:
+        level = _reduce(*[np.concatenate([part[i] for part in parts]) for i in range(5)])
+    else:
+        level = (np.zeros(0, np.int64), np.zeros((0, n_ch)), np.zeros((0, n_ch)), np.zeros((0, n_ch)),
+                 np.zeros(0, np.int64))
+    #Sampling period from the median number of samples per bin of the finest level
+    samp_ns = bin_ns[0] / np.median(level[4]) if len(level[4]) else np.nan
+    arrays = {'levels': np.array(levels, dtype=np.float64), 'channels': np.array(channels),
+              'samp_ns': np.float64(samp_ns)}
+    for i, size in enumerate(bin_ns):
+        if i > 0:
+            #Coarser level from the level below
+            bins = level[0] * bin_ns[i - 1] // size
+            level = _reduce(bins, *level[1:])
+        bins, mins, maxs, sums, counts = level
+        arrays['L' + str(i) + '_time'] = bins * size
+        arrays['L' + str(i) + '_min'] = mins.astype(np.float32)
+        arrays['L' + str(i) + '_max'] = maxs.astype(np.float32)
+        arrays['L' + str(i) + '_mean'] = (sums / counts[:, None]).astype(np.float32)
+        arrays['L' + str(i) + '_count'] = counts
+
+    #Written to a temporary file and renamed, so a plot never reads half a file
+    os.makedirs(os.path.dirname(fullout), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fullout), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, fullout)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return fullout
+
+
+def update_tiles(session_dir, data_type, force=False):
+    """
+    Build the tiles of one data type of a subject session folder if they are
+    missing or older than the merged file. Returns the path of the tiles.
+    """
+    name = os.path.splitext(data_type)[0]
+    fullin, in_format = merged_file(os.path.join(session_dir, 'merge'), name)
+    fullout = tile_path(session_dir, name)
+    if not force and os.path.isfile(fullout) and os.path.getmtime(fullout) >= os.path.getmtime(fullin):
+        return fullout
+    return build_tiles(iter_merged_chunks(fullin, in_format), fullout, tile_channels[name])
+
+
+def _with_gaps(times, columns, gap_ns):
+    """Insert a NaN row after each step in times larger than gap_ns"""
+    if len(times) < 2:
+        return times, columns
+    after = np.flatnonzero(np.diff(times) > gap_ns) + 1
+    if len(after) == 0:
+        return times, columns
+    times = np.insert(times, after, times[after - 1] + 1)
+    columns = {key: np.insert(values.astype(np.float64), after, np.nan, axis=0) for key, values in columns.items()}
+    return times, columns
+
+
+class TilePyramid:
+    """
+    Tiles of one data type of a subject session folder. Levels are read from
+    the file when first used. The raw samples of short ranges are read from
+    the merged file.
+    """
+
+    def __init__(self, session_dir, data_type):
+        self.session_dir = session_dir
+        self.data_type = os.path.splitext(data_type)[0]
+        self.file = np.load(update_tiles(session_dir, self.data_type))
+        self.levels = self.file['levels']
+        self.channels = [str(ch) for ch in self.file['channels']]
+        self.samp_ns = float(self.file['samp_ns'])
+        self.loaded = {}
+
+    def level(self, i):
+        """Arrays of level i: time (ns since epoch, bin start), min, max, mean, count"""
+        if i not in self.loaded:
+            self.loaded[i] = {key: self.file['L' + str(i) + '_' + key] for key in ('time',) + STATS + ('count',)}
+        return self.loaded[i]
+
+    def bounds(self):
+        """First and last time with data (datetime64), from the finest level"""
+        times = self.level(0)['time']
+        if len(times) == 0:
+            return None, None
+        return times[0].astype('datetime64[ns]'), (times[-1] + int(self.levels[0] * 1e9)).astype('datetime64[ns]')
+
+    def level_for(self, start, end, max_points=max_points):
+        """
+        Level to draw the range start to end with at most max_points points:
+        None for the raw samples, otherwise the finest level with few enough
+        bins (the coarsest level if none has).
+        """
+        span_ns = (pd.Timestamp(end) - pd.Timestamp(start)).value
+        if np.isfinite(self.samp_ns) and self.samp_ns > 0 and span_ns / self.samp_ns <= max_points:
+            return None
+        for i, size in enumerate(self.levels):
+            if span_ns / (size * 1e9) <= max_points:
+                return i
+        return len(self.levels) - 1
+
+    def _gap(self, step_ns):
+        return max(1.5 * step_ns, max_gap_ns.get(self.data_type, 0))
+
+    def view(self, start, end, max_points=max_points):
+        """
+        Data to draw from start to end: a dict with the level (None for raw),
+        the time stamps (datetime64, bin centres for tiles) and per statistic
+        (min, max, mean; all equal to the samples for raw data) an array of
+        time x channels, with NaN rows at gaps.
+        """
+        i = self.level_for(start, end, max_points)
+        start_ns = pd.Timestamp(start).value
+        end_ns = pd.Timestamp(end).value
+        if i is None:
+            df = read_merged(os.path.join(self.session_dir, 'merge'), self.data_type, [(start, end)])
+            times = df['Time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+            values = df[self.channels].to_numpy(dtype=np.float64)
+            times, columns = _with_gaps(times, {stat: values for stat in STATS}, self._gap(self.samp_ns))
+        else:
+            level = self.level(i)
+            size_ns = int(self.levels[i] * 1e9)
+            #Bins that overlap the range, and one more on each side so the line reaches the edges
+            first = max(np.searchsorted(level['time'], start_ns - size_ns, side='left') - 1, 0)
+            stop = np.searchsorted(level['time'], end_ns, side='right') + 1
+            times = level['time'][first:stop] + size_ns // 2
+            times, columns = _with_gaps(times, {stat: level[stat][first:stop] for stat in STATS}, self._gap(size_ns))
+        columns['level'] = i
+        columns['time'] = times.astype('datetime64[ns]')
+        return columns
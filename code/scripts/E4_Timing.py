@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing of the feature extraction in E4_Features.py, to see where the time of
+a subject goes.
+
+    - A StageTimer adds up the wall time and number of calls of named stages
+        (load, slice, hrv, eda, temp, acc, write) of one subject. Stages can
+        be nested: the time of an inner stage (e.g. loading a data type the
+        first time it is used in the HRV features) only counts for the inner
+        stage, so the stage times add up to the time of the subject.
+    - The timings of all subjects are written as a JSON report
+        (E4_Feature_Timing.json in the EMA folder), with the totals per
+        stage.
+    - A sample of subjects can also run with cProfile and tracemalloc
+        (profiled): the profile is saved as <subject>.prof (for pstats or
+        snakeviz) with a text summary of the slowest functions, and the
+        lines that allocated most memory are saved in <subject>_memory.txt.
+
+"""
+
+#Import Libraries
+import os, io, json, time, cProfile, pstats, tracemalloc
+from contextlib import contextmanager, nullcontext
+
+#Stages of the feature extraction, in the order they are reported
+STAGES = ('load', 'slice', 'hrv', 'eda', 'temp', 'acc', 'write')
+#Lines in the text summaries of the profiles
+profile_lines = 30
+
+
+class StageTimer:
+    """Wall time (s) and number of calls of named stages, time in nested stages counted once"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.open = []
+
+    @contextmanager
+    def stage(self, name):
+        """Time the code in the with block as stage name"""
+        #Time of the stage and of the stages started inside it
+        entry = [time.perf_counter(), 0.0]
+        self.open.append(entry)
+        try:
+            yield
+        finally:
+            self.open.pop()
+            elapsed = time.perf_counter() - entry[0]
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - entry[1]
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.open:
+                self.open[-1][1] += elapsed
+
+    def add(self, other):
+        """Add the stages of another StageTimer (or its report)"""
+        stages = other.report() if isinstance(other, StageTimer) else other
+        for name, stage in stages.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + stage['seconds']
+            self.calls[name] = self.calls.get(name, 0) + stage['calls']
+
+    def report(self):
+        """Stages as a dict of {'seconds', 'calls'}, known stages first"""
+        names = [name for name in STAGES if name in self.seconds] + sorted(set(self.seconds) - set(STAGES))
+        return {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in names}
+
+
+def timed(timer, name):
+    """timer.stage(name), or nothing if timer is None"""
+    return nullcontext() if timer is None else timer.stage(name)
+
+
+def profiled(function, args, prefix):
+    """
+    Call function(*args) with cProfile and tracemalloc. The profile is saved
+    as prefix.prof and prefix_profile.txt, the top memory allocations as
+    prefix_memory.txt. Returns the result and a dict with the files and the
+    peak traced memory (MB).
+    """
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        result = function(*args)
+    finally:
+        profiler.disable()
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+    profiler.dump_stats(prefix + '.prof')
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(profile_lines)
+    with open(prefix + '_profile.txt', 'w') as f:
+        f.write(text.getvalue())
+    with open(prefix + '_memory.txt', 'w') as f:
+        f.write('Peak traced memory: %.1f MB\n\n' % (peak / 1024**2))
+        for stat in snapshot.statistics('lineno')[:profile_lines]:
+            f.write(str(stat) + '\n')
+    return result, {'profile': prefix + '.prof', 'memory': prefix + '_memory.txt', 'peak_traced_mb': peak / 1024**2}
+
+
+def write_report(fullout, subjects, main=None):
+    """
+    Write the timings of the subjects (list of dicts with castor_record_id
+    and stages, as made by E4_Features.py), the stages of the main process
+    that are not part of a subject (main, e.g. writing the feature files),
+    and the totals per stage as JSON. Returns the totals.
+    """
+    total = StageTimer()
+    for subject in subjects:
+        total.add(subject['stages'])
+    total.add(main or {})
+    totals = total.report()
+    with open(fullout, 'w') as f:
+        json.dump({'stages': list(STAGES), 'total': totals, 'main': main or {}, 'subjects': subjects}, f, indent=2,
+                  default=str)
+    return totals
+
+
+def format_totals(totals):
+    """Text table of the total time and calls per stage"""
+    overall = sum(stage['seconds'] for stage in totals.values()) or 1.0
+    lines = ['%-8s %10s %8s %7s' % ('stage', 'time (s)', 'calls', '%')]
+    for name, stage in totals.items():
+        lines.append('%-8s %10.2f %8d %6.1f%%' % (name, stage['seconds'], stage['calls'],
+                                                100 * stage['seconds'] / overall))
+    return '\n'.join(lines)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Window extraction for merged E4 data, used by E4_Features.py to select the
+data in the time window before each EMA survey (or the sleep period).
+
+    - The merged data is sorted by time, so the first and last sample of a
+        window are found with a binary search (searchsorted) on the time
+        stamps instead of comparing every time stamp of the week.
+    - Windows are returned as row slices (iloc) of the full data, which do
+        not copy the data.
+    - Windows are open intervals (start_time < Time < end_time), the same
+        as the boolean masks used before.
+    - Features of all windows of a subject (HR/IBI statistics, RMSSD, skin
+        temperature, ACC displacement) are calculated in one pass from
+        prefix sums of the values, their squares and sample number * value
+        (for the temperature slope), instead of one window at a time.
+    - The same batch features work for sliding windows over a whole week
+        (sliding_windows, e.g. 10 minutes every minute): each window is the
+        difference of two running sums, so the cost grows with the number of
+        samples and windows, not with the overlap of the windows.
+
+"""
+
+#Import Libraries
+import numpy as np
+import pandas as pd
+from E4_Timing import timed
+
+
+def _to_datetime64(time):
+    """Convert a time stamp (Timestamp, datetime, string) to numpy datetime64"""
+    return pd.Timestamp(time).to_datetime64()
+
+
+def window_bounds(times, start_time, end_time):
+    """
+    Row numbers (first, stop) of the samples with start_time < time < end_time
+    in a sorted datetime64 array. Returns an empty range if either time is
+    missing (NaT) or the window is empty.
+    """
+    if pd.isnull(start_time) or pd.isnull(end_time):
+        return 0, 0
+    first = int(np.searchsorted(times, _to_datetime64(start_time), side='right'))
+    stop = int(np.searchsorted(times, _to_datetime64(end_time), side='left'))
+    return first, max(first, stop)
+
+
+def window_slice(df, start_time, end_time, time_col='Time'):
+    """
+    Rows of a data frame sorted by time_col with start_time < time < end_time,
+    as a slice of the data frame. Gives the same rows as
+    df[(df.Time > start_time) & (df.Time < end_time)].
+    """
+    if len(df) == 0:
+        return df
+    first, stop = window_bounds(df[time_col].to_numpy(), start_time, end_time)
+    return df.iloc[first:stop]
+
+
+class SignalWindows:
+    """
+    Merged data of one data type with its time stamps kept as a sorted
+    datetime64 array, to take many windows from the same data. The data is
+    sorted by time once if it is not sorted already.
+    """
+
+    def __init__(self, df, time_col='Time'):
+        if len(df) > 0 and not df[time_col].is_monotonic_increasing:
+            df = df.sort_values(time_col, kind='stable', ignore_index=True)
+        self.df = df
+        self.time_col = time_col
+        self.times = df[time_col].to_numpy() if len(df) > 0 else np.array([], dtype='datetime64[ns]')
+
+    def __len__(self):
+        return len(self.df)
+
+    def bounds(self, start_time, end_time):
+        """Row numbers (first, stop) of the window, see window_bounds"""
+        return window_bounds(self.times, start_time, end_time)
+
+    def window(self, start_time, end_time):
+        """Rows with start_time < time < end_time, as a slice of the data"""
+        if len(self.df) == 0:
+            return self.df
+        first, stop = self.bounds(start_time, end_time)
+        return self.df.iloc[first:stop]
+
+
+def window_bounds_batch(times, start_times, end_times):
+    """
+    Row numbers (first, stop) of many windows at once, for arrays of start
+    and end times. Windows with a missing time (NaT) are empty.
+    """
+    start_times = pd.to_datetime(pd.Series(start_times)).to_numpy()
+    end_times = pd.to_datetime(pd.Series(end_times)).to_numpy()
+    first = np.searchsorted(times, start_times, side='right')
+    stop = np.searchsorted(times, end_times, side='left')
+    stop = np.maximum(first, stop)
+    missing = pd.isnull(start_times) | pd.isnull(end_times)
+    first[missing] = 0
+    stop[missing] = 0
+    return first.astype(np.int64), stop.astype(np.int64)
+
+
+def _prefix_sum(values):
+    """Cumulative sum with a leading zero, so sum(values[a:b]) = c[b] - c[a]"""
+    return np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+
+
+def batch_sum(values, first, stop):
+    """Sum of values[first:stop] for every window"""
+    c = _prefix_sum(values)
+    return c[stop] - c[first]
+
+
+def batch_mean_sd(values, first, stop, ddof=0):
+    """
+    Mean and standard deviation of values[first:stop] for every window, from
+    prefix sums of the values and their squares. The values are shifted by
+    their overall mean first, so the sums of squares keep their precision.
+    Windows with too few samples give NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    shift = np.mean(values) if len(values) > 0 else 0.0
+    shifted = values - shift
+    n = (stop - first).astype(np.float64)
+    s1 = batch_sum(shifted, first, stop)
+    s2 = batch_sum(shifted**2, first, stop)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, s1/n, np.nan)
+        var = (s2 - s1*mean) / (n - ddof)
+        sd = np.where(n > ddof, np.sqrt(np.maximum(var, 0.0)), np.nan)
+    return mean + shift, sd
+
+
+def _batch_reduce(ufunc, values, first, stop):
+    """ufunc.reduce (e.g. np.minimum) of values[first:stop] for every window, NaN if empty"""
+    out = np.full(len(first), np.nan)
+    full = stop > first
+    if full.any():
+        #Start and stop of each window next to each other. Padding makes the
+        #last stop a valid index
+        padded = np.append(np.asarray(values, dtype=np.float64), np.nan)
+        index = np.empty(2*full.sum(), dtype=np.int64)
+        index[0::2] = first[full]
+        index[1::2] = stop[full]
+        out[full] = ufunc.reduceat(padded, index)[0::2]
+    return out
+
+
+def batch_min_max(values, first, stop):
+    """Minimum and maximum of values[first:stop] for every window"""
+    return _batch_reduce(np.minimum, values, first, stop), _batch_reduce(np.maximum, values, first, stop)
+
+
+def sliding_windows(start_time, end_time, length, stride):
+    """
+    Start and end times of the windows of length (Timedelta) every stride
+    from start_time to end_time, starting at multiples of stride. Only
+    complete windows are returned, as two Series.
+    """
+    length = pd.Timedelta(length)
+    starts = pd.date_range(pd.Timestamp(start_time).floor(stride), pd.Timestamp(end_time) - length, freq=stride)
+    return pd.Series(starts), pd.Series(starts + length)
+
+
+def _diff_bounds(first, stop, n_values):
+    """
+    Window bounds in the array of successive differences (length n_values-1):
+    the differences inside the window [first, stop) are diffs[first:stop-1]
+    """
+    n_diffs = max(n_values - 1, 0)
+    first_d = np.minimum(first, n_diffs)
+    stop_d = np.clip(stop - 1, first_d, n_diffs)
+    return first_d, stop_d
+
+
+def batch_rmssd(values, first, stop):
+    """Root mean square of successive differences within every window"""
+    diffs = np.diff(np.asarray(values, dtype=np.float64))
+    first_d, stop_d = _diff_bounds(first, stop, len(values))
+    n = (stop_d - first_d).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, np.sqrt(batch_sum(diffs**2, first_d, stop_d)/n), np.nan)
+
+
+def batch_slope(values, first, stop):
+    """
+    Slope of a least squares line through values[first:stop] against the
+    sample number in the window (as np.polyfit(range(n), values, 1)[0]), in
+    closed form from prefix sums of the values and sample number * value.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    shifted = values - (np.mean(values) if len(values) > 0 else 0.0)
+    k = np.arange(len(values), dtype=np.float64)
+    n = (stop - first).astype(np.float64)
+    s_y = batch_sum(shifted, first, stop)
+    #Sum of (sample number in window) * value
+    s_iy = batch_sum(k*shifted, first, stop) - first*s_y
+    s_i = n*(n - 1)/2
+    s_ii = (n - 1)*n*(2*n - 1)/6
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 1, (n*s_iy - s_i*s_y)/(n*s_ii - s_i**2), np.nan)
+
+
+def batch_median(values, first, stop):
+    """Median of values[first:stop] for every window (per window, on slices)"""
+    values = np.asarray(values, dtype=np.float64)
+    return np.array([np.median(values[a:b]) if b > a else np.nan for a, b in zip(first, stop)])
+
+
+def batch_window_features(windows, start_times, end_times, timer=None):
+    """
+    HR, IBI, skin temperature and ACC features of E4_Features.py for all
+    windows of a subject in one pass. windows is a dict of SignalWindows
+    with keys 'IBI', 'HR', 'TEMP' and 'ACC'. Returns a data frame with one
+    row per window and one column per feature. Features of windows with too
+    little data are NaN, with the same limits as the per window code (more
+    than 50 IBIs, 5 temperature samples and 20 ACC samples). With timer (an
+    E4_Timing.StageTimer), the window search is timed as 'slice' and the
+    features as 'hrv', 'temp' and 'acc'.
+    """
+    n_windows = len(start_times)
+    feats = {}
+
+    def bounds(name):
+        win = windows[name]
+        with timed(timer, 'slice'):
+            if len(win) == 0:
+                empty = np.zeros(n_windows, dtype=np.int64)
+                return win, empty, empty
+            first, stop = window_bounds_batch(win.times, start_times, end_times)
+        return win, first, stop
+
+    ##IBI and HR (only for windows with enough IBIs)
+    with timed(timer, 'hrv'):
+        win, first, stop = bounds('IBI')
+        ibi_ok = (stop - first) > 50
+        ibi = win.df['Data'].to_numpy() if len(win) else np.array([])
+        feats['ibi_mean'], feats['ibi_sd'] = batch_mean_sd(ibi, first, stop)
+        feats['ibi_min'], feats['ibi_max'] = batch_min_max(ibi, first, stop)
+        feats['hr_rmssd'] = batch_rmssd(ibi, first, stop)
+        feats['ibi_based_quality'] = batch_sum(ibi, first, stop)/1000/(10*60)
+        win, first, stop = bounds('HR')
+        hr = win.df['Data'].to_numpy() if len(win) else np.array([])
+        feats['hr_mean'], feats['hr_sd'] = batch_mean_sd(hr, first, stop)
+        feats['hr_min'], feats['hr_max'] = batch_min_max(hr, first, stop)
+        for name in ['ibi_mean', 'ibi_sd', 'ibi_min', 'ibi_max', 'hr_rmssd', 'ibi_based_quality',
+                     'hr_mean', 'hr_sd', 'hr_min', 'hr_max']:
+            feats[name] = np.where(ibi_ok, feats[name], np.nan)
+
+    ##Skin temperature (SD with ddof=1, as pandas)
+    with timed(timer, 'temp'):
+        win, first, stop = bounds('TEMP')
+        temp = win.df['Data'].to_numpy() if len(win) else np.array([])
+        temp_ok = (stop - first) > 5
+        feats['temp_mean'], feats['temp_sd'] = batch_mean_sd(temp, first, stop, ddof=1)
+        feats['temp_median'] = batch_median(temp, np.where(temp_ok, first, 0), np.where(temp_ok, stop, 0))
+        feats['temp_slope'] = batch_slope(temp, first, stop)
+        for name in ['temp_mean', 'temp_sd', 'temp_median', 'temp_slope']:
+            feats[name] = np.where(temp_ok, feats[name], np.nan)
+
+    ##ACC: absolute sample to sample differences inside each window
+    with timed(timer, 'acc'):
+        win, first, stop = bounds('ACC')
+        acc_ok = (stop - first) > 20
+        first_d, stop_d = _diff_bounds(first, stop, len(win))
+        if len(win):
+            deltas = [np.abs(np.diff(win.df[axis].to_numpy().astype(np.float64))) for axis in ['ACC_X', 'ACC_Y', 'ACC_Z']]
+        else:
+            deltas = [np.array([])]*3
+        deltas.append(np.sqrt(deltas[0]**2 + deltas[1]**2 + deltas[2]**2))
+        for (name, name_sd), delta in zip([('acc_x', 'acc_x_sd'), ('acc_y', 'acc_y_sd'),
+                                           ('acc_z', 'acc_z_sd'), ('acc_delta', 'acc_delta_sd')], deltas):
+            mean, sd = batch_mean_sd(delta, first_d, stop_d)
+            feats[name] = np.where(acc_ok, mean, np.nan)
+            feats[name_sd] = np.where(acc_ok, sd, np.nan)
+
+    return pd.DataFrame(feats)
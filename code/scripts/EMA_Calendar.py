@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Calendar of the stress weeks of the study, used by EMA_Cleaner.py to label
+each survey as control (1) or stress (2) week.
+
+    - The first day of each stress week is read from a CSV file with a
+        start_date column (lines starting with # are comments), so a new
+        cohort only needs a new line in that file. stress_weeks.csv in the
+        EMA folder is used when it exists, otherwise the one next to this
+        script.
+    - A stress week is its first day and the days up to week_days later.
+        Surveys are matched to the weeks on their date: the last week that
+        starts on or before the date is found with a binary search
+        (np.searchsorted) on the sorted start dates, and the survey is in a
+        stress week if its date is less than week_days after that start.
+    - Surveys without a date are control week, as before.
+
+"""
+
+#Import Libraries
+import os
+import numpy as np
+import pandas as pd
+
+#Length of a stress week (days)
+week_days = 7
+#Stress weeks shipped with the scripts
+stress_weeks_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stress_weeks.csv')
+
+
+def find_stress_weeks(ema_dir=None):
+    """stress_weeks.csv in the EMA folder if it exists, the one next to the scripts otherwise"""
+    if ema_dir is not None:
+        file_name = os.path.join(ema_dir, 'stress_weeks.csv')
+        if os.path.isfile(file_name):
+            return file_name
+    return stress_weeks_file
+
+
+def read_stress_weeks(file_name=stress_weeks_file):
+    """First days of the stress weeks in a CSV file, as a sorted datetime64[D] array"""
+    weeks = pd.read_csv(file_name, comment='#', skipinitialspace=True)
+    if 'start_date' not in weeks.columns:
+        raise ValueError(str(file_name) + ' has no start_date column')
+    starts = pd.to_datetime(weeks['start_date'].dropna(), format='%Y-%m-%d').to_numpy().astype('datetime64[D]')
+    return np.unique(starts)
+
+
+class StressCalendar:
+    """Stress weeks from their first days (sorted datetime64[D] array or dates), each days long"""
+
+    def __init__(self, start_dates, days=week_days):
+        self.starts = np.unique(np.asarray(start_dates, dtype='datetime64[D]'))
+        self.days = np.timedelta64(days, 'D')
+
+    @classmethod
+    def from_file(cls, file_name=stress_weeks_file, days=week_days):
+        """Calendar of the stress weeks in a CSV file (see read_stress_weeks)"""
+        return cls(read_stress_weeks(file_name), days)
+
+    def is_stress(self, times):
+        """Boolean array, True for the times (datetime-like) on a day of a stress week"""
+        dates = pd.to_datetime(pd.Series(times)).to_numpy().astype('datetime64[D]')
+        #Last week that starts on or before each date
+        week = np.searchsorted(self.starts, dates, side='right') - 1
+        found = (week >= 0) & ~np.isnat(dates)
+        in_week = np.zeros(len(dates), dtype=bool)
+        in_week[found] = dates[found] < self.starts[week[found]] + self.days
+        return in_week
+
+    def week_type(self, times):
+        """Week type of the times: 1 for control, 2 for stress weeks"""
+        return np.where(self.is_stress(times), 2, 1)
@@ -1,153 +1,206 @@
 #!/usr/bin/env python3
-""" 
-Script that imports the exported castor file containing data from EMA surveys, 
+"""
+Script that imports the exported castor file containing data from EMA surveys,
 and applies different cleaning methods to both sleep and wake surveys:
     - Outputs the percent of surveys compeletted, drops those with incomplete surveys
     - Renames variables with space in names
     - Fixes issues with subjects IDs
-    - Assign which surveys were in control vs stress weeks
+    - Assign which surveys were in control vs stress weeks (first days of the
+        stress weeks in stress_weeks.csv, see EMA_Calendar)
     - For sleep surveys: calcualte date time, and time of sleep
 
+The subject IDs, survey times, dates and week types of the wake and sleep
+sheets are cleaned together in one pass, and the sleep and wake times are
+built with datetime64 arithmetic (survey date + clock time) instead of
+joining and parsing strings. The cleaned tables are written as CSV and as
+Parquet (EMA_Clean.parquet, Sleep_Clean.parquet) with typed columns, which
+E4_Features.py reads without parsing the times again.
+
+The cleaning is done by clean_ema, which can also be used from other scripts
+(see E4_Pipeline.py) on sheets that are already loaded.
+
+Usage:  python EMA_Cleaner.py [--ema-dir /project/3013068.02/stats/EMA/] [--file EMA.xlsx]
+
 Authors:        Rayyan Toutouni, Margo Willems
 Last Modified:  05-JUN-2019
 
 """
 
 #Import Libraries
-import os
+import os, sys, argparse
 import numpy as np
 import pandas as pd
 import datetime as dt
 from datetime import datetime, timedelta
+from EMA_Calendar import StressCalendar, find_stress_weeks
 
 #Turnoff write warning in Pandas
-pd.options.mode.chained_assignment = None  
+pd.options.mode.chained_assignment = None
 
-#File Path Location
-filepath = ("/project/3013068.02/stats/EMA/")
-os.chdir (str(filepath))
-file = "EMA.xlsx"
+#Wake surveys that go with a sleep survey
+sleep_packages = ['EMA 2.1', 'EMA 3.1', 'EMA 4.1', 'EMA 5.1', 'EMA 6.1', 'EMA 7.1']
 
-#Read excel into dataframe for sleep and wake surveys
-Day_df = pd.read_excel(file, '2._Momentary_Assessment')
-Sleep_df = pd.read_excel(file, "1._Sleep_Assessment", header = 0, index_col = None)
-EMA_n_tot= len(Day_df.index)
-Sleep_n_tot= len(Sleep_df.index)
 
+def clean_columns(columns):
+    """Lower case column names without spaces and brackets"""
+    return columns.str.strip().str.lower().str.replace(' ', '_').str.replace('(', '').str.replace(')', '')
+
+
+def clean_surveys(sheets, calendar):
+    """
+    Clean the columns all sheets have (subject ID, survey time and date, week
+    type) for a list of sheets at once: the columns are joined, converted,
+    and split again. Returns the cleaned sheets.
+    """
+    ids = pd.concat([df['Castor Record ID'] for df in sheets], ignore_index=True)
+    completed = pd.concat([df['Survey Completed On'] for df in sheets], ignore_index=True)
 
-#Place imported df in array to loop
-dfs=[Day_df, Sleep_df]
-for index, EMA_df in enumerate(dfs):
-    
-    #Drop incomplete data, report percent complete
-    #EMA_df = EMA_df[EMA_df['Survey Progress'] >= 100]
-    EMA_n_com= len(EMA_df.index)
-    if index==0:
-       print('EMA Percent complete: '+str((EMA_n_com/EMA_n_tot)*100))
-    else:
-        print('Sleep Percent complete: '+str((EMA_n_com/Sleep_n_tot)*100))
-        
     #Reformat Subject IDs
-    EMA_df['Castor Record ID'] = EMA_df['Castor Record ID'].str.slice(0,7)
-    
+    ids = ids.str.slice(0,7)
     #Reformat date-time so day is read firt
-    EMA_df['Survey Completed On'] = pd.to_datetime(EMA_df['Survey Completed On'], dayfirst=True)
-    
-    #Make variable with date only for setting stress vs control weeks
-    EMA_df['Survey_Date'] = EMA_df['Survey Completed On']
-    EMA_df['Survey_Date'] = EMA_df['Survey Completed On'].astype(str)
-    EMA_df['Survey_Date'] = EMA_df['Survey_Date'].str.slice(0,10)
-    
-    #Set first days of stress weeks
-    Stress_Weeks=['2018-04-04', '2018-05-18', '2018-06-20', '2018-09-28', '2018-10-31', 
-                  '2018-12-07', '2019-01-23', '2019-03-01', '2019-04-03', '2019-05-17',
-                  '2019-06-19', '2019-09-27', '2019-10-30', '2019-12-06']
-    stress_days = Stress_Weeks.copy()
-    len_weeks=len(Stress_Weeks)
-    
-    #Loop to make weeks 7 days from start of each stress week
-    for k in range(1,7):
-        for i in range (0,len_weeks):
-            #First convert the string to date time
-            date_1 = dt.datetime.strptime((str(Stress_Weeks[i])), '%Y-%m-%d')
-            #Add one day to that
-            add_date= date_1 + dt.timedelta(days=k)
-            #Append it to new list
-            stress_days.append(str(add_date))
-            
-    #Function to shorten day string, then application       
-    def remove_cruft(s):
-        return s[0:10]
-    stress_days=[remove_cruft(s) for s in stress_days]
-    
-    #Make a week type variable (1=Control, 2=Stress): First make all weeks into
-    #a string with the OR line in between
-    makeitastring = '|'.join(map(str, stress_days))
-    
-    #Condition in which date contains string (from above), and choices
-    condition_EMA= [EMA_df['Survey_Date'].str.contains(makeitastring)]
-    choices=[2]
-    #Apply condition to week variable
-    EMA_df['Week_Type'] = np.select(condition_EMA, choices, default=1)
-    
+    completed = pd.to_datetime(completed, dayfirst=True)
+    #Date only, for setting stress vs control weeks
+    dates = completed.dt.normalize()
+    #Week type (1=Control, 2=Stress) from the stress week calendar
+    week_type = calendar.week_type(completed)
+
+    cleaned = []
+    start = 0
+    for df in sheets:
+        stop = start + len(df)
+        df = df.copy()
+        df['Castor Record ID'] = ids[start:stop].to_numpy()
+        df['Survey Completed On'] = completed[start:stop].to_numpy()
+        df['Survey_Date'] = dates[start:stop].to_numpy()
+        df['Week_Type'] = week_type[start:stop]
+        df.columns = clean_columns(df.columns)
+        cleaned.append(df)
+        start = stop
+    return cleaned
+
+
+def clock_time(values):
+    """Time since midnight of clock times ('HH:MM' or datetime.time), NaT if it is not a valid time"""
+    text = pd.Series(values).astype(str).str.strip()
+    times = pd.to_datetime(text, format='%H:%M', errors='coerce')
+    #Times with seconds, as Excel cells of type time
+    times = times.fillna(pd.to_datetime(text, format='%H:%M:%S', errors='coerce'))
+    return times - times.dt.normalize()
+
+
+def sleep_hours(sleep_down_dt, sleep_up_dt):
+    """Hours between going to sleep and waking up, in whole minutes"""
+    return ((sleep_up_dt - sleep_down_dt) // pd.Timedelta(minutes=1)).abs() / 60
+
+
+def sleep_datetimes(survey_date, sleep_down, sleep_up):
+    """
+    Date and time of going to sleep and waking up, and the hours slept. The
+    reported clock times are added to the date of the survey; if that gives
+    more than 12 hours of sleep, the sleep time was on the day before.
+    """
+    down_time = clock_time(sleep_down)
+    up_time = clock_time(sleep_up)
+    survey_date = pd.Series(pd.to_datetime(survey_date).to_numpy(), index=down_time.index)
+    sleep_down_dt = survey_date + down_time
+    sleep_up_dt = survey_date + up_time
+
+    #Correct for date time issues by subtracting 1 day if sleep longer than 12 hours
+    sleep_down_dt = sleep_down_dt.mask(sleep_hours(sleep_down_dt, sleep_up_dt) > 12, sleep_down_dt - pd.Timedelta(days=1))
+    return sleep_down_dt, sleep_up_dt, sleep_hours(sleep_down_dt, sleep_up_dt)
+
+
+def clean_sleep(Sleep_df, Day_df):
+    """Sleep surveys with sleep and wake times, joined with their wake survey, without extremes"""
+    #Remove first survey
+    Sleep_df = Sleep_df[Sleep_df.survey_package_name != 'EMA 1.1']
+
+    #Date times of going to sleep and waking up, as clock times
+    down, up, hours = sleep_datetimes(Sleep_df['survey_date'], Sleep_df['sleep_down'], Sleep_df['sleep_up'])
+    Sleep_df['sleep_up_dt'] = up.to_numpy()
+    Sleep_df['sleep_down_dt'] = down.to_numpy()
+    Sleep_df['sleep_down'] = (pd.Timestamp(0) + clock_time(Sleep_df['sleep_down'])).dt.time.to_numpy()
+    Sleep_df['sleep_up'] = (pd.Timestamp(0) + clock_time(Sleep_df['sleep_up'])).dt.time.to_numpy()
+    Sleep_df['sleep_time'] = hours.to_numpy()
+
+    #Make a df with waking EMA Surveys
+    EMA_Sleep_df = Day_df[Day_df.survey_package_name.isin(sleep_packages)]
+
+    #Merge with sleep questionnaires
+    Sleep_df = Sleep_df.sort_values('survey_date').set_index('survey_instance_id')
+    EMA_Sleep_df = EMA_Sleep_df.sort_values('survey_date').set_index('survey_instance_id')
+    full_Sleep_df = pd.merge(Sleep_df, EMA_Sleep_df)
+
+    #Drop extremes
+    full_Sleep_df = full_Sleep_df.drop(full_Sleep_df[full_Sleep_df.sleep_time >40].index)
+    full_Sleep_df = full_Sleep_df.drop(full_Sleep_df[full_Sleep_df.sleep_time <3].index)
+    return full_Sleep_df
+
+
+def write_clean(df, name):
+    """
+    Write a cleaned table as name.csv and name.parquet. Parquet keeps the
+    types (datetimes, times, numbers); text columns with mixed values are
+    written as strings.
+    """
+    df.to_csv(name + '.csv', index = None, header=True)
+    typed = df.reset_index(drop=True)
+    for col in typed.columns:
+        if typed[col].dtype == object and pd.api.types.infer_dtype(typed[col], skipna=True).startswith('mixed'):
+            typed[col] = typed[col].where(typed[col].isna(), typed[col].astype(str))
+    typed.to_parquet(name + '.parquet', index=False)
+
+
+def read_sheets(file_name):
+    """Wake and sleep sheets of the Castor export"""
+    Day_df = pd.read_excel(file_name, '2._Momentary_Assessment')
+    Sleep_df = pd.read_excel(file_name, "1._Sleep_Assessment", header = 0, index_col = None)
+    return Day_df, Sleep_df
+
+
+def clean_ema(Day_df, Sleep_df, out_dir, calendar):
+    """
+    Clean the wake and sleep sheets, and save them in out_dir as EMA_Clean
+    and Sleep_Clean. Returns the cleaned wake and sleep tables.
+    """
+    EMA_n_tot= len(Day_df.index)
+    Sleep_n_tot= len(Sleep_df.index)
+
+    #Drop incomplete data, report percent complete
+    #Day_df = Day_df[Day_df['Survey Progress'] >= 100]
+    #Sleep_df = Sleep_df[Sleep_df['Survey Progress'] >= 100]
+    print('EMA Percent complete: '+str((len(Day_df.index)/EMA_n_tot)*100))
+    print('Sleep Percent complete: '+str((len(Sleep_df.index)/Sleep_n_tot)*100))
+
+    #IDs, dates and week types of both sheets
+    Day_df, Sleep_df = clean_surveys([Day_df, Sleep_df], calendar)
+
     #Save Cleaned data file for EMA, for sleep do more stuff though
-    if index == 0:
-        EMA_df.columns = EMA_df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('(', '').str.replace(')', '')
-        clean_file="EMA_Clean.csv"
-        EMA_df.to_csv (clean_file, index = None, header=True)
-        CP_Day_df=EMA_df
-        #EMA_1_df =
-    else:
-        #Clean column headers, remove firts survey
-        EMA_df.columns = EMA_df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('(', '').str.replace(')', '')
-        EMA_df=EMA_df[EMA_df.survey_package_name != 'EMA 1.1']
-        
-        #Combine day and time (as string) reported for wake/sleep into date time
-        ##Wake
-        EMA_df["sleep_up_dt"] = EMA_df["sleep_up"].map(str) + ' ' + EMA_df["survey_date"]
-        EMA_df['sleep_up_dt'] = pd.to_datetime(EMA_df['sleep_up_dt'], errors='coerce')
-        ##Sleep
-        EMA_df["sleep_down_dt"] = EMA_df["sleep_down"].map(str) + ' ' + EMA_df["survey_date"]
-        EMA_df['sleep_down_dt'] = pd.to_datetime(EMA_df['sleep_down_dt'], errors='coerce')
-        
-        #Convert the time variable from string to time
-        EMA_df['sleep_down'] = pd.to_datetime(EMA_df['sleep_down'], format='%H:%M').dt.time
-        EMA_df['sleep_up'] = pd.to_datetime(EMA_df['sleep_up'], format='%H:%M').dt.time
-        EMA_df=EMA_df.set_index(EMA_df.sleep_down_dt)
-        
-        #calculate time slept without correcting dt differences
-        EMA_df['sleep_time']=abs((EMA_df['sleep_up_dt']-EMA_df['sleep_down_dt']).astype('timedelta64[m]'))/60
-        
-        #Correct for date time issues by subtracting 1 day if sleep longer than 12 hours
-        #Set condition and choices
-        conditions = [EMA_df['sleep_time'] > 12]
-        choices = [EMA_df.sleep_down_dt-pd.DateOffset(1)]
-        #Apply above conditions
-        EMA_df['sleep_down_dt'] = np.select(conditions, choices, default=EMA_df['sleep_down_dt'])
-        
-        #Recalculate the propper time slept
-        EMA_df['sleep_time']=abs((EMA_df['sleep_up_dt']-EMA_df['sleep_down_dt']).astype('timedelta64[m]'))/60
-         
-        #Make a df with waking EMA Surveys
-        EMA_Sleep_df=CP_Day_df[
-                (CP_Day_df.survey_package_name == 'EMA 2.1') | (CP_Day_df.survey_package_name == 'EMA 3.1')|
-                (CP_Day_df.survey_package_name == 'EMA 4.1') | (CP_Day_df.survey_package_name == 'EMA 5.1')|
-                (CP_Day_df.survey_package_name == 'EMA 6.1') | (CP_Day_df.survey_package_name == 'EMA 7.1')]
-
-        #Merge with sleep questionnaires
-        EMA_df=EMA_df.sort_values('survey_date')   
-        EMA_Sleep_df=EMA_Sleep_df.sort_values('survey_date')
-        EMA_df=EMA_df.set_index('survey_instance_id')
-        EMA_Sleep_df=EMA_Sleep_df.set_index('survey_instance_id')
-        
-        #Drop extremes
-        full_Sleep_df=pd.merge(EMA_df, EMA_Sleep_df)
-        full_Sleep_df = full_Sleep_df.drop(full_Sleep_df[full_Sleep_df.sleep_time >40].index)
-        full_Sleep_df = full_Sleep_df.drop(full_Sleep_df[full_Sleep_df.sleep_time <3].index)
-        
-        #Output to csv
-        clean_file="Sleep_Clean.csv"
-        full_Sleep_df.to_csv (clean_file, index = None, header=True)
-        
-        
-    
+    write_clean(Day_df, os.path.join(out_dir, "EMA_Clean"))
+    full_Sleep_df = clean_sleep(Sleep_df, Day_df)
+    write_clean(full_Sleep_df, os.path.join(out_dir, "Sleep_Clean"))
+    return Day_df, full_Sleep_df
+
+
+#File Path Location
+filepath = ("/project/3013068.02/stats/EMA/")
+file = "EMA.xlsx"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Clean the wake and sleep EMA surveys of the Castor export.')
+    parser.add_argument('--ema-dir', default=filepath,
+                        help='folder with the Castor export, where the cleaned files are written')
+    parser.add_argument('--file', dest='file_name', default=file, help='file name of the Castor export')
+    args = parser.parse_args(argv)
+
+    #Read excel into dataframe for sleep and wake surveys
+    Day_df, Sleep_df = read_sheets(os.path.join(args.ema_dir, args.file_name))
+    #Stress weeks (stress_weeks.csv in the EMA folder, or the one next to the scripts)
+    Stress_Calendar = StressCalendar.from_file(find_stress_weeks(args.ema_dir))
+    clean_ema(Day_df, Sleep_df, args.ema_dir, Stress_Calendar)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
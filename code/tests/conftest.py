@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixtures of the tests: a small synthetic cohort (see
+code/benchmarks/synthetic_data.py) with short recordings, so the tests run
+without the study data. The cohort is written once per test run; tests that
+change it get their own copy.
+
+Usage:  python -m pytest code/tests
+"""
+
+#Import Libraries
+import os, sys, shutil
+import pytest
+
+#The scripts under test and the synthetic data generator
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'scripts'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+import synthetic_data
+
+#Size of the test cohort
+n_subjects = 2
+days = 2
+hours = 1.5
+beeps = 3
+
+
+@pytest.fixture(scope='session')
+def cohort_template(tmp_path_factory):
+    """Synthetic cohort (data/ with the E4 sessions) and its EMA sheets, shared by all tests"""
+    folder = str(tmp_path_factory.mktemp('cohort'))
+    weeks, totals = synthetic_data.write_cohort(os.path.join(folder, 'data'), n_subjects, days, hours, beeps, seed=0)
+    sheets = synthetic_data.make_ema_sheets(weeks, days, hours, beeps, seed=0)
+    return {'root': os.path.join(folder, 'data'), 'weeks': weeks, 'totals': totals, 'sheets': sheets}
+
+
+@pytest.fixture
+def cohort(cohort_template, tmp_path):
+    """Copy of the E4 sessions of the cohort that a test may change. Returns its data folder."""
+    root = str(tmp_path / 'data')
+    shutil.copytree(cohort_template['root'], root)
+    return root
+
+
+@pytest.fixture(scope='session')
+def merged_cohort(cohort_template, tmp_path_factory):
+    """Copy of the cohort with merged sessions and cleaned EMA files. Returns the data and EMA folders."""
+    import E4_Cleaner, EMA_Cleaner
+    from EMA_Calendar import StressCalendar
+    folder = str(tmp_path_factory.mktemp('merged'))
+    root = os.path.join(folder, 'data')
+    ema_dir = os.path.join(folder, 'EMA')
+    shutil.copytree(cohort_template['root'], root)
+    assert E4_Cleaner.main(['--root', root, '--subjects'] + [str(n) for n in range(1, n_subjects + 1)]) == 0
+    os.makedirs(ema_dir)
+    EMA_Cleaner.clean_ema(*cohort_template['sheets'], ema_dir, StressCalendar.from_file())
+    return root, ema_dir
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of the feature checkpoints (E4_Checkpoint.py) and resuming E4_Features.py"""
+
+#Import Libraries
+import os, shutil
+import pandas as pd
+import E4_Features
+from E4_Checkpoint import FeatureCheckpoint
+
+
+def test_checkpoint_resume(tmp_path):
+    """Rows in the checkpoint file are done after a restart, and end up in the feature file"""
+    EMA_df = pd.DataFrame({'castor_record_id': ['sub_001', 'sub_001', 'sub_002'],
+                           'survey_instance_id': ['SI1', 'SI2', 'SI3'], 'feat': [float('nan')] * 3})
+    feature_file = str(tmp_path / 'Features.csv')
+    checkpoint = FeatureCheckpoint(feature_file, EMA_df, ['feat'], flush_every=1)
+    checkpoint.add(EMA_df.iloc[:2].assign(feat=[1.0, 2.0]))
+    assert os.path.isfile(checkpoint.path)
+
+    #A new run (after a crash) skips the rows of the first subject
+    restarted = FeatureCheckpoint(feature_file, EMA_df, ['feat'], flush_every=1)
+    assert restarted.is_done(EMA_df).tolist() == [True, True, False]
+    restarted.add(EMA_df.iloc[2:].assign(feat=[3.0]))
+    result = restarted.finalize(EMA_df.copy())
+    assert result['feat'].tolist() == [1.0, 2.0, 3.0]
+    assert not os.path.isfile(checkpoint.path)
+
+    #Without resume the checkpoint is started over
+    FeatureCheckpoint(feature_file, EMA_df, ['feat'], flush_every=1).add(EMA_df.iloc[:1].assign(feat=[1.0]))
+    assert not FeatureCheckpoint(feature_file, EMA_df, ['feat'], resume=False).is_done(EMA_df).any()
+
+
+def test_features_resume_after_interrupt(merged_cohort, tmp_path, monkeypatch):
+    """A run that stopped after the first subject only calculates the others, with the same result"""
+    root, ema_src = merged_cohort
+    ema_dir = str(tmp_path / 'EMA')
+    shutil.copytree(ema_src, ema_dir)
+    options = ['--root', root, '--ema-dir', ema_dir, '--no-eda-cache', '--eda-backend', 'native']
+    assert E4_Features.main(options + ['--no-resume']) == 0
+    complete = [pd.read_csv(f) for f in E4_Features.feature_files(ema_dir)]
+
+    #Checkpoints as left by a run that stopped after sub_001
+    for sleep, (feature_file, features) in enumerate(zip(E4_Features.feature_files(ema_dir), complete)):
+        checkpoint = FeatureCheckpoint(feature_file, features, E4_Features.feature_columns(sleep == 1), flush_every=1)
+        checkpoint.add(features[features['castor_record_id'] == 'sub_001'])
+        os.remove(feature_file)
+
+    #An EDA window of sub_001 that failed before the stop
+    errors_file = os.path.join(ema_dir, 'E4_Feature_Errors.csv')
+    errors = pd.DataFrame([error_record('sub_001')])
+    errors.to_csv(errors_file, index=None)
+
+    run = []
+    subject_features = E4_Features.subject_features
+    monkeypatch.setattr(E4_Features, 'subject_features', lambda sub_ID, *args: run.append(sub_ID) or
+                        subject_features(sub_ID, *args))
+    assert E4_Features.main(options) == 0
+    assert run == ['sub_002']
+    for feature_file, features in zip(E4_Features.feature_files(ema_dir), complete):
+        pd.testing.assert_frame_equal(pd.read_csv(feature_file), features)
+        assert not os.path.isfile(os.path.splitext(feature_file)[0] + '.checkpoint.csv')
+    #The errors of the subjects that were not run again are kept
+    pd.testing.assert_frame_equal(pd.read_csv(errors_file), errors)
+
+
+def error_record(sub_ID, row=0, stage='driver'):
+    """Record of an EDA window that failed, as in E4_Feature_Errors.csv"""
+    return {'castor_record_id': sub_ID, 'window': 'wake', 'row': row, 'start_time': '2021-03-01 09:50:00',
+            'end_time': '2021-03-01 10:00:00', 'stage': stage, 'error': 'ValueError()'}
+
+
+def test_update_errors_file(tmp_path):
+    """Only the error records of the subjects that were run are replaced"""
+    errors_file = str(tmp_path / 'E4_Feature_Errors.csv')
+    assert E4_Features.update_errors_file(errors_file, [error_record('sub_001'), error_record('sub_002')],
+                                          ['sub_001', 'sub_002']) == 2
+    #sub_002 run again (e.g. with --subjects) with another failed window
+    assert E4_Features.update_errors_file(errors_file, [error_record('sub_002', 5, 'phasic')], ['sub_002']) == 2
+    errors = pd.read_csv(errors_file)
+    assert errors[['castor_record_id', 'row', 'stage']].values.tolist() == [['sub_001', 0, 'driver'],
+                                                                           ['sub_002', 5, 'phasic']]
+    #sub_001 run again without failed windows, and a subject without records
+    assert E4_Features.update_errors_file(errors_file, [], ['sub_001', 'sub_003']) == 1
+    assert pd.read_csv(errors_file)['castor_record_id'].tolist() == ['sub_002']
+    #A full run from the start without failed windows removes the file
+    assert E4_Features.update_errors_file(errors_file, [], ['sub_001'], keep=False) == 0
+    assert not os.path.isfile(errors_file)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of the EDA backends of E4_Features.py and their comparison (E4_EDACompare.py)"""
+
+#Import Libraries
+import pandas as pd
+import pytest
+import E4_Features
+import E4_EDACompare
+
+
+def test_default_backend_is_pyphysio_when_installed():
+    """The original pyphysio values are the default; the native chain only without pyphysio"""
+    assert E4_Features.eda_backend == ('pyphysio' if E4_Features.ph is not None else 'native')
+
+
+def test_tolerance_check():
+    """Features are within tolerance when close (relative, or about zero in both) and correlated"""
+    ref = pd.DataFrame({'sc_a': [1.0, 2.0, 3.0, 4.0], 'sc_b': [1.0, 2.0, 3.0, 4.0], 'sc_c': [1e-18, 0, -1e-18, 0]})
+    other = pd.DataFrame({'sc_a': [1.01, 2.02, 2.97, 4.0], 'sc_b': [1.5, 2.5, 2.0, 5.0], 'sc_c': [1e-9, -1e-9, 0, 1e-9]})
+    report = E4_EDACompare.comparison_report(ref, other, ('pyphysio', 'native')).set_index('feature')
+    assert report['within_tolerance'].to_dict() == {'sc_a': True, 'sc_b': False, 'sc_c': True}
+
+
+def test_native_within_tolerance_of_pyphysio(request):
+    """The native chain gives SC features within tolerance of pyphysio on a sample of windows"""
+    pytest.importorskip('pyphysio')
+    root, ema_dir = request.getfixturevalue('merged_cohort')
+    assert E4_EDACompare.main(['--compare', 'backends', '--root', root, '--ema-dir', ema_dir, '--no-eda-cache',
+                               '--sample', '10']) == 0
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the EDA component cache (E4_EDACache.py): hits, new keys for
+changed values or parameters, atomic writes, and eviction of the least
+recently used entries above max_bytes.
+"""
+
+#Import Libraries
+import os
+import numpy as np
+import pytest
+import E4_EDACache
+from E4_EDACache import EDACache
+
+params = {'fp': 0.8, 'delta': 0.02}
+
+
+def components(n=1000, value=1.0):
+    """Driver, phasic and tonic signal of a window with constant values"""
+    return {'driver': np.full(n, value), 'phasic': np.full(n, value / 2), 'tonic': np.full(n, value / 4)}
+
+
+def test_hit_and_miss(tmp_path):
+    cache = EDACache(str(tmp_path))
+    values = np.linspace(0, 1, 240)
+    calls = []
+
+    def compute(v):
+        calls.append(len(v))
+        return components()
+
+    first = cache.cached(compute, values, params, sub_ID='sub_001', start_time='t0', end_time='t1')
+    again = cache.cached(compute, values, params, sub_ID='sub_001', start_time='t0', end_time='t1')
+    assert calls == [240]
+    assert (cache.hits, cache.misses) == (1, 1)
+    for name in first:
+        np.testing.assert_array_equal(first[name], again[name])
+
+    #Changed values, parameters or window give another key (a miss)
+    key = cache.key(values, params, 'sub_001', '', 't0', 't1')
+    changed = values.copy()
+    changed[10] += 1e-9
+    assert cache.key(changed, params, 'sub_001', '', 't0', 't1') != key
+    assert cache.key(values, dict(params, fp=1.1), 'sub_001', '', 't0', 't1') != key
+    assert cache.key(values, params, 'sub_001', '', 't0', 't2') != key
+    cache.cached(compute, values, dict(params, fp=1.1), sub_ID='sub_001', start_time='t0', end_time='t1')
+    assert len(calls) == 2 and cache.misses == 2
+
+
+def test_atomic_write(tmp_path, monkeypatch):
+    cache = EDACache(str(tmp_path))
+    key = cache.key(np.zeros(10), params)
+    cache.put(key, components())
+    assert cache.get(key) is not None
+
+    #A write that fails leaves the entry as it was, and no temporary file
+    def broken(f, **arrays):
+        f.write(b'half written')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(E4_EDACache.np, 'savez', broken)
+    other = cache.key(np.ones(10), params)
+    with pytest.raises(OSError):
+        cache.put(other, components())
+    with pytest.raises(OSError):
+        cache.put(key, components(value=2.0))
+    files = [name for _, _, names in os.walk(str(tmp_path)) for name in names]
+    assert sorted(files) == [key + '.npz']
+    assert cache.get(other) is None
+    np.testing.assert_array_equal(cache.get(key)['driver'], components()['driver'])
+
+
+def test_eviction(tmp_path):
+    cache = EDACache(str(tmp_path), max_bytes=None)
+    keys = [cache.key(np.full(10, k), params) for k in range(3)]
+    for k, key in enumerate(keys):
+        cache.put(key, components())
+        #Written an hour apart, the first is the oldest
+        os.utime(cache.path(key), (1e9 + 3600 * k, 1e9 + 3600 * k))
+    entry_size = os.path.getsize(cache.path(keys[0]))
+    #A hit marks the oldest entry as recently used
+    assert cache.get(keys[0]) is not None
+
+    #Room for three entries: adding a fourth removes the least recently used one
+    cache = EDACache(str(tmp_path), max_bytes=3.5 * entry_size)
+    new = cache.key(np.full(10, 3), params)
+    cache.put(new, components())
+    assert not os.path.isfile(cache.path(keys[1]))
+    assert all(os.path.isfile(cache.path(key)) for key in [keys[0], keys[2], new])
+    assert cache.size() <= cache.max_bytes
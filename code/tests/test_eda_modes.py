@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of the EDA modes of E4_Features.py"""
+
+#Import Libraries
+import pandas as pd
+import E4_Cleaner
+import E4_Features
+
+
+def recording_windows(root, sub_nr):
+    """Two 10 minute windows in each recording of a subject, more than an hour apart"""
+    starts = []
+    for session_type in E4_Cleaner.sessions:
+        filepath = E4_Cleaner.session_path(sub_nr, session_type, root)
+        starts += [pd.to_datetime(int(k.split('_')[0]), unit='s') for k in E4_Cleaner.session_dirs(filepath)]
+    ends = [start + pd.Timedelta(minutes=m) for start in starts for m in (12, 85)]
+    window_end = pd.Series(ends)
+    return starts, (window_end - pd.Timedelta(minutes=10), window_end)
+
+
+def test_session_mode_segments_are_recordings(merged_cohort):
+    """In session mode the EDA is split into the recordings, not into the (joined) EMA windows"""
+    root, _ = merged_cohort
+    starts, wake_windows = recording_windows(root, 1)
+    no_windows = (pd.Series([], dtype='datetime64[ns]'), pd.Series([], dtype='datetime64[ns]'))
+
+    data = E4_Features.load_windows_data('sub_001', wake_windows, no_windows, root, eda_mode='session')
+    assert len(E4_Features.SessionEDA(data['EDA']).starts) == len(starts)
+
+    #The window mode only reads the windows, two ranges per recording
+    data = E4_Features.load_windows_data('sub_001', wake_windows, no_windows, root, eda_mode='window')
+    assert len(E4_Features.SessionEDA(data['EDA']).starts) == 2 * len(starts)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the LF/HF heart rate power (E4_HRV.py): the default 'fft' mode
+gives the values of the original per window code of E4_Features.py
+(pandas resample to 4 Hz, nearest interpolation, Hann window, np.fft.fft).
+"""
+
+#Import Libraries
+import numpy as np
+import pandas as pd
+import pytest
+import E4_Features
+from E4_HRV import batch_lf_hf
+from E4_Windows import window_bounds_batch
+
+
+def old_lf_hf(df, start_time, end_time):
+    """LF and HF power of one window with the original code, None with too few IBIs"""
+    temp_IBI = df[(df.Time > start_time) & (df.Time < end_time)].astype({'Data': np.float64})
+    if temp_IBI.size <= 100:
+        return None
+    IBI_fft = temp_IBI
+    IBI_fft = IBI_fft.set_index(IBI_fft.Time)
+    IBI_fft = IBI_fft.drop('Time', axis=1)
+    IBI_fft = IBI_fft.resample('250ms').apply(np.mean)
+    IBI_fft = IBI_fft.interpolate(method='nearest')
+    signal_len = IBI_fft.Data.size
+    hann_window = np.hanning(signal_len)
+    hann_window = hann_window/np.sum(hann_window)
+    IBI_fft = IBI_fft['Data']*hann_window
+    IBI_fft = np.abs(np.fft.fft(IBI_fft))
+    IBI_freqs = IBI_fft**2
+    LF_start = np.round(0.05/(4/signal_len))
+    LF_stop = np.round(0.15/(4/signal_len))
+    HF_start = np.round(0.15/(4/signal_len))
+    HF_stop = np.round(0.4/(4/signal_len))
+    return np.sum(IBI_freqs[int(LF_start):int(LF_stop)]), np.sum(IBI_freqs[int(HF_start):int(HF_stop)])
+
+
+def test_fft_matches_old(merged_cohort):
+    root, _ = merged_cohort
+    ibi = E4_Features.load_subject('sub_001', root)['IBI']
+    rng = np.random.default_rng(0)
+    #Windows of 10 minutes (many with the same grid length) and of other lengths, ending after random beats
+    n = 60
+    lengths = pd.to_timedelta(np.where(np.arange(n) < 40, 600, rng.integers(60, 900, n)), unit='s')
+    after = pd.to_timedelta(rng.integers(0, 600 * 10**3, n), unit='ms')
+    ends = pd.Series(pd.DatetimeIndex(ibi.times[rng.integers(len(ibi), size=n)]) + after)
+    starts = ends - lengths
+    first, stop = window_bounds_batch(ibi.times, starts, ends)
+    lf, hf, lfhf = batch_lf_hf(ibi.times, ibi.df['Data'].to_numpy(), first, stop, 'fft')
+
+    n_compared = 0
+    for row in range(n):
+        old = old_lf_hf(ibi.df, starts[row], ends[row])
+        if old is None:
+            assert np.isnan(lf[row]) and np.isnan(hf[row]) and np.isnan(lfhf[row])
+            continue
+        assert lf[row] == pytest.approx(old[0], rel=1e-9, abs=1e-12)
+        assert hf[row] == pytest.approx(old[1], rel=1e-9, abs=1e-12)
+        assert lfhf[row] == pytest.approx(old[0] / old[1], rel=1e-9)
+        n_compared += 1
+    assert n_compared > 20
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of reading the merged files (E4_IO.py): the weeks of a subject read
+into preallocated columns, batch by batch, give the same data as the merged
+files read whole and joined, with a peak memory of about the result.
+"""
+
+#Import Libraries
+import tracemalloc
+import pandas as pd
+import pytest
+import E4_Features, E4_IO
+from E4_Schema import frame_mb
+
+
+@pytest.mark.parametrize('rows', [1000, 10**6])
+def test_read_merged_sessions(merged_cohort, monkeypatch, rows):
+    root, _ = merged_cohort
+    monkeypatch.setattr(E4_IO, 'batch_rows', rows)
+    merge_dirs = E4_Features.subject_merge_dirs('sub_001', root)
+    assert len(merge_dirs) == 2
+    for data_type in E4_Features.data_types + ['BVP']:
+        df = E4_IO.read_merged_sessions(merge_dirs, data_type)
+        whole = pd.concat([E4_IO.read_merged(merge_dir, data_type) for merge_dir in merge_dirs], ignore_index=True)
+        whole = whole.sort_values('Time', kind='stable', ignore_index=True)
+        pd.testing.assert_frame_equal(df, whole)
+
+
+def test_read_merged_sessions_peak(merged_cohort, monkeypatch):
+    root, _ = merged_cohort
+    monkeypatch.setattr(E4_IO, 'batch_rows', 10000)
+    merge_dirs = E4_Features.subject_merge_dirs('sub_001', root)
+    tracemalloc.start()
+    try:
+        df = E4_IO.read_merged_sessions(merge_dirs, 'ACC')
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    #The columns of the result and one batch, not the whole files next to the columns
+    assert peak / 1024**2 < 1.3 * frame_mb(df)
+
+
+@pytest.mark.parametrize('out_format', ['parquet', 'feather', 'csv'])
+def test_read_merged_no_ranges(merged_cohort, tmp_path, monkeypatch, out_format):
+    root, _ = merged_cohort
+    merge_dir = E4_Features.subject_merge_dirs('sub_001', root)[0]
+    full = E4_IO.read_merged(merge_dir, 'ACC')
+    E4_IO.write_merged(full, str(tmp_path), 'ACC', out_format)
+    #Only the columns are read
+    for name in ['read_parquet', 'read_feather']:
+        monkeypatch.setattr(pd, name, lambda *args, **kwargs: pytest.fail('file read for no ranges'))
+    empty = E4_IO.read_merged(str(tmp_path), 'ACC', [])
+    assert len(empty) == 0
+    pd.testing.assert_series_equal(empty.dtypes, full.dtypes)
+
+
+def test_read_merged_sessions_no_ranges(merged_cohort, monkeypatch):
+    root, _ = merged_cohort
+    merge_dirs = E4_Features.subject_merge_dirs('sub_001', root)
+    for name in ['merged_file', 'merged_rows']:
+        monkeypatch.setattr(E4_IO, name, lambda *args: pytest.fail('file opened for no ranges'))
+    assert E4_IO.read_merged_sessions(merge_dirs, 'EDA', []).empty
+    assert E4_IO.read_store_sessions(merge_dirs, 'EDA', []).empty
+    assert len(E4_IO.LazySubject(merge_dirs, [], store=True)['ACC']) == 0
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the live feature engine (E4_Live.py): windows in a gap of the
+stream (e.g. between recordings) are skipped, not counted as dropped.
+"""
+
+#Import Libraries
+import asyncio
+import numpy as np
+import pandas as pd
+import E4_Live
+
+minute_ns = 60 * 10**9
+
+
+def test_stream_gaps():
+    gap_ns = 10 * minute_ns
+    times = np.array([1, 2, 30, 31], dtype=np.int64) * minute_ns
+    assert E4_Live.stream_gaps(None, times, gap_ns) == []
+    assert E4_Live.stream_gaps(0, times, gap_ns) == [(2 * minute_ns, 30 * minute_ns)]
+    #Gap before the batch, and samples that are not newer than the newest so far
+    assert E4_Live.stream_gaps(-20 * minute_ns, times, gap_ns) == [(-20 * minute_ns, minute_ns),
+                                                                  (2 * minute_ns, 30 * minute_ns)]
+    assert E4_Live.stream_gaps(40 * minute_ns, times, gap_ns) == []
+
+
+def test_gap_windows_skipped():
+    start = pd.Timestamp('2021-03-01 10:00').value
+    #Two recordings of 20 minutes of TEMP (4 Hz) two days apart, in batches of a minute
+    blocks = [start, start + 2 * 24 * 60 * minute_ns]
+
+    async def source():
+        for block in blocks:
+            for minute in range(20):
+                times = block + minute * minute_ns + np.arange(240, dtype=np.int64) * 250_000_000
+                yield 'TEMP', times, np.full((240, 1), 32.0)
+                #Slow enough for the features to keep up
+                await asyncio.sleep(0.05)
+
+    vectors = []
+    stats = asyncio.run(E4_Live.run_engine(source(), E4_Live.LiveFeatures(), vectors.append))
+    times = pd.DatetimeIndex([v['time'] for v in vectors])
+    assert stats['dropped'] == 0
+    #The windows with data of the first recording (to 10 minutes after its last sample, as the second
+    #recording follows), then from the start of the second to its last sample (the end of the stream)
+    expected = pd.DatetimeIndex([pd.Timestamp(blocks[0] + n * minute_ns) for n in range(1, 30)]
+                                + [pd.Timestamp(blocks[1] + n * minute_ns) for n in range(20)])
+    assert stats['vectors'] == len(vectors)
+    assert times.equals(expected)
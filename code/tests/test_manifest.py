@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of merging only new sessions with the manifests (E4_Manifest.py, E4_Cleaner.py)"""
+
+#Import Libraries
+import os, shutil
+import numpy as np
+import pandas as pd
+import pytest
+import E4_Cleaner
+import synthetic_data
+from E4_IO import read_merged
+from E4_Manifest import MergeManifest
+
+
+def add_session(filepath, empty_ibi=False):
+    """Write a new short session a day after the last one, optionally with an empty IBI export"""
+    last = max(int(k.split('_')[0]) for k in E4_Cleaner.session_dirs(filepath))
+    session_dir = os.path.join(filepath, '%d_A99999' % (last + 86400))
+    synthetic_data.write_session(session_dir, last + 86400, 600, 0, 0, np.random.default_rng(1))
+    if empty_ibi:
+        open(os.path.join(session_dir, 'IBI.csv'), 'w').close()
+    return session_dir
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_append_new_sessions(cohort, stream):
+    """New sessions are appended (an empty IBI export is skipped), with the same result as a full merge"""
+    filepath = E4_Cleaner.session_path(1, 'control', cohort)
+    for data_type in E4_Cleaner.data_types:
+        assert E4_Cleaner.merge_data_type(filepath, data_type, stream=stream)[1] == 'full'
+        assert E4_Cleaner.merge_data_type(filepath, data_type, stream=stream)[1] == 'skip'
+
+    add_session(filepath, empty_ibi=True)
+    for data_type in E4_Cleaner.data_types:
+        _, action = E4_Cleaner.merge_data_type(filepath, data_type, stream=stream)
+        assert action == ('skip' if data_type == 'IBI.csv' else 'append')
+        #The manifest records the new session, so the next run has nothing to do
+        assert MergeManifest(filepath, data_type).entry is not None
+        assert E4_Cleaner.merge_data_type(filepath, data_type, stream=stream)[1] == 'skip'
+
+    #Same data as merging all sessions again
+    copy = filepath + '_full'
+    shutil.copytree(filepath, copy)
+    for data_type in E4_Cleaner.data_types:
+        appended = read_merged(os.path.join(filepath, 'merge'), data_type)
+        E4_Cleaner.merge_data_type(copy, data_type, stream=stream, force=True)
+        pd.testing.assert_frame_equal(appended, read_merged(os.path.join(copy, 'merge'), data_type))
+
+
+def test_merge_ibi_without_beats(cohort):
+    """Sessions without beats give an empty IBI frame with the IBI columns"""
+    filepath = E4_Cleaner.session_path(1, 'control', cohort)
+    session_dir = add_session(filepath, empty_ibi=True)
+    full_df = E4_Cleaner.merge_ibi(filepath, [os.path.basename(session_dir)])
+    assert list(full_df.columns) == ['Time', 'Data'] and len(full_df) == 0
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of the merge of the E4 sessions (E4_Cleaner.py, E4_Stream.py)"""
+
+#Import Libraries
+import os
+import pytest
+import pandas as pd
+import E4_Cleaner
+from E4_IO import read_merged
+
+
+@pytest.mark.parametrize('out_format', ['parquet', 'feather', 'csv'])
+def test_stream_merge_equals_in_memory(cohort, out_format):
+    """Merging in chunks gives the same merged data as merging whole files"""
+    filepath = E4_Cleaner.session_path(1, 'control', cohort)
+    for data_type in E4_Cleaner.data_types:
+        E4_Cleaner.merge_data_type(filepath, data_type, out_format, stream=False)
+        in_memory = read_merged(os.path.join(filepath, 'merge'), data_type)
+        #Small chunks, so every session is read in several parts
+        _, action = E4_Cleaner.merge_data_type(filepath, data_type, out_format, stream=True, rows=5000, force=True)
+        assert action == 'full'
+        streamed = read_merged(os.path.join(filepath, 'merge'), data_type)
+        pd.testing.assert_frame_equal(streamed[in_memory.columns], in_memory, check_exact=False, rtol=1e-6)
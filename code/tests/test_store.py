@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the signal store (E4_Store.py): reads from the store give the
+samples of the merged files, stores that do not hold every sample as it is
+(overlapping or out of phase sessions) are reported and not read, and a
+store is replaced, not changed in place.
+"""
+
+#Import Libraries
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import E4_Cleaner, E4_Features, E4_IO
+from E4_Store import write_store_chunks, store_issues, read_store, SignalStore
+
+
+def session(start, n, samp_freq=4, value=0.0):
+    """Data frame of an evenly sampled session of n samples from start"""
+    times = pd.Timestamp(start) + pd.to_timedelta(np.arange(n) * (1e9 / samp_freq), unit='ns')
+    return pd.DataFrame({'Time': times, 'Data': value + np.arange(n, dtype=np.float32)})
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_store_reads(cohort, stream):
+    args = ['--root', cohort, '--subjects', '1', '2', '--store']
+    assert E4_Cleaner.main(args + (['--stream'] if stream else [])) == 0
+    merge_dirs = E4_Features.subject_merge_dirs('sub_001', cohort)
+    assert all(os.path.isdir(E4_IO.store_dir(merge_dir)) for merge_dir in merge_dirs)
+    first = E4_IO.read_merged_sessions(merge_dirs, 'TEMP')['Time']
+    ranges = [(first.iloc[100], first.iloc[400]), (first.iloc[-300], first.iloc[-1] + pd.Timedelta(days=1))]
+    for data_type in ['EDA', 'TEMP', 'HR', 'ACC']:
+        for selection in [None, ranges]:
+            store_df = E4_IO.read_store_sessions(merge_dirs, data_type, selection)
+            merged_df = E4_IO.read_merged_sessions(merge_dirs, data_type, selection)
+            pd.testing.assert_frame_equal(store_df, merged_df)
+    #Data types without a store are read from the merged files
+    assert E4_IO.read_store_sessions(merge_dirs, 'IBI') is None
+    data = E4_Features.load_subject('sub_001', cohort, ranges, store=True)
+    pd.testing.assert_frame_equal(data['IBI'].df, E4_IO.read_merged_sessions(merge_dirs, 'IBI', ranges))
+
+
+def test_store_older_than_merged(cohort):
+    assert E4_Cleaner.main(['--root', cohort, '--subjects', '1', '--store']) == 0
+    merge_dir = E4_Features.subject_merge_dirs('sub_001', cohort)[0]
+    fullin, _ = E4_IO.merged_file(merge_dir, 'EDA')
+    assert read_store(E4_IO.store_dir(merge_dir), 'EDA', None, fullin) is not None
+    #Merged again without the store
+    stat = os.stat(fullin)
+    os.utime(fullin, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert read_store(E4_IO.store_dir(merge_dir), 'EDA', None, fullin) is None
+    assert E4_IO.read_store_sessions([merge_dir], 'EDA') is None
+
+
+def test_store_issues(tmp_path):
+    store_dir = str(tmp_path)
+    a = session('2021-03-01 10:00:00', 400)
+    #In phase after a gap: held exactly
+    write_store_chunks([a, session('2021-03-01 11:00:00', 400)], store_dir, 'EDA', a['Time'].iloc[0].value,
+                       pd.Timestamp('2021-03-01 11:01:39.75').value, 4)
+    assert store_issues(store_dir, 'EDA') is None
+    assert SignalStore(store_dir, 'EDA').exact
+    assert len(read_store(store_dir, 'EDA')) == 800
+    #Second session out of phase (a tenth of a second later)
+    b = session('2021-03-01 11:00:00.100', 400)
+    write_store_chunks([a, b], store_dir, 'EDA', a['Time'].iloc[0].value, b['Time'].iloc[-1].value, 4)
+    assert store_issues(store_dir, 'EDA') == '400 samples out of phase'
+    assert read_store(store_dir, 'EDA') is None
+    #Second session overlapping the first by 100 samples
+    c = session('2021-03-01 10:01:15', 400, value=1000.0)
+    both = pd.concat([a, c]).sort_values('Time', kind='stable')
+    write_store_chunks([both], store_dir, 'EDA', a['Time'].iloc[0].value, c['Time'].iloc[-1].value, 4)
+    assert store_issues(store_dir, 'EDA') == '100 samples overlap'
+    assert not SignalStore(store_dir, 'EDA').exact
+    #Overlap across chunks
+    write_store_chunks([a, c], store_dir, 'EDA', a['Time'].iloc[0].value, c['Time'].iloc[-1].value, 4)
+    assert store_issues(store_dir, 'EDA') == '100 samples overlap'
+
+
+def test_store_replaced(tmp_path):
+    store_dir = str(tmp_path)
+    a = session('2021-03-01 10:00:00', 400)
+    write_store_chunks([a], store_dir, 'EDA', a['Time'].iloc[0].value, a['Time'].iloc[-1].value, 4)
+    store = SignalStore(store_dir, 'EDA')
+    b = session('2021-03-01 10:00:00', 800, value=500.0)
+    write_store_chunks([b], store_dir, 'EDA', b['Time'].iloc[0].value, b['Time'].iloc[-1].value, 4)
+    #The open store still reads the old values, a new one the new values
+    assert len(store) == 400 and store.values[10, 0] == 10.0
+    new = SignalStore(store_dir, 'EDA')
+    assert len(new) == 800 and new.values[10, 0] == 510.0
+    assert sorted(os.listdir(store_dir)) == ['EDA.json', 'EDA.npy']
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the window extraction and batch features (E4_Windows.py) against
+the code they replaced: boolean masks df[(df.Time > start) & (df.Time < end)]
+for the windows, and the per window HR/IBI, temperature and ACC formulas of
+the original E4_Features.py for the features.
+"""
+
+#Import Libraries
+import numpy as np
+import pandas as pd
+import pytest
+import E4_Features
+from E4_Windows import SignalWindows, window_bounds, window_bounds_batch, batch_window_features
+
+
+def mask_window(df, start_time, end_time):
+    """Window as selected before, with a boolean mask"""
+    return df[(df.Time > start_time) & (df.Time < end_time)]
+
+
+def test_window_matches_mask():
+    rng = np.random.default_rng(0)
+    #4 Hz samples with a gap and repeated time stamps (overlapping sessions)
+    times = pd.Timestamp('2021-03-01 10:00') + pd.to_timedelta(np.arange(400) * 250, unit='ms')
+    times = times.append(times[-50:]).append(times[-1] + pd.to_timedelta(3600 + np.arange(200) * 0.25, unit='s'))
+    df = pd.DataFrame({'Time': times, 'Data': rng.normal(size=len(times)).astype(np.float32)})
+    df = df.sort_values('Time', kind='stable', ignore_index=True)
+    t = df['Time']
+    windows = [(t.iloc[10], t.iloc[50]),                       #On exact sample times
+               (t.iloc[10] + pd.Timedelta(milliseconds=1), t.iloc[50] - pd.Timedelta(milliseconds=1)),
+               (t.iloc[380], t.iloc[480]),                      #Over the repeated time stamps
+               (t.iloc[10], t.iloc[11]),                        #No sample inside
+               (t.iloc[50], t.iloc[10]),                        #End before start
+               (t.iloc[0] - pd.Timedelta(days=1), t.iloc[0]),   #Before the data
+               (t.iloc[-1], t.iloc[-1] + pd.Timedelta(days=1)), #After the data
+               (t.iloc[0] - pd.Timedelta(days=1), t.iloc[-1] + pd.Timedelta(days=1)),
+               (t.iloc[420] + pd.Timedelta(minutes=5), t.iloc[420] + pd.Timedelta(minutes=20)), #In the gap
+               (pd.NaT, t.iloc[50]), (t.iloc[10], pd.NaT), (pd.NaT, pd.NaT)]
+    shuffled = df.sample(frac=1, random_state=1)
+    for data in [df, shuffled]:
+        windows_data = SignalWindows(data)
+        for start_time, end_time in windows:
+            expected = mask_window(data, start_time, end_time).sort_values('Time', kind='stable')
+            pd.testing.assert_frame_equal(windows_data.window(start_time, end_time).reset_index(drop=True),
+                                          expected.reset_index(drop=True))
+        #All windows at once give the same rows
+        first, stop = window_bounds_batch(windows_data.times, [w[0] for w in windows], [w[1] for w in windows])
+        single = [window_bounds(windows_data.times, *w) for w in windows]
+        assert [tuple(bounds) for bounds in zip(first, stop)] == single
+    #Empty data
+    empty = SignalWindows(df.iloc[0:0])
+    assert len(empty.window(t.iloc[0], t.iloc[-1])) == 0
+
+
+def old_window_features(data, start_time, end_time):
+    """HR/IBI, temperature and ACC features of one window with the formulas of the original E4_Features.py"""
+    feats = {}
+    temp_IBI = mask_window(data['IBI'].df, start_time, end_time).astype({'Data': np.float64})
+    temp_HR = mask_window(data['HR'].df, start_time, end_time).astype({'Data': np.float64})
+    temp_temp = mask_window(data['TEMP'].df, start_time, end_time).astype({'Data': np.float64})
+    temp_ACC = mask_window(data['ACC'].df, start_time, end_time).astype(
+        {'ACC_X': np.float64, 'ACC_Y': np.float64, 'ACC_Z': np.float64})
+    if temp_IBI.size > 100:
+        feats['ibi_mean'] = np.mean(temp_IBI['Data'])
+        feats['ibi_sd'] = np.std(temp_IBI['Data'])
+        feats['ibi_min'] = np.min(temp_IBI['Data'])
+        feats['ibi_max'] = np.max(temp_IBI['Data'])
+        feats['hr_rmssd'] = np.sqrt(np.mean(np.square(np.diff(temp_IBI['Data']))))
+        feats['hr_mean'] = np.mean(temp_HR.Data)
+        feats['hr_sd'] = np.std(temp_HR['Data'])
+        feats['hr_min'] = np.min(temp_HR['Data'])
+        feats['hr_max'] = np.max(temp_HR['Data'])
+        feats['ibi_based_quality'] = (np.sum(temp_IBI.Data))/1000/(10*60)
+    if temp_temp.size > 10:
+        feats['temp_mean'] = temp_temp['Data'].mean()
+        feats['temp_median'] = temp_temp['Data'].median()
+        feats['temp_sd'] = temp_temp['Data'].std()
+        feats['temp_slope'] = np.polyfit(range(len(temp_temp['Data'].values)), temp_temp['Data'].values, 1)[0]
+    if temp_ACC['ACC_X'].size > 20:
+        temp_ACC['ACC_X'] = np.array(abs(temp_ACC['ACC_X'].diff(-1)))
+        temp_ACC['ACC_Y'] = np.array(abs(temp_ACC['ACC_Y'].diff(-1)))
+        temp_ACC['ACC_Z'] = np.array(abs(temp_ACC['ACC_Z'].diff(-1)))
+        temp_ACC['ACC_tot'] = np.sqrt(temp_ACC['ACC_X']**2+temp_ACC['ACC_Y']**2+temp_ACC['ACC_Z']**2)
+        feats['acc_x'] = np.mean(temp_ACC['ACC_X'])
+        feats['acc_x_sd'] = np.std(temp_ACC['ACC_X'])
+        feats['acc_y'] = np.mean(temp_ACC['ACC_Y'])
+        feats['acc_y_sd'] = np.std(temp_ACC['ACC_Y'])
+        feats['acc_z'] = np.mean(temp_ACC['ACC_Z'])
+        feats['acc_z_sd'] = np.std(temp_ACC['ACC_Z'])
+        feats['acc_delta'] = np.nanmean(temp_ACC['ACC_tot'])
+        feats['acc_delta_sd'] = np.nanstd(temp_ACC['ACC_tot'])
+    return feats
+
+
+def gate_windows(times, limit):
+    """Windows with exactly limit and limit + 1 samples inside (open interval), for the minimum sample gates"""
+    starts, ends = [], []
+    for i in [0, len(times) // 2]:
+        for n in [limit, limit + 1]:
+            starts.append(times[i])
+            ends.append(times[i + n + 1])
+    return starts, ends
+
+
+def test_batch_features_match_old(merged_cohort):
+    root, _ = merged_cohort
+    data = E4_Features.load_subject('sub_001', root)
+    rng = np.random.default_rng(0)
+    #10 minute windows ending up to 15 minutes after random samples (some partly or fully after a recording)
+    hr_times = data['HR'].times
+    after = pd.to_timedelta(rng.integers(0, 15 * 60, 40), unit='s')
+    ends = pd.DatetimeIndex(hr_times[rng.integers(len(hr_times), size=40)]) + after
+    starts = list(ends - pd.Timedelta(minutes=10))
+    ends = list(ends)
+    #Windows at the sample gates: more than 50 IBIs, 5 temperature samples and 20 ACC samples
+    for data_type, limit in [('IBI', 50), ('TEMP', 5), ('ACC', 20)]:
+        gate_starts, gate_ends = gate_windows(data[data_type].times, limit)
+        starts += gate_starts
+        ends += gate_ends
+    starts, ends = pd.Series(starts), pd.Series(ends)
+    batch = batch_window_features({name: data[name] for name in ['IBI', 'HR', 'TEMP', 'ACC']}, starts, ends)
+
+    for row in range(len(starts)):
+        old = old_window_features(data, starts[row], ends[row])
+        for name in E4_Features.batch_feats:
+            if name in old:
+                assert batch[name].iloc[row] == pytest.approx(old[name], rel=1e-5, abs=1e-6), (row, name)
+            else:
+                assert np.isnan(batch[name].iloc[row]), (row, name)
+    #The gate windows (last 12): NaN at the limit, features with one sample more
+    gates = batch.iloc[-12:]
+    for k, name in enumerate(['ibi_mean', 'temp_mean', 'acc_x']):
+        assert gates[name].iloc[4*k:4*k + 4].notna().tolist() == [False, True, False, True]
+    assert batch.iloc[:-12][['ibi_mean', 'temp_mean', 'acc_x']].notna().all(axis=1).sum() > 10
+